@@ -0,0 +1,346 @@
+"""An approximate nearest neighbour index of patent embeddings, for finding the patents closest to a document.
+
+The index is an inverted file (IVF): the normalized vectors are clustered with k-means, and each vector is put in the
+list of its closest centroid. A query is only compared with the vectors in the lists of its nprobe closest centroids,
+instead of with all vectors, and the neighbours are the vectors with the largest cosine similarity. Patents added after
+the index is built go into the list of their closest centroid, the centroids are not trained again.
+Queries can be restricted to patents published in a range of years or having one of a set of IPC main classes.
+
+    index = IVFIndex.from_stores([EmbeddingStore('patent_sbert/patent_sbert_english_netto_list')], kinds=('abstract', 'claims'))
+    patent_numbers, similarities = index.search(query_vector, k=10, years=(2010, 2015), ipc_classes={'A61K'})
+
+The index is saved as a directory of .npy files like the embedding stores, and the script builds, queries and
+benchmarks indices:
+
+    python scripts/ann_index.py build patent_sbert/patent_sbert_english_netto_list --kinds abstract claims --output netto_index
+    python scripts/ann_index.py query netto_index --store patent_sbert/patent_sbert_complement_english --patent EP1234567.A1
+    python scripts/ann_index.py benchmark netto_index
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+
+from embedding_store import EmbeddingStore
+
+
+INDEX_META = 'index.json'
+# Number of vectors per block when comparing many vectors with the centroids
+BLOCK_SIZE = 8192
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def store_vectors(store: EmbeddingStore, kinds):
+    '''The vectors of the kinds of a store, each kind normalized on its own so they weigh the same, concatenated and
+    normalized again'''
+    store.check_complete(kinds)
+    return normalize_rows(np.concatenate([normalize_rows(np.asarray(store.vectors(kind), dtype=np.float32)) for kind in kinds], axis=1))
+
+
+def nearest_centroids(vectors, centroids):
+    '''The index of the centroid with the largest inner product with each vector'''
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), BLOCK_SIZE):
+        assignments[start:start+BLOCK_SIZE] = np.argmax(vectors[start:start+BLOCK_SIZE] @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(vectors, n_lists, n_iterations=10, sample_size=None, rng=None):
+    '''Spherical k-means of (a sample of) normalized vectors'''
+    if rng is None:
+        rng = np.random.default_rng(0)
+    if sample_size is None:
+        sample_size = 256*n_lists
+    if len(vectors) > sample_size:
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for iteration in range(n_iterations):
+        assignments = nearest_centroids(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=n_lists)
+        # Empty clusters get a random vector as their new centroid
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+    def __init__(self, centroids, dim):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.dim = dim
+        self.n_vectors = 0
+        # The vectors are kept in a matrix which grows by doubling, so inserting one at a time is cheap
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self.assignments = []
+        self.patent_numbers = []
+        self.years = []
+        self.ipc_classes = []
+        self.lists = [[] for _ in range(len(self.centroids))]
+        # The kinds of vectors of the embedding stores the index was built from
+        self.kinds = None
+        # Arrays of the lists, made when they're needed after an insert, and the mask of the last filters
+        self._list_arrays = dict()
+        self._filter_masks = None
+        self._row_of = dict()
+
+    @classmethod
+    def build(cls, vectors, patent_numbers, years, ipc_classes, n_lists=None, n_iterations=10):
+        '''Train the centroids on the normalized vectors and add them. By default there are 4*sqrt(n) lists.'''
+        vectors = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        if n_lists is None:
+            n_lists = max(1, int(4*math.sqrt(len(vectors))))
+        n_lists = min(n_lists, len(vectors))
+        index = cls(train_centroids(vectors, n_lists, n_iterations=n_iterations), vectors.shape[1])
+        index.add(vectors, patent_numbers, years, ipc_classes)
+        return index
+
+    @classmethod
+    def from_stores(cls, stores, kinds, n_lists=None, n_iterations=10):
+        vectors = np.concatenate([store_vectors(store, kinds) for store in stores])
+        patent_numbers = []
+        years = []
+        ipc_classes = []
+        for store in stores:
+            patent_numbers.extend(store.patent_numbers.tolist())
+            years.extend(store.publication_dates.astype('datetime64[Y]').astype(int) + 1970)
+            ipc_classes.extend(sorted(set(main_class for main_class, sub_class in store.ipc_classes(i))) for i in range(len(store)))
+        index = cls.build(vectors, patent_numbers, years, ipc_classes, n_lists=n_lists, n_iterations=n_iterations)
+        index.kinds = list(kinds)
+        return index
+
+    def __len__(self):
+        return self.n_vectors
+
+    @property
+    def vectors(self):
+        return self._vectors[:self.n_vectors]
+
+    def add(self, vectors, patent_numbers, years, ipc_classes):
+        '''Add vectors with their patent numbers, publication years and IPC main classes to the lists of their
+        closest centroids'''
+        vectors = normalize_rows(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim))
+        n_new = len(vectors)
+        if self.n_vectors + n_new > len(self._vectors):
+            capacity = max(self.n_vectors + n_new, 2*len(self._vectors))
+            grown = np.zeros((capacity, self.dim), dtype=np.float32)
+            grown[:self.n_vectors] = self.vectors
+            self._vectors = grown
+        self._vectors[self.n_vectors:self.n_vectors+n_new] = vectors
+        assignments = nearest_centroids(vectors, self.centroids)
+        for row, list_id in enumerate(assignments.tolist(), start=self.n_vectors):
+            self.lists[list_id].append(row)
+            self._list_arrays.pop(list_id, None)
+        for row, patent_number in enumerate(patent_numbers, start=self.n_vectors):
+            self._row_of[patent_number] = row
+        self.assignments.extend(assignments.tolist())
+        self.patent_numbers.extend(patent_numbers)
+        self.years.extend(int(year) for year in years)
+        self.ipc_classes.extend(list(classes) for classes in ipc_classes)
+        self._filter_masks = None
+        self.n_vectors += n_new
+
+    def vector_of(self, patent_number):
+        return self.vectors[self._row_of[patent_number]]
+
+    def _list_array(self, list_id):
+        if list_id not in self._list_arrays:
+            self._list_arrays[list_id] = np.array(self.lists[list_id], dtype=np.int64)
+        return self._list_arrays[list_id]
+
+    def _filter_mask(self, years=None, ipc_classes=None):
+        '''A boolean mask of the rows published in the years (first, last) and with one of the ipc_classes. The mask
+        of the last filters is kept, since the same filters are usually used for many queries.'''
+        if years is None and ipc_classes is None:
+            return None
+        key = (tuple(years) if years is not None else None, frozenset(ipc_classes) if ipc_classes is not None else None)
+        if self._filter_masks is None or self._filter_masks[0] != key:
+            mask = np.ones(self.n_vectors, dtype=bool)
+            if years is not None:
+                first_year, last_year = years
+                row_years = np.array(self.years, dtype=np.int64)
+                mask &= (row_years >= first_year) & (row_years <= last_year)
+            if ipc_classes is not None:
+                mask &= np.array([any(main_class in ipc_classes for main_class in classes) for classes in self.ipc_classes], dtype=bool)
+            self._filter_masks = (key, mask)
+        return self._filter_masks[1]
+
+    def search(self, query, k=10, nprobe=16, years=None, ipc_classes=None, exclude=()):
+        '''Return the patent numbers and cosine similarities of the (approximately) k closest patents to the query
+        vector. Only patents published in the years (first, last) or with one of the ipc_classes are returned if given.
+        If the filters leave fewer than k patents in the probed lists, more lists are probed.'''
+        query = normalize_rows(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+        centroid_order = np.argsort(-(self.centroids @ query))
+        exclude_rows = [self._row_of[patent_number] for patent_number in exclude if patent_number in self._row_of]
+        mask = self._filter_mask(years=years, ipc_classes=ipc_classes)
+        n_probed = 0
+        candidate_parts = []
+        n_candidates = 0
+        while n_probed < len(centroid_order):
+            probe = centroid_order[n_probed:max(nprobe, 2*n_probed)]
+            n_probed += len(probe)
+            rows = np.concatenate([self._list_array(list_id) for list_id in probe])
+            if mask is not None:
+                rows = rows[mask[rows]]
+            if exclude_rows:
+                rows = rows[~np.isin(rows, exclude_rows)]
+            candidate_parts.append(rows)
+            n_candidates += len(rows)
+            if n_candidates >= k:
+                break
+        candidates = np.concatenate(candidate_parts)
+        similarities = self._vectors[candidates] @ query
+        return self._top_k(candidates, similarities, k)
+
+    def exact_search(self, query, k=10, years=None, ipc_classes=None, exclude=()):
+        '''Like search, but compares the query with all vectors'''
+        query = normalize_rows(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+        similarities = self.vectors @ query
+        mask = self._filter_mask(years=years, ipc_classes=ipc_classes)
+        mask = np.ones(self.n_vectors, dtype=bool) if mask is None else mask.copy()
+        mask[[self._row_of[patent_number] for patent_number in exclude if patent_number in self._row_of]] = False
+        candidates = np.flatnonzero(mask)
+        return self._top_k(candidates, similarities[candidates], k)
+
+    def _top_k(self, candidates, similarities, k):
+        if len(candidates) > k:
+            top = np.argpartition(-similarities, k)[:k]
+            candidates, similarities = candidates[top], similarities[top]
+        order = np.argsort(-similarities, kind='stable')
+        return [self.patent_numbers[row] for row in candidates[order]], similarities[order]
+
+    def save(self, index_dir: Path):
+        '''Save the index to a directory, through a temporary directory like the embedding stores'''
+        index_dir = Path(index_dir)
+        part_dir = index_dir.with_name(index_dir.name + '.part')
+        if part_dir.exists():
+            shutil.rmtree(part_dir)
+        part_dir.mkdir(parents=True)
+        np.save(part_dir / 'centroids.npy', self.centroids)
+        np.save(part_dir / 'vectors.npy', self.vectors)
+        np.save(part_dir / 'assignments.npy', np.array(self.assignments, dtype=np.int64))
+        np.save(part_dir / 'years.npy', np.array(self.years, dtype=np.int64))
+        np.save(part_dir / 'patent_numbers.npy', np.array(self.patent_numbers, dtype=str))
+        ipc_offsets = np.cumsum([0] + [len(classes) for classes in self.ipc_classes])
+        np.save(part_dir / 'ipc_offsets.npy', ipc_offsets)
+        np.save(part_dir / 'ipc_main.npy', np.array([main_class for classes in self.ipc_classes for main_class in classes], dtype=str))
+        with open(part_dir / INDEX_META, 'w') as fp:
+            json.dump({'n_vectors': self.n_vectors, 'dim': self.dim, 'n_lists': len(self.centroids),
+                       'kinds': self.kinds}, fp)
+        if index_dir.exists():
+            shutil.rmtree(index_dir)
+        os.replace(part_dir, index_dir)
+
+    @classmethod
+    def load(cls, index_dir: Path):
+        index_dir = Path(index_dir)
+        with open(index_dir / INDEX_META) as fp:
+            meta = json.load(fp)
+        index = cls(np.load(index_dir / 'centroids.npy'), meta['dim'])
+        index.kinds = meta['kinds']
+        index._vectors = np.load(index_dir / 'vectors.npy')
+        index.n_vectors = meta['n_vectors']
+        index.assignments = np.load(index_dir / 'assignments.npy').tolist()
+        index.years = np.load(index_dir / 'years.npy').tolist()
+        index.patent_numbers = np.load(index_dir / 'patent_numbers.npy').tolist()
+        ipc_offsets = np.load(index_dir / 'ipc_offsets.npy')
+        ipc_main = np.load(index_dir / 'ipc_main.npy').tolist()
+        index.ipc_classes = [ipc_main[ipc_offsets[i]:ipc_offsets[i+1]] for i in range(index.n_vectors)]
+        for row, list_id in enumerate(index.assignments):
+            index.lists[list_id].append(row)
+        index._row_of = {patent_number: row for row, patent_number in enumerate(index.patent_numbers)}
+        return index
+
+
+def recall_benchmark(index: IVFIndex, n_queries=200, k=10, nprobes=(1, 2, 4, 8, 16, 32, 64), years=None, ipc_classes=None, seed=0):
+    '''Query the index with a sample of its own vectors (leaving out the patent itself) and compare with exact search.
+    Returns a list of (nprobe, recall at k, milliseconds per query), with nprobe None for the exact search.'''
+    rng = np.random.default_rng(seed)
+    query_rows = rng.choice(len(index), min(n_queries, len(index)), replace=False)
+    queries = [(index.patent_numbers[row], index.vectors[row]) for row in query_rows]
+    results = []
+    start = time.perf_counter()
+    exact = [set(index.exact_search(vector, k=k, years=years, ipc_classes=ipc_classes, exclude=(patent_number,))[0])
+             for patent_number, vector in queries]
+    results.append((None, 1.0, 1000*(time.perf_counter() - start)/len(queries)))
+    for nprobe in nprobes:
+        if nprobe > len(index.centroids):
+            break
+        n_found = 0
+        start = time.perf_counter()
+        found = [index.search(vector, k=k, nprobe=nprobe, years=years, ipc_classes=ipc_classes, exclude=(patent_number,))[0]
+                 for patent_number, vector in queries]
+        milliseconds = 1000*(time.perf_counter() - start)/len(queries)
+        for neighbours, exact_neighbours in zip(found, exact):
+            n_found += len(exact_neighbours.intersection(neighbours))
+        results.append((nprobe, n_found / max(1, sum(len(exact_neighbours) for exact_neighbours in exact)), milliseconds))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build, query and benchmark approximate nearest neighbour indices of patent embeddings")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help="Build an index from embedding stores")
+    build_parser.add_argument('stores', help="Embedding store directories", nargs='+', type=Path)
+    build_parser.add_argument('--kinds', help="Kinds of vectors to use, e.g. abstract claims", nargs='+', required=True)
+    build_parser.add_argument('--output', help="Directory to save the index to", type=Path, required=True)
+    build_parser.add_argument('--n-lists', help="Number of k-means lists, by default 4*sqrt(number of patents)", type=int)
+
+    query_parser = subparsers.add_parser('query', help="Find the patents of the index closest to a patent")
+    query_parser.add_argument('index', type=Path)
+    query_parser.add_argument('--patent', help="Patent number of the query patent", required=True)
+    query_parser.add_argument('--store', help="Embedding store with the query patent, if it's not in the index", type=Path)
+    query_parser.add_argument('--k', help="Number of neighbours", type=int, default=10)
+    query_parser.add_argument('--nprobe', help="Number of lists to search", type=int, default=16)
+    query_parser.add_argument('--years', help="First and last publication year of the neighbours", nargs=2, type=int)
+    query_parser.add_argument('--ipc', help="IPC main classes of the neighbours (any of them)", nargs='+')
+
+    benchmark_parser = subparsers.add_parser('benchmark', help="Compare the recall and speed of the index with exact search")
+    benchmark_parser.add_argument('index', type=Path)
+    benchmark_parser.add_argument('--k', type=int, default=10)
+    benchmark_parser.add_argument('--n-queries', type=int, default=200)
+    benchmark_parser.add_argument('--years', nargs=2, type=int)
+    benchmark_parser.add_argument('--ipc', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        stores = [EmbeddingStore(store_dir) for store_dir in args.stores]
+        start = time.perf_counter()
+        index = IVFIndex.from_stores(stores, args.kinds, n_lists=args.n_lists)
+        index.save(args.output)
+        print(f"Indexed {len(index)} patents in {len(index.centroids)} lists in {time.perf_counter() - start:.1f}s, saved to {args.output}")
+    elif args.command == 'query':
+        index = IVFIndex.load(args.index)
+        if args.store is not None:
+            store = EmbeddingStore(args.store)
+            i = store.index_of(args.patent)
+            query = np.concatenate([normalize_rows(np.asarray(store.vectors(kind)[i:i+1], dtype=np.float32)) for kind in index.kinds], axis=1)[0]
+        else:
+            query = index.vector_of(args.patent)
+        start = time.perf_counter()
+        patent_numbers, similarities = index.search(query, k=args.k, nprobe=args.nprobe, years=args.years,
+                                                    ipc_classes=set(args.ipc) if args.ipc else None, exclude=(args.patent,))
+        milliseconds = 1000*(time.perf_counter() - start)
+        for patent_number, similarity in zip(patent_numbers, similarities):
+            print(f"{patent_number}\t{similarity:.4f}")
+        print(f"Found {len(patent_numbers)} neighbours in {milliseconds:.1f} ms")
+    elif args.command == 'benchmark':
+        index = IVFIndex.load(args.index)
+        results = recall_benchmark(index, n_queries=args.n_queries, k=args.k, years=args.years, ipc_classes=set(args.ipc) if args.ipc else None)
+        print(f"{'nprobe':>8} {'recall@' + str(args.k):>10} {'ms/query':>10}")
+        for nprobe, recall, milliseconds in results:
+            print(f"{'exact' if nprobe is None else nprobe:>8} {recall:>10.3f} {milliseconds:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+"""Encode the texts and drawings of packaged patents with CLIP, like clip_representations.ipynb but batched.
+
+The texts are tokenized once and cut into windows of the 77 tokens the CLIP text encoder takes, and the windows of
+many patents are encoded in the same batches. The drawings of all patents of a shard are decoded and preprocessed by
+DataLoader worker processes and encoded in fixed size batches, regardless of which patent they belong to. The window
+and image embeddings are then summed per section and patent. The output has the same shards as sbert_encode_patents.py,
+and ends up in two embedding stores per zip: 'clip_{zip name}' with the text vectors of all patents, and
+'clip_images_{zip name}' with the text and image vectors of the patents which have drawings.
+"""
+import argparse
+import io
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from PIL import Image
+from tqdm import tqdm
+import clip
+from clip.simple_tokenizer import SimpleTokenizer
+
+from embedding_store import write_embedding_store
+from encoding_shards import plan_shard_jobs, write_shard, load_shards
+from image_store import ImageStore, is_drawing
+from packaged_patents import PackagedPatents
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+MODEL_NAME = 'ViT-B/32'
+TEXT_SECTIONS = ('abstract', 'description', 'claims')
+POOLING_METHODS = ('sum', 'mean')
+# The CLIP text encoder has a fixed number of positions, the windows are always padded to it
+CONTEXT_LENGTH = 77
+# The normalization of the CLIP preprocessing, used for the images of an image store
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def clip_text_windows(tokens, sot_token, eot_token, stride=None):
+    '''Cut the BPE tokens of a text into windows of CONTEXT_LENGTH tokens, each starting with the start of text token
+    and ending with the end of text token, padded with zeros. An empty text gives a single window with only the start
+    and end tokens. Returns a (n_windows, CONTEXT_LENGTH) int64 array.'''
+    content_length = CONTEXT_LENGTH - 2
+    if stride is None:
+        stride = content_length
+    starts = range(0, max(1, len(tokens) - content_length + stride), stride)
+    windows = np.zeros((len(starts), CONTEXT_LENGTH), dtype=np.int64)
+    for i, start in enumerate(starts):
+        content = tokens[start:start+content_length]
+        windows[i, 0] = sot_token
+        windows[i, 1:len(content)+1] = content
+        windows[i, len(content)+1] = eot_token
+    return windows
+
+
+class TextChunkDataset(Dataset):
+    '''The tokenized sections of chunks of patents, one chunk per item. Used with a DataLoader without batching, so the
+    chunks are read and tokenized by the DataLoader workers while the model encodes earlier chunks.'''
+    def __init__(self, packaged, chunks, stride=None):
+        self.packaged = packaged
+        self.chunks = chunks
+        self.stride = stride
+        self._packaged_patents = None
+        self._tokenizer = None
+
+    def __getstate__(self):
+        # Each worker opens the zip itself
+        return dict(self.__dict__, _packaged_patents=None, _tokenizer=None)
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __getitem__(self, i):
+        if self._packaged_patents is None:
+            self._packaged_patents = PackagedPatents(self.packaged)
+            self._tokenizer = SimpleTokenizer()
+        sot_token = self._tokenizer.encoder['<|startoftext|>']
+        eot_token = self._tokenizer.encoder['<|endoftext|>']
+        patent_metadata = []
+        windows_per_text = []
+        for record in self._packaged_patents.records(fields=('applicants', 'publication_date', 'ipc_classes') + TEXT_SECTIONS, patent_numbers=self.chunks[i]):
+            patent_metadata.append(dict(patent_number=record['patent_number'],
+                                        applicants=','.join(record['applicants']),
+                                        publication_date=record['publication_date'],
+                                        ipc_classes=record['ipc_classes']))
+            for section in TEXT_SECTIONS:
+                tokens = self._tokenizer.encode(record[section]['en'])
+                windows_per_text.append(clip_text_windows(tokens, sot_token, eot_token, stride=self.stride))
+        return patent_metadata, windows_per_text
+
+
+class PackagedImageDataset(Dataset):
+    '''The drawings of patents in a packaged zip, decoded and preprocessed for CLIP. Items are (image, valid) where
+    valid is False for images which couldn't be decoded.'''
+    def __init__(self, packaged, image_refs, preprocess, image_size):
+        self.packaged = packaged
+        self.image_refs = image_refs
+        self.preprocess = preprocess
+        self.image_size = image_size
+        self._packaged_patents = None
+
+    def __getstate__(self):
+        return dict(self.__dict__, _packaged_patents=None)
+
+    def __len__(self):
+        return len(self.image_refs)
+
+    def __getitem__(self, i):
+        if self._packaged_patents is None:
+            self._packaged_patents = PackagedPatents(self.packaged)
+        patent_number, image_name = self.image_refs[i]
+        try:
+            image = Image.open(io.BytesIO(self._packaged_patents.image(patent_number, image_name)))
+            return self.preprocess(image), True
+        except (OSError, ValueError):
+            return torch.zeros((3, self.image_size, self.image_size)), False
+
+
+class StoredImageDataset(Dataset):
+    '''The drawings of patents from an image store, which are already scaled and cropped like the CLIP preprocessing,
+    so they only have to be normalized'''
+    def __init__(self, store_dir: Path, indices):
+        self.store_dir = store_dir
+        self.indices = indices
+        self.mean = torch.tensor(CLIP_MEAN).view(3, 1, 1)
+        self.std = torch.tensor(CLIP_STD).view(3, 1, 1)
+        self._image_store = None
+
+    def __getstate__(self):
+        # Pickling the memory mapped images would copy them, so each worker opens the store itself
+        return dict(self.__dict__, _image_store=None)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if self._image_store is None:
+            self._image_store = ImageStore(self.store_dir)
+        index = self.indices[i]
+        image = torch.from_numpy(np.array(self._image_store.images[index], dtype=np.float32) / 255)
+        image = image.unsqueeze(0).expand(3, -1, -1)
+        return (image - self.mean) / self.std, bool(self._image_store.decoded[index])
+
+
+def collate_images(items):
+    images, valid = zip(*items)
+    return torch.stack(images), torch.tensor(valid, dtype=torch.bool)
+
+
+def identity(item):
+    return item
+
+
+def pool_embeddings(embeddings, owners, n_owners, pooling='sum'):
+    '''Sum (or average) the rows of embeddings with the same owner'''
+    pooled = torch.zeros((n_owners, embeddings.shape[1]))
+    pooled.index_add_(0, owners, embeddings)
+    if pooling == 'mean':
+        counts = torch.bincount(owners, minlength=n_owners).clamp(min=1)
+        pooled = pooled / counts.unsqueeze(1)
+    return pooled
+
+
+def encode_text_windows(windows_per_text, model, device=device, batch_size=256, pooling='sum'):
+    '''Encode texts, given as arrays of token windows, into one vector each. The windows of all the texts are encoded
+    together in batches of batch_size windows.'''
+    windows = torch.from_numpy(np.concatenate(windows_per_text))
+    owners = torch.tensor(np.repeat(np.arange(len(windows_per_text)), [len(text_windows_) for text_windows_ in windows_per_text]))
+    embeddings = []
+    with torch.no_grad():
+        for start in range(0, len(windows), batch_size):
+            batch = windows[start:start+batch_size].to(device=device)
+            embeddings.append(model.encode_text(batch).float().cpu())
+    return pool_embeddings(torch.cat(embeddings), owners, len(windows_per_text), pooling=pooling).numpy()
+
+
+def encode_images(image_loader, owners, n_owners, model, device=device, pooling='sum'):
+    '''Encode the batches of an image loader and pool the embeddings per owner. Returns the pooled vectors and the
+    number of valid images of each owner.'''
+    embeddings = []
+    valid = []
+    with torch.no_grad():
+        for images, images_valid in tqdm(image_loader, desc='Encoding images', leave=False):
+            embeddings.append(model.encode_image(images.to(device=device)).float().cpu())
+            valid.append(images_valid)
+    if not embeddings:
+        return np.zeros((n_owners, 0), dtype=np.float32), np.zeros(n_owners, dtype=np.int64)
+    embeddings = torch.cat(embeddings)
+    valid = torch.cat(valid)
+    owners = owners[valid]
+    pooled = pool_embeddings(embeddings[valid], owners, n_owners, pooling=pooling)
+    return pooled.numpy(), torch.bincount(owners, minlength=n_owners).numpy()
+
+
+def encode_shard_patents(packaged, shard_patents, model, preprocess, device=device, image_store=None, text_batch_size=256,
+                         image_batch_size=64, chunk_size=64, stride=None, pooling='sum', loader_workers=4, prefetch=2):
+    '''Encode the texts and drawings of the given patents of a packaged zip. Returns the patent dicts, where the
+    patents with drawings have an 'image_vector' as well.'''
+    loader_kwargs = dict(num_workers=loader_workers)
+    if loader_workers > 0:
+        loader_kwargs['prefetch_factor'] = prefetch
+
+    chunks = [shard_patents[i:i+chunk_size] for i in range(0, len(shard_patents), chunk_size)]
+    text_loader = DataLoader(TextChunkDataset(packaged, chunks, stride=stride), batch_size=None, collate_fn=identity, **loader_kwargs)
+    patent_reprs = []
+    for patent_metadata, windows_per_text in tqdm(text_loader, desc='Encoding texts', leave=False):
+        encoded_texts = encode_text_windows(windows_per_text, model, device=device, batch_size=text_batch_size, pooling=pooling)
+        for i, metadata in enumerate(patent_metadata):
+            patent_vectors = encoded_texts[i*len(TEXT_SECTIONS):(i+1)*len(TEXT_SECTIONS)]
+            vectors = {f'{section}_vector': vector for section, vector in zip(TEXT_SECTIONS, patent_vectors)}
+            patent_reprs.append(dict(metadata, vectors=vectors))
+
+    patent_rows = {patent_number: i for i, patent_number in enumerate(shard_patents)}
+    if image_store is not None:
+        indices = []
+        owners = []
+        for patent_number in shard_patents:
+            begin, end = image_store.image_range(patent_number)
+            indices.extend(range(begin, end))
+            owners.extend([patent_rows[patent_number]]*(end - begin))
+        image_dataset = StoredImageDataset(image_store.store_dir, indices)
+    else:
+        image_refs = []
+        owners = []
+        with PackagedPatents(packaged) as packaged_patents:
+            for patent_number in shard_patents:
+                for image_name in packaged_patents.image_names(patent_number):
+                    if is_drawing(image_name):
+                        image_refs.append((patent_number, image_name))
+                        owners.append(patent_rows[patent_number])
+        image_dataset = PackagedImageDataset(packaged, image_refs, preprocess, model.visual.input_resolution)
+    image_loader = DataLoader(image_dataset, batch_size=image_batch_size, collate_fn=collate_images, **loader_kwargs)
+    image_vectors, n_images = encode_images(image_loader, torch.tensor(owners, dtype=torch.long), len(shard_patents), model,
+                                           device=device, pooling=pooling)
+    for i, patent_repr in enumerate(patent_reprs):
+        if n_images[i] > 0:
+            patent_repr['vectors']['image_vector'] = image_vectors[i]
+    return patent_reprs
+
+
+def load_model(model_name=MODEL_NAME, device=device):
+    model, preprocess = clip.load(model_name, device=device)
+    model.eval()
+    return model, preprocess
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode the texts and drawings of packaged patents with CLIP")
+    parser.add_argument('packaged', help="Packaged patent zips to encode", nargs='+', type=Path)
+    parser.add_argument('--output-dir', help="Directory to write the encodings to", type=Path, default=Path())
+    parser.add_argument('--model-name', help="CLIP model to use", default=MODEL_NAME)
+    parser.add_argument('--device', help="Device to run the model on", default=device)
+    parser.add_argument('--image-stores', help="Directory with image stores of the zips made by image_store.py, named "
+                        "'{zip name}_images'. The drawings of zips with a store are not decoded again", type=Path)
+    parser.add_argument('--text-batch-size', help="Number of text windows per batch", type=int, default=256)
+    parser.add_argument('--image-batch-size', help="Number of images per batch", type=int, default=64)
+    parser.add_argument('--stride', help="Number of tokens between the starts of the windows of a text. "
+                        f"By default the windows don't overlap ({CONTEXT_LENGTH - 2} tokens)", type=int, default=None)
+    parser.add_argument('--pooling', help="How to pool the window and image embeddings of a patent", choices=POOLING_METHODS, default='sum')
+    parser.add_argument('--chunk-size', help="Number of patents whose text windows are batched together", type=int, default=64)
+    parser.add_argument('--shard-size', help="Number of patents per shard, see sbert_encode_patents.py", type=int, default=1000)
+    parser.add_argument('--loader-workers', help="Number of DataLoader processes reading, tokenizing and decoding ahead of the model",
+                        type=int, default=4)
+    parser.add_argument('--prefetch', help="Number of batches each DataLoader process prepares ahead", type=int, default=2)
+    parser.add_argument('--threads', help="Number of torch threads of the model", type=int, default=None)
+    parser.add_argument('--dtype', help="Data type of the vectors in the embedding stores", choices=('float32', 'float16'), default='float32')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    # The shards are only reused by runs with the same settings
+    shard_settings = dict(model_name=args.model_name, stride=args.stride, pooling=args.pooling)
+    shard_jobs, zip_shards = plan_shard_jobs(args.packaged, args.output_dir, args.shard_size, 'clip', shard_settings)
+
+    model, preprocess = load_model(args.model_name, args.device)
+    image_stores = dict()
+    if args.image_stores is not None:
+        for packaged in args.packaged:
+            store_dir = args.image_stores / f'{packaged.with_suffix("").name}_images'
+            if store_dir.exists():
+                image_store = ImageStore(store_dir)
+                if image_store.fit != 'crop' or image_store.size != model.visual.input_resolution:
+                    raise ValueError(f"The images of {store_dir} are not cropped to {model.visual.input_resolution}x{model.visual.input_resolution} like the CLIP preprocessing")
+                image_stores[packaged] = image_store
+
+    for packaged, output_path, shard_patents in tqdm(shard_jobs, desc="Encoding shards"):
+        patent_reprs = encode_shard_patents(packaged, shard_patents, model, preprocess, device=args.device,
+                                            image_store=image_stores.get(packaged),
+                                            text_batch_size=args.text_batch_size, image_batch_size=args.image_batch_size,
+                                            chunk_size=args.chunk_size, stride=args.stride, pooling=args.pooling,
+                                            loader_workers=args.loader_workers, prefetch=args.prefetch)
+        write_shard(output_path, patent_reprs)
+
+    for packaged, shard_paths in zip_shards.items():
+        basename = packaged.with_suffix('').name
+        patent_reprs = load_shards(shard_paths)
+        text_reprs = [dict(patent_repr, vectors={name: vector for name, vector in patent_repr['vectors'].items() if name != 'image_vector'})
+                      for patent_repr in patent_reprs]
+        image_reprs = [patent_repr for patent_repr in patent_reprs if 'image_vector' in patent_repr['vectors']]
+        write_embedding_store(args.output_dir / f'clip_{basename}', text_reprs, dtype=args.dtype)
+        write_embedding_store(args.output_dir / f'clip_images_{basename}', image_reprs, dtype=args.dtype)
+        print(f"{basename}: {len(text_reprs)} patents, {len(image_reprs)} with drawings")
+
+
+if __name__ == '__main__':
+    # The DataLoader workers import this module on platforms which spawn processes
+    main()
@@ -6,9 +6,7 @@ import datetime
 from requests.models import HTTPError
 
 from tqdm import tqdm, trange
-from zipfile import ZipFile
 from pathlib import Path
-import xml.etree.ElementTree as ET
 from collections import Counter, defaultdict
 
 import datetime
@@ -20,56 +18,12 @@ import json
 from collections import defaultdict,  Counter
 import datetime
 import random
-from zipfile import ZipFile
 from pathlib import Path
-import xml.etree.ElementTree as ET
 from collections import Counter
 
+from patent_index import load_index
 
 
-def load_patent_xml(patent_path):
-    with ZipFile(patent_path) as patent_zip:
-        filenames = [zipinfo.filename for zipinfo in patent_zip.infolist()]
-        # We're just assuming the only XML apart from TOC.xml is the one we're looking for
-        # Since the name of this document is based on the application number, not the 
-        # publication number, we have to scan for it manually
-        doc_xml = None
-        for filename in filenames:
-            *base, ext = filename.split('.')
-            if ext == 'xml' and filename.lower() != 'toc.xml':
-                doc_xml = filename
-        if doc_xml is None:
-            raise ValueError(f"Unable to find document xml for zipfile {patent_path}")
-        
-        with patent_zip.open(doc_xml) as patent_xml_fp:
-            xml_str = str(patent_xml_fp.read(), encoding='utf8')
-            root = ET.fromstring(xml_str)
-            return root
-
-
-def extract_patent_info(patent_path):
-    patent_info = dict()
-    root = load_patent_xml(patent_path)
-    # The root element is the 'ep-patent-document', which has an attribute called date-publ, the publication date
-    publication_date_str = root.attrib['date-publ']
-    publication_date = datetime.datetime.strptime(publication_date_str, '%Y%m%d')
-    patent_info['publication_date'] = publication_date
-
-    doc_country = root.attrib['country']
-    doc_number = root.attrib['doc-number']
-    doc_kind = root.attrib['kind']
-    patent_info['document_number'] = f'{doc_country}{doc_number}.{doc_kind}'
-
-    ipcr_classes = root.findall('.//SDOBI//classification-ipcr/text')
-    text_classes = [e.text for e in ipcr_classes]
-    # The class string has the form 'A61K  38/44        20060101AFI20130522BHEP        '
-    # We first split by white space and only select the first two parts
-    split_classes = [text.split() for text in text_classes]
-    selected_parts = [(main_class, sub_class) for main_class, sub_class, *_ in split_classes]
-    patent_info['ipc_classes'] = selected_parts
-
-    return patent_info
-
 def load_search_results(search_result_path):
     m = re.match(r'([\w\d]+)_(\d+)-(\d+)\.txt', search_result_path.name)
     if m is not None:
@@ -92,6 +46,10 @@ def main():
     parser.add_argument('--output-directory', help="Directory to output files to", type=Path, default=Path())
     parser.add_argument('--sample-ratio', help="How many complement patents to sample relative to the netto list", type=float, default=1)
     parser.add_argument('--random-seed', help="Constant to seed the random number generator with for repreducability", type=int, default=None)
+    parser.add_argument('--netto-patents-dir', help="Directory of downloaded netto list patents. The document numbers "
+                        "read from the persistent index of this directory are also excluded from the complement", type=Path, default=None)
+    parser.add_argument('--index-path', help="Where the index of the netto patents is stored, by default 'patent_index.sqlite' "
+                        "in the netto patents directory", type=Path, default=None)
     args = parser.parse_args()
 
     output_dir = args.output_directory
@@ -102,6 +60,10 @@ def main():
         desired_samples = json.load(fp)
     with open(args.netto_list) as fp:
         netto_list_patents = set(line.strip() for line in fp)
+    if args.netto_patents_dir is not None:
+        # This makes sure the complement is disjoint from the documents we actually downloaded
+        index_entries = load_index(args.netto_patents_dir, args.index_path)
+        netto_list_patents.update(entry['document_number'] for entry in index_entries if entry['document_number'] is not None)
     search_results_files = list(args.class_patents.glob('*.txt'))
 
     # downloaded_patents = set()
@@ -0,0 +1,63 @@
+"""A manifest of the patent zip-files downloaded to a directory, with the size, checksum and validation result of each file.
+The manifest is a JSON-lines file which is appended to as files are downloaded, the last entry for a file is the valid one."""
+import datetime
+import hashlib
+import json
+import threading
+from pathlib import Path
+
+
+MANIFEST_NAME = 'download_manifest.jsonl'
+
+
+def file_sha256(path, chunk_size=2**20):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class DownloadManifest:
+    def __init__(self, manifest_path: Path):
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+        self.entries = dict()
+        if manifest_path.exists():
+            with open(manifest_path) as fp:
+                for line in fp:
+                    line = line.strip()
+                    if line:
+                        entry = json.loads(line)
+                        self.entries[entry['file']] = entry
+
+    @classmethod
+    def in_directory(cls, directory: Path):
+        return cls(directory / MANIFEST_NAME)
+
+    def record(self, file_name, document, size, sha256, error=None):
+        entry = dict(file=file_name, document=document, size=size, sha256=sha256,
+                     status='ok' if error is None else 'broken', error=error,
+                     checked=datetime.datetime.now().isoformat(timespec='seconds'))
+        with self.lock:
+            self.entries[file_name] = entry
+            with open(self.manifest_path, 'a') as fp:
+                fp.write(json.dumps(entry, sort_keys=True) + '\n')
+        return entry
+
+    def get(self, file_name):
+        return self.entries.get(file_name)
+
+    def verify(self, patent_path: Path, check_hash=False):
+        '''Check a file against its manifest entry. Returns None if the file matches a valid entry,
+        otherwise the reason it doesn't.'''
+        entry = self.get(patent_path.name)
+        if entry is None:
+            return "Not in manifest"
+        if entry['status'] != 'ok':
+            return entry['error']
+        if patent_path.stat().st_size != entry['size']:
+            return f"Size {patent_path.stat().st_size} differs from the manifest size {entry['size']}"
+        if check_hash and file_sha256(patent_path) != entry['sha256']:
+            return "Checksum differs from the manifest"
+        return None
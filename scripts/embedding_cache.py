@@ -0,0 +1,115 @@
+"""A cache of text embeddings, keyed by a hash of the encoding settings and the text.
+
+The same patent is often in several packaged zips (e.g. both in a netto list and a random sample), and zips are
+sometimes packaged again. Since the key only depends on the text and how it's encoded, the cached embedding is used
+whichever zip the text comes from. The cache is an SQLite file which is kept below a maximum size by evicting the
+least recently used embeddings."""
+import hashlib
+import json
+import sqlite3
+import time
+from collections import Counter
+
+import numpy as np
+
+
+CACHE_SCHEMA = '''CREATE TABLE IF NOT EXISTS embeddings (
+    key TEXT PRIMARY KEY,
+    vector BLOB NOT NULL,
+    last_used REAL NOT NULL
+)'''
+# SQLite has a limit on the number of parameters of a query
+MAX_QUERY_KEYS = 500
+
+
+def cache_key(settings, text):
+    '''The key of a text encoded with the settings (a dict with e.g. the model name and window length)'''
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps(settings, sort_keys=True).encode('utf8'))
+    hasher.update(b'\0')
+    hasher.update(text.encode('utf8'))
+    return hasher.hexdigest()
+
+
+def key_batches(keys):
+    keys = list(keys)
+    for i in range(0, len(keys), MAX_QUERY_KEYS):
+        yield keys[i:i+MAX_QUERY_KEYS]
+
+
+class EmbeddingCache:
+    def __init__(self, cache_path, max_bytes=4*10**9, read_only=False):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.stats = Counter()
+        if read_only:
+            self.connection = sqlite3.connect(f'file:{cache_path}?mode=ro', uri=True, timeout=60)
+        else:
+            # Several processes can write to the cache at the same time, so we wait for the lock instead of failing
+            self.connection = sqlite3.connect(str(cache_path), timeout=60)
+            with self.connection:
+                self.connection.execute(CACHE_SCHEMA)
+
+    def contains(self, keys):
+        '''Return the set of the keys which are in the cache'''
+        found = set()
+        for batch in key_batches(keys):
+            query = f'SELECT key FROM embeddings WHERE key IN ({",".join("?"*len(batch))})'
+            found.update(key for key, in self.connection.execute(query, batch))
+        return found
+
+    def get(self, keys):
+        '''Return a dict from the keys in the cache to their vectors, and mark them as used'''
+        keys = list(keys)
+        vectors = dict()
+        for batch in key_batches(keys):
+            query = f'SELECT key, vector FROM embeddings WHERE key IN ({",".join("?"*len(batch))})'
+            for key, vector in self.connection.execute(query, batch):
+                vectors[key] = np.frombuffer(vector, dtype=np.float32)
+        now = time.time()
+        with self.connection:
+            self.connection.executemany('UPDATE embeddings SET last_used = ? WHERE key = ?', ((now, key) for key in vectors))
+        self.stats['hits'] += sum(1 for key in keys if key in vectors)
+        return vectors
+
+    def put(self, vectors):
+        '''Add a dict from keys to vectors to the cache'''
+        now = time.time()
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)',
+                                        ((key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in vectors.items()))
+        self.stats['misses'] += len(vectors)
+
+    def size(self):
+        total, = self.connection.execute('SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings').fetchone()
+        return total
+
+    def evict(self):
+        '''Remove the least recently used embeddings until the cache is below its maximum size'''
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return 0
+        n_evicted = 0
+        with self.connection:
+            rows = self.connection.execute('SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used').fetchall()
+            evicted_keys = []
+            for key, n_bytes in rows:
+                if excess <= 0:
+                    break
+                evicted_keys.append(key)
+                excess -= n_bytes
+            for batch in key_batches(evicted_keys):
+                self.connection.execute(f'DELETE FROM embeddings WHERE key IN ({",".join("?"*len(batch))})', batch)
+            n_evicted = len(evicted_keys)
+        self.connection.execute('VACUUM')
+        return n_evicted
+
+    def close(self):
+        self.connection.close()
+
+
+def cache_summary(stats):
+    n_texts = stats['hits'] + stats['misses']
+    if n_texts == 0:
+        return 'no texts encoded'
+    return f"{stats['hits']} of {n_texts} texts found in the cache ({100*stats['hits']/n_texts:.1f}%)"
@@ -0,0 +1,210 @@
+"""A columnar store of patent embeddings, replacing the pickled lists of patent dicts.
+
+A store is a directory with one .npy matrix per kind of vector (e.g. 'abstract', 'description', 'claims' or 'image'),
+the patent numbers in the same order and the metadata in separate columns. The matrices are opened with np.load in
+mmap mode, so loading them doesn't copy or unpickle anything. The patents are sorted by patent number, so a patent is
+found by bisection.
+
+    store/
+        store.json              number of patents and the kinds, dimensions and dtypes of the vectors
+        patent_numbers.npy      fixed width strings
+        {kind}_vectors.npy      float32 or float16, one row per patent
+        {kind}_present.npy      only for kinds some patents don't have (e.g. images), whether each patent has the
+                                vector, the rows of the others are zeros
+        publication_dates.npy   datetime64[D]
+        ipc_offsets.npy         the ipc classes of patent i are at ipc_offsets[i]:ipc_offsets[i+1] of
+        ipc_main.npy            ipc_main and
+        ipc_sub.npy             ipc_sub
+        applicants.json         the applicants of each patent
+"""
+import argparse
+import datetime
+import json
+import os
+import pickle
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+
+STORE_META = 'store.json'
+
+
+def vector_kind(vector_name):
+    '''The encoding scripts name the vectors like 'abstract_vector' '''
+    return vector_name[:-len('_vector')] if vector_name.endswith('_vector') else vector_name
+
+
+def parse_publication_date(publication_date):
+    if isinstance(publication_date, (datetime.date, datetime.datetime)):
+        return np.datetime64(publication_date.strftime('%Y-%m-%d'), 'D')
+    return np.datetime64(datetime.datetime.strptime(str(publication_date), '%Y%m%d').date(), 'D')
+
+
+def write_embedding_store(store_dir: Path, patent_reprs, dtype='float32'):
+    '''Write patent representations as made by the encoding scripts (dicts with patent_number, vectors, applicants,
+    publication_date and ipc_classes) to a store. The store is written to a temporary directory which is renamed when
+    it's complete, replacing any earlier store.'''
+    patent_reprs = sorted(patent_reprs, key=lambda patent_repr: patent_repr['patent_number'])
+    n_patents = len(patent_reprs)
+    # Not every patent has every kind of vector, e.g. only the patents with drawings have image vectors, so the kinds
+    # are collected from all of them, keeping the name each kind has in the vector dicts
+    kinds = dict()
+    vector_names = dict()
+    for patent_repr in patent_reprs:
+        for vector_name, vector in patent_repr['vectors'].items():
+            kind = vector_kind(vector_name)
+            if kind not in kinds:
+                kinds[kind] = {'dim': int(np.shape(vector)[-1]), 'dtype': np.dtype(dtype).name, 'n_present': 0}
+                vector_names[kind] = vector_name
+            elif vector_names[kind] != vector_name:
+                raise ValueError(f"Patent {patent_repr['patent_number']} has {kind} vectors named {vector_name}, "
+                                 f"but other patents have them named {vector_names[kind]}")
+            kinds[kind]['n_present'] += 1
+
+    part_dir = store_dir.with_name(store_dir.name + '.part')
+    if part_dir.exists():
+        shutil.rmtree(part_dir)
+    part_dir.mkdir(parents=True)
+
+    patent_numbers = np.array([patent_repr['patent_number'] for patent_repr in patent_reprs], dtype=str)
+    np.save(part_dir / 'patent_numbers.npy', patent_numbers)
+    for kind, kind_info in kinds.items():
+        vectors = np.lib.format.open_memmap(part_dir / f'{kind}_vectors.npy', mode='w+', dtype=dtype, shape=(n_patents, kind_info['dim']))
+        present = np.zeros(n_patents, dtype=bool)
+        for i, patent_repr in enumerate(patent_reprs):
+            vector = patent_repr['vectors'].get(vector_names[kind])
+            if vector is not None:
+                vectors[i] = vector
+                present[i] = True
+            else:
+                vectors[i] = 0
+        vectors.flush()
+        del vectors
+        if kind_info['n_present'] < n_patents:
+            np.save(part_dir / f'{kind}_present.npy', present)
+
+    publication_dates = np.array([parse_publication_date(patent_repr['publication_date']) for patent_repr in patent_reprs], dtype='datetime64[D]')
+    np.save(part_dir / 'publication_dates.npy', publication_dates)
+    ipc_offsets = np.zeros(n_patents + 1, dtype=np.int64)
+    ipc_main = []
+    ipc_sub = []
+    for i, patent_repr in enumerate(patent_reprs):
+        for main_class, sub_class in patent_repr['ipc_classes']:
+            ipc_main.append(main_class)
+            ipc_sub.append(sub_class)
+        ipc_offsets[i+1] = len(ipc_main)
+    np.save(part_dir / 'ipc_offsets.npy', ipc_offsets)
+    np.save(part_dir / 'ipc_main.npy', np.array(ipc_main, dtype=str))
+    np.save(part_dir / 'ipc_sub.npy', np.array(ipc_sub, dtype=str))
+    with open(part_dir / 'applicants.json', 'w') as fp:
+        json.dump([patent_repr['applicants'] for patent_repr in patent_reprs], fp)
+    with open(part_dir / STORE_META, 'w') as fp:
+        json.dump({'n_patents': n_patents, 'kinds': kinds}, fp)
+
+    if store_dir.exists():
+        shutil.rmtree(store_dir)
+    os.replace(part_dir, store_dir)
+
+
+class EmbeddingStore:
+    def __init__(self, store_dir: Path):
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir / STORE_META) as fp:
+            meta = json.load(fp)
+        self.n_patents = meta['n_patents']
+        self.kinds = meta['kinds']
+        self._columns = dict()
+        self._applicants = None
+
+    def _column(self, name):
+        if name not in self._columns:
+            self._columns[name] = np.load(self.store_dir / f'{name}.npy', mmap_mode='r')
+        return self._columns[name]
+
+    def __len__(self):
+        return self.n_patents
+
+    @property
+    def patent_numbers(self):
+        return self._column('patent_numbers')
+
+    @property
+    def publication_dates(self):
+        return self._column('publication_dates')
+
+    @property
+    def applicants(self):
+        if self._applicants is None:
+            with open(self.store_dir / 'applicants.json') as fp:
+                self._applicants = json.load(fp)
+        return self._applicants
+
+    def vectors(self, kind):
+        '''The memory mapped matrix of the vectors of a kind, one row per patent'''
+        if kind not in self.kinds:
+            raise KeyError(f"No {kind} vectors in the store, it has {list(self.kinds)}")
+        return self._column(f'{kind}_vectors')
+
+    def has_vectors(self, kind):
+        '''Whether each patent has a vector of the kind. The rows of the patents which don't are zeros.'''
+        if kind not in self.kinds:
+            raise KeyError(f"No {kind} vectors in the store, it has {list(self.kinds)}")
+        # Stores written before the presence masks only have kinds all the patents have
+        if self.kinds[kind].get('n_present', self.n_patents) == self.n_patents:
+            return np.ones(self.n_patents, dtype=bool)
+        return self._column(f'{kind}_present')
+
+    def ipc_classes(self, i):
+        ipc_offsets = self._column('ipc_offsets')
+        begin, end = ipc_offsets[i], ipc_offsets[i+1]
+        return list(zip(self._column('ipc_main')[begin:end].tolist(), self._column('ipc_sub')[begin:end].tolist()))
+
+    def index_of(self, patent_number):
+        patent_numbers = self.patent_numbers
+        i = int(np.searchsorted(patent_numbers, patent_number))
+        if i == len(patent_numbers) or patent_numbers[i] != patent_number:
+            raise KeyError(patent_number)
+        return i
+
+    def check_complete(self, kinds):
+        '''Raise a ValueError if some patents don't have vectors of all the kinds'''
+        for kind in kinds:
+            n_present = self.kinds.get(kind, {}).get('n_present', self.n_patents)
+            if n_present < self.n_patents:
+                raise ValueError(f"Only {n_present} of the {self.n_patents} patents in {self.store_dir} have {kind} vectors, "
+                                 f"select them with has_vectors('{kind}')")
+
+    def matrix(self, kinds):
+        '''The vectors of the kinds concatenated per patent. This makes a copy, unlike vectors(). All the patents
+        must have all the kinds, otherwise select the patents with has_vectors() first.'''
+        self.check_complete(kinds)
+        return np.concatenate([self.vectors(kind) for kind in kinds], axis=1)
+
+
+def labelled_matrix(stores, kinds):
+    '''Build X, y from several stores, given as a dict from labels to stores'''
+    X = np.concatenate([store.matrix(kinds) for store in stores.values()], axis=0)
+    y = np.concatenate([np.full(len(store), label) for label, store in stores.items()])
+    return X, y
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert pickled lists of patent encodings to embedding stores")
+    parser.add_argument('pickles', help="Pickle files with the lists of patent dicts", nargs='+', type=Path)
+    parser.add_argument('--output-dir', help="Directory to write the stores to, each store is named like its pickle",
+                        type=Path, default=Path())
+    parser.add_argument('--dtype', help="Data type of the stored vectors", choices=('float32', 'float16'), default='float32')
+    args = parser.parse_args()
+
+    for pickle_path in args.pickles:
+        with open(pickle_path, 'rb') as fp:
+            patent_reprs = pickle.load(fp)
+        store_dir = args.output_dir / pickle_path.with_suffix('').name
+        write_embedding_store(store_dir, patent_reprs, dtype=args.dtype)
+        print(f"Wrote {len(patent_reprs)} patents to {store_dir}")
+
+
+if __name__ == '__main__':
+    main()
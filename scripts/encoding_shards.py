@@ -0,0 +1,96 @@
+"""The sharded output of the encoding scripts. The patents of each packaged zip are split into shards which are
+written as pickled lists of patent dicts as soon as they're encoded. Shards which are already written are skipped
+when a script is run again, and when all shards of a zip are done they're collected into an embedding store.
+
+The shards of a zip are in a directory named by the encoder and model, and the other settings the encodings depend
+on are written to it, so a run with different settings doesn't reuse shards encoded with other ones."""
+import json
+import os
+import pickle
+from pathlib import Path
+
+from packaged_patents import PackagedPatents
+
+
+def list_packaged_patents(packaged):
+    '''Return the sorted patent numbers of a packaged zip'''
+    with PackagedPatents(packaged) as packaged_patents:
+        return packaged_patents.patent_numbers
+
+
+def plan_shards(patents, shard_size):
+    '''Split the sorted patent numbers into shards of shard_size patents. The shards are named by their
+    first and last patent numbers, so a shard file is only reused for exactly the same patents.'''
+    shards = []
+    for i in range(0, len(patents), shard_size):
+        shard_patents = patents[i:i+shard_size]
+        shard_name = f'shard_{i//shard_size:05}_{shard_patents[0]}-{shard_patents[-1]}'
+        shards.append((shard_name, shard_patents))
+    return shards
+
+
+SHARD_SETTINGS = 'settings.json'
+
+
+def shard_dir(output_dir: Path, encoder, model_name, basename):
+    '''The directory of the shards of a zip, e.g. sbert_AI-Growth-Lab_PatentSBERTa_{zip name}_shards'''
+    model_slug = model_name.replace('/', '_').replace('\\', '_')
+    return output_dir / f'{encoder}_{model_slug}_{basename}_shards'
+
+
+def shard_path(shards_dir: Path, shard_name):
+    return shards_dir / f'{shard_name}.pkl'
+
+
+def check_shard_settings(shards_dir: Path, settings):
+    '''Write the encoding settings to a new shard directory, or check that they're the ones of the shards already in it'''
+    settings_path = shards_dir / SHARD_SETTINGS
+    if settings_path.exists():
+        with open(settings_path) as fp:
+            shard_settings = json.load(fp)
+        if shard_settings != settings:
+            raise ValueError(f"The shards in {shards_dir} were encoded with {shard_settings}, not {settings}. "
+                             f"Use another output directory, or remove the shards to encode them again")
+    else:
+        part_path = settings_path.with_name(settings_path.name + '.part')
+        with open(part_path, 'w') as fp:
+            json.dump(settings, fp)
+        os.replace(part_path, settings_path)
+
+
+def plan_shard_jobs(packaged_zips, output_dir: Path, shard_size, encoder, settings):
+    '''Plan the shards of the packaged zips encoded by the encoder (e.g. 'sbert' or 'clip') with the settings, a dict
+    which includes the model_name. Returns the jobs (packaged zip, shard path, patents) of the shards which aren't
+    written yet, and a dict from the zips to the paths of all their shards.'''
+    shard_jobs = []
+    zip_shards = dict()
+    for packaged in packaged_zips:
+        basename = packaged.with_suffix('').name
+        shards_dir = shard_dir(output_dir, encoder, settings['model_name'], basename)
+        shards_dir.mkdir(exist_ok=True)
+        check_shard_settings(shards_dir, settings)
+        shards = plan_shards(list_packaged_patents(packaged), shard_size)
+        zip_shards[packaged] = [shard_path(shards_dir, shard_name) for shard_name, shard_patents in shards]
+        for shard_name, shard_patents in shards:
+            output_path = shard_path(shards_dir, shard_name)
+            if not output_path.exists():
+                shard_jobs.append((packaged, output_path, shard_patents))
+    n_shards = sum(len(shard_paths) for shard_paths in zip_shards.values())
+    print(f"{n_shards - len(shard_jobs)} of {n_shards} shards are already done")
+    return shard_jobs, zip_shards
+
+
+def write_shard(output_path: Path, patent_reprs):
+    '''Write a shard through a .part file, so a shard file with the final name is always complete'''
+    part_path = output_path.with_name(output_path.name + '.part')
+    with open(part_path, 'wb') as fp:
+        pickle.dump(patent_reprs, fp)
+    os.replace(part_path, output_path)
+
+
+def load_shards(shard_paths):
+    patent_reprs = []
+    for path in shard_paths:
+        with open(path, 'rb') as fp:
+            patent_reprs.extend(pickle.load(fp))
+    return patent_reprs
@@ -2,14 +2,17 @@ import argparse
 from pathlib import Path
 import json
 import datetime
+import tempfile
 import zipfile
+from contextlib import ExitStack
+from functools import partial
+from multiprocessing import Pool
 
 from requests.models import HTTPError
 
 from tqdm import tqdm, trange
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo
 from pathlib import Path
-import xml.etree.ElementTree as ET
 from collections import Counter, defaultdict
 
 import datetime
@@ -21,13 +24,9 @@ import json
 from collections import defaultdict,  Counter
 import datetime
 import random
-from zipfile import ZipFile
 from pathlib import Path
-import xml.etree.ElementTree as ET
 from collections import Counter
-from zipfile import ZipFile
 from pathlib import Path
-import xml.etree.ElementTree as ET
 from collections import Counter, defaultdict
 from tqdm import tqdm, trange
 import datetime
@@ -36,95 +35,59 @@ import random
 import json
 #import imageio
 
+from patent_reader import read_patent_info, read_images
+from packaged_patents import ColumnarWriter, TEXT_SECTIONS, compress_section
+from image_store import write_image_store, FIT_METHODS
 
-def load_patent_xml(patent_path):
-    with ZipFile(patent_path) as patent_zip:
-        filenames = [zipinfo.filename for zipinfo in patent_zip.infolist()]
-        # We're just assuming the only XML apart from TOC.xml is the one we're looking for
-        # Since the name of this document is based on the application number, not the
-        # publication number, we have to scan for it manually
-        doc_xml = None
-        for filename in filenames:
-            *base, ext = filename.split('.')
-            if ext == 'xml' and filename.lower() != 'toc.xml':
-                doc_xml = filename
-        if doc_xml is None:
-            raise ValueError(
-                f"Unable to find document xml for zipfile {patent_path}")
-
-        with patent_zip.open(doc_xml) as patent_xml_fp:
-            xml_str = str(patent_xml_fp.read(), encoding='utf8')
-            root = ET.fromstring(xml_str)
-            return root
-
-
-def load_images(patent_path):
-    with ZipFile(patent_path) as patent_zip:
-        images = []
-        for fileinfo in patent_zip.infolist():
-            *parents, filename = fileinfo.filename.split('/')
-            *baseparts, ext = filename.split('.')
-            if ext == 'tif':
-                with patent_zip.open(fileinfo) as fp:
-                    image = fp.read()
-                    images.append((filename, image))
-        return images
-
-
-def numbered_text(paragraph):
-    text = ''
-    if 'num' in paragraph.attrib:
-        num = paragraph.attrib['num']
-        text = f'[{num}] '
-    text += ''.join(paragraph.itertext())
-    return text
-
-
-def get_texts(elements):
-    text_dict = {}
-
-    for element in elements:
-        lang = element.attrib['lang']
-        texts = '\n'.join(numbered_text(c) for c in element)
-        text_dict[lang] = texts
-    return text_dict
-
-
-def extract_patent_info(patent_path):
-    patent_info = dict()
-    root = load_patent_xml(patent_path)
-    # The root element is the 'ep-patent-document', which has an attribute called date-publ, the publication date
-    publication_date_str = root.attrib['date-publ']
-    #publication_date = datetime.datetime.strptime(publication_date_str, '%Y%m%d')
-    patent_info['publication_date'] = publication_date_str
-
-    doc_country = root.attrib['country']
-    doc_number = root.attrib['doc-number']
-    doc_kind = root.attrib['kind']
-    patent_info['document_number'] = f'{doc_country}{doc_number}.{doc_kind}'
-
-    ipcr_classes = root.findall('.//SDOBI//classification-ipcr/text')
-    text_classes = [e.text for e in ipcr_classes]
-    # The class string has the form 'A61K  38/44        20060101AFI20130522BHEP        '
-    # We first split by white space and only select the first two parts
-    split_classes = [text.split() for text in text_classes]
-    selected_parts = [(main_class, sub_class)
-                      for main_class, sub_class, *_ in split_classes]
-    patent_info['ipc_classes'] = selected_parts
-
-    patent_info['abstract'] = get_texts(root.findall('abstract'))
-    patent_info['claims'] = get_texts(root.findall('claims'))
-    patent_info['description'] = get_texts(root.findall('description'))
-
-    applicants = root.findall('.//SDOBI//B711/snm')
-    text_applicants = [e.text for e in applicants]
-    patent_info['applicants'] = text_applicants
-
-    language, = root.findall('.//SDOBI/B200/B260')
-    language_text = language.text
-    patent_info['language'] = language_text
-
-    return patent_info
+
+PACKAGING_FORMATS = ('json', 'columnar')
+
+
+def package_patent(patent_file, filter_lang=None, packaging_format='json'):
+    '''Parse a single downloaded patent zip and collect everything which should go into the package.
+    The source zip is only opened once. Returns a tuple (status, patent_file_name, patent_number, patent_data, images),
+    where status is one of 'ok', 'empty', 'filtered' or 'broken'. The patent data is the patent info json for the
+    json format, and the fields and compressed text sections for the columnar format. This runs in the worker
+    processes, so everything returned has to be picklable.'''
+    try:
+        with ZipFile(patent_file) as patent_zip:
+            patent_info = read_patent_info(patent_zip, patent_file)
+            abstract_langs = set(patent_info['abstract'].keys())
+            claims_langs = set(patent_info['claims'].keys())
+            description_langs = set(patent_info['description'].keys())
+
+            if len(abstract_langs) == 0 or len(claims_langs) == 0 or len(description_langs) == 0:
+                return 'empty', patent_file.name, None, None, None
+
+            if filter_lang is not None:
+                lang = filter_lang
+                if not (lang in abstract_langs and lang in claims_langs and lang in description_langs):
+                    return 'filtered', patent_file.name, None, None, None
+
+            patent_number = patent_info['document_number']
+            if packaging_format == 'columnar':
+                fields = {field: value for field, value in sorted(patent_info.items()) if field not in TEXT_SECTIONS}
+                patent_data = fields, {section: compress_section(patent_info[section]) for section in TEXT_SECTIONS}
+            else:
+                patent_data = json.dumps(patent_info, sort_keys=True, indent=2)
+            images = read_images(patent_zip)
+            return 'ok', patent_file.name, patent_number, patent_data, images
+    except zipfile.BadZipFile as e:
+        #print(f"Error loading file {patent_file}")
+        return 'broken', patent_file.name, None, None, None
+
+
+def patent_sort_key(patent_file):
+    # The downloaded files are named like EP1234567NWA1.zip for the patent EP1234567.A1
+    return patent_file.stem.replace('NW', '.')
+
+
+def write_member(patents_fp, name, data):
+    # We use a fixed timestamp instead of the current time so that packaging the same
+    # patents always gives a byte-for-byte identical archive
+    zinfo = ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    zinfo.external_attr = 0o644 << 16
+    patents_fp.writestr(zinfo, data)
 
 
 def main():
@@ -135,10 +98,19 @@ def main():
     parser.add_argument('--filter-lang', help="Only include patents wher abstract, "
                         "description and claims are available in the given language", default='en')
     parser.add_argument('--only-with-images', action='store_true')
-    
+    parser.add_argument('--workers', help="Number of worker processes parsing the patent files. The archive is "
+                        "written by the main process in patent number order regardless of the number of workers",
+                        type=int, default=1)
+    parser.add_argument('--format', help="Format of the archive. 'json' writes a patent_info.json per patent, 'columnar' "
+                        "writes the fields of all patents as one table and the text sections as separately compressed "
+                        "texts, so the fields can be read without the texts", choices=PACKAGING_FORMATS, default='json')
+    parser.add_argument('--image-size', help="If given, the drawings are also decoded and scaled to images of this "
+                        "width and height, and written to an image store next to the archive", type=int)
+    parser.add_argument('--image-fit', help="How to make the decoded images square, see image_store.py", choices=FIT_METHODS, default='crop')
+
     args = parser.parse_args()
 
-    patent_list = set(args.patent_directory.glob('EP*.zip'))
+    patent_list = sorted(args.patent_directory.glob('EP*.zip'), key=patent_sort_key)
     basename = args.patent_directory.name
 
     args.output_dir.mkdir(exist_ok=True, parents=True)
@@ -146,34 +118,41 @@ def main():
     broken_patents = []
     empty_patents = []
 
-    with ZipFile(output_path, 'w') as patents_fp:
-        for patent_file in tqdm(patent_list, desc='Patent files'):
-            try:
-                patent_info = extract_patent_info(patent_file)
-                abstract_langs = set(patent_info['abstract'].keys())
-                claims_langs = set(patent_info['claims'].keys())
-                description_langs = set(patent_info['description'].keys())
-
-                if len(abstract_langs) == 0 or len(claims_langs) == 0 or len(description_langs) == 0:
-                    empty_patents.append(patent_file.name)
-                    continue
-                    
-                if args.filter_lang is not None:
-                    lang = args.filter_lang
-                    if not (lang in abstract_langs and lang in claims_langs and lang in description_langs):
-                        continue
-
-                patent_number = patent_info['document_number']
-                patents_fp.writestr(patent_number + '/patent_info.json',
-                                    json.dumps(patent_info, sort_keys=True, indent=2))
-
-                images = load_images(patent_file)
+    package_fn = partial(package_patent, filter_lang=args.filter_lang, packaging_format=args.format)
+    with ExitStack() as stack:
+        if args.workers > 1:
+            pool = stack.enter_context(Pool(args.workers))
+            # imap gives back the results in the order of patent_list, so the output does
+            # not depend on which worker finishes first
+            packaged_patents = pool.imap(package_fn, patent_list, chunksize=4)
+        else:
+            packaged_patents = map(package_fn, patent_list)
+
+        patents_fp = stack.enter_context(ZipFile(output_path, 'w'))
+        columnar_writer = None
+        if args.format == 'columnar':
+            temp_dir = Path(stack.enter_context(tempfile.TemporaryDirectory(dir=args.output_dir)))
+            columnar_writer = ColumnarWriter(patents_fp, write_member, temp_dir)
+        for status, patent_file_name, patent_number, patent_data, images in tqdm(packaged_patents, desc='Patent files', total=len(patent_list)):
+            if status == 'broken':
+                broken_patents.append(patent_file_name)
+            elif status == 'empty':
+                empty_patents.append(patent_file_name)
+            elif status == 'ok':
+                if columnar_writer is not None:
+                    columnar_writer.add(*patent_data)
+                else:
+                    write_member(patents_fp, patent_number + '/patent_info.json', patent_data)
                 for image_name, image in images:
-                    patents_fp.writestr(f'{patent_number}/{image_name}', image)
-            except zipfile.BadZipFile as e:
-                #print(f"Error loading file {patent_file}")
-                broken_patents.append(patent_file.name)
-    
+                    write_member(patents_fp, f'{patent_number}/{image_name}', image)
+        if columnar_writer is not None:
+            columnar_writer.close()
+
+    if args.image_size is not None:
+        n_images, n_failed = write_image_store(args.output_dir / f'{basename}_images', output_path, size=args.image_size,
+                                               fit=args.image_fit, workers=args.workers)
+        print(f"Decoded {n_images} images, {n_failed} could not be decoded")
+
     with open(args.output_dir / f'{basename}_broken_zips.txt', 'w') as fp:
         fp.write('\n'.join(broken_patents))
 
@@ -2,14 +2,27 @@ import argparse
 from pathlib import Path
 import json
 import math
-import re
 import datetime
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import Counter
 
 from requests.models import HTTPError
 
-from tqdm import tqdm, trange
+from tqdm import tqdm
 import epo_ops
 
+from ops_client import ThrottleBudget, ThrottledClient, set_ops_url
+from ops_search import SearchCache, search_count, search_page
+from search_coverage import CoverageIndex
+
+# OPS doesn't give us more than the first 2000 results of a search
+MAX_RANGE_COUNT = 2000
+# When splitting a date range we aim lower than the limit, since the results aren't spread evenly over the days
+# (EP documents are published weekly, so a part can easily get one publication day more than another)
+TARGET_RANGE_COUNT = 1500
+
 
 def determine_yearly_range(client, cql, year_range):
     '''return a sequence of year ranges where each range will return less than 2000 patents'''
@@ -28,24 +41,54 @@ def determine_yearly_range(client, cql, year_range):
         return determine_yearly_range(client, cql, first_range) + determine_yearly_range(client, cql, second_range)
 
 
-def determine_date_ranges(client, ipc_class, date_range):
-    '''return a sequence of date ranges where each range will return less than 2000 patents'''
+def class_query(ipc_class, date_range):
     begin_date, end_date = date_range
     begin_date_str = begin_date.strftime('%Y%m%d')
     end_date_str = end_date.strftime('%Y%m%d')
-    year_instantiated_cql = f'ipc={ipc_class} and pn=EP and pd="{begin_date_str} {end_date_str}"'
-    #print(year_instantiated_cql)
-    req = client.published_data_search(year_instantiated_cql, range_begin=1, range_end=2)  # We limit the range to limit how much date we request
-    query_response = json.loads(req.content)
-    total_count = int(query_response['ops:world-patent-data']['ops:biblio-search']['@total-result-count'])
-    if total_count < 2000:
+    return f'ipc={ipc_class} and pn=EP and pd="{begin_date_str} {end_date_str}"'
+
+
+def split_date_range(date_range, total_count, target_count=TARGET_RANGE_COUNT):
+    '''Split a date range on whole days into as many parts as needed for each to have about target_count results,
+    assuming the results are spread evenly over the days. Like the rest of the search, neighbouring ranges share their
+    boundary date.'''
+    begin_date, end_date = date_range
+    n_days = (end_date - begin_date).days
+    n_parts = min(max(2, math.ceil(total_count / target_count)), n_days)
+    boundaries = [begin_date + datetime.timedelta(days=round(i*n_days/n_parts)) for i in range(n_parts + 1)]
+    return tuple(zip(boundaries[:-1], boundaries[1:]))
+
+
+def bisection_probes(total_count, max_count=MAX_RANGE_COUNT):
+    '''Estimate how many count probes halving a date range until all parts have less than max_count results
+    would take, if the results are spread evenly'''
+    if total_count < max_count:
+        return 1
+    depth = math.floor(math.log2(total_count / max_count)) + 1
+    return 2**(depth + 1) - 1
+
+
+def determine_date_ranges(client, ipc_class, date_range, cache: SearchCache = None, total_count=None, stats: Counter = None):
+    '''return a sequence of date ranges where each range is expected to return less than 2000 patents.
+    A range with too many results is split in one step, with the number of parts based on its count. The parts are not
+    probed, instead the search finds out from the first page of a part if an estimate was wrong, and that range is
+    passed here again with the count it got (in which case no request is made).'''
+    begin_date, end_date = date_range
+    if total_count is None:
+        year_instantiated_cql = class_query(ipc_class, date_range)
+        #print(year_instantiated_cql)
+        total_count = search_count(client, year_instantiated_cql, cache=cache)
+        if stats is not None:
+            stats['count_probes'] += 1
+            stats['bisection_probes'] += bisection_probes(total_count)
+    if total_count < MAX_RANGE_COUNT:
         return (date_range,)
-    else:
-        timedelta = end_date-begin_date
-        first_range = (begin_date, begin_date+timedelta/2)
-        second_range = (begin_date+timedelta/2, end_date)   # +1 since the ranges are inclusive (I think?)
-        return determine_date_ranges(client, ipc_class, first_range) + determine_date_ranges(client, ipc_class, second_range)
-    
+    if (end_date - begin_date).days < 2:
+        # We can't split on whole days any more, so there's no way to get all of these results
+        print(f"Can't split the date range {begin_date:%Y%m%d}-{end_date:%Y%m%d} of class {ipc_class} with {total_count} results, skipping it")
+        return ()
+    return split_date_range(date_range, total_count)
+
 
 def prepare_date_ranges(client, ipc_class, year):
     cql = f'ipc={ipc_class}' + ' and pn=EP and pd={year}'
@@ -73,118 +116,177 @@ def prepare_date_ranges(client, ipc_class, year):
         return determine_yearly_range(client, cql, first_range) + determine_yearly_range(client, cql, second_range)
 
 
-def extract_patents(query_response):
-    docs = query_response['ops:world-patent-data']['ops:biblio-search']['ops:search-result']['ops:publication-reference']
-    if not isinstance(docs, list):
-        # In the rare case that we get a single result, it's not returned as a JSON array, but as a singleton object
-        docs = [docs]
-    document_ids = []
-    for doc in docs:
-        document_id = doc['document-id']
-        country = document_id['country']['$']
-        doc_number = document_id['doc-number']['$']
-        kind_code = document_id['kind']['$']
-        doc_str = f'{country}{doc_number}.{kind_code}'
-        document_ids.append(doc_str)
-    return document_ids
-
-
-def get_class_patents(client, ipc_class, date_range):
-    patents = []
-    begin_date, end_date = date_range
-    begin_date_str = begin_date.strftime('%Y%m%d')
+def cleanup_class(class_str):
+    return class_str.replace('/', '-')
+
+def get_missing_date_ranges(directory, ipc_class, date_range, coverage: CoverageIndex = None):
+    '''Return the parts of the date range not covered by the search result files of the class in the directory,
+    and the merged covered date ranges'''
+    if coverage is None:
+        coverage = CoverageIndex.load(directory)
+    return coverage.missing_date_ranges(ipc_class, date_range)
+
+
+def range_output_path(output_dir: Path, ipc_class, date_range):
+    start_date, end_date = date_range
+    start_date_str = start_date.strftime('%Y%m%d')
     end_date_str = end_date.strftime('%Y%m%d')
-    cql = f'ipc={ipc_class} and pn=EP and pd="{begin_date_str} {end_date_str}"'
-    req = client.published_data_search(cql, range_begin=1, range_end=100)  # We limit the range to limit how much date we request
-    query_response = json.loads(req.content)
-    patents.extend(extract_patents(query_response))
+    return output_dir / f'{cleanup_class(ipc_class)}_{start_date_str}-{end_date_str}.txt'
 
-    total_count = int(query_response['ops:world-patent-data']['ops:biblio-search']['@total-result-count'])
-    if not total_count < 2000:
-        raise ValueError(f"Total count is too much for class {ipc_class} and date range {date_range}")
-    n_requests = int(math.ceil(total_count / 100))
-    for i in trange(1, n_requests, desc="Retriving documents", leave=False):
-        start_range = i*100+1
-        end_range = (i+1)*100
-        req = client.published_data_search(cql, range_begin=start_range, range_end=end_range)  # We limit the range to limit how much date we request
-        query_response = json.loads(req.content)
-        patents.extend(extract_patents(query_response))
-    return patents
 
-def cleanup_class(class_str):
-    return class_str.replace('/', '-')
+def write_range_file(output_path: Path, documents):
+    '''Write the documents of a range through a .part file, so a file with the final name is always complete'''
+    part_path = output_path.with_name(output_path.name + '.part')
+    with open(part_path, 'w') as fp:
+        fp.write('\n'.join(documents))
+    os.replace(part_path, output_path)
+
+
+class ClassSearcher:
+    '''Runs the searches of all classes and date ranges with their requests overlapping. The count probes and the
+    result pages are fetched by a pool of worker threads, so the number of workers is how many requests can be in flight
+    at the same time. All requests go through a shared throttle budget. The client_factory is called once per worker
+    thread, it should return an epo_ops.Client (or something else with its `published_data_search` method).'''
+    def __init__(self, client_factory, workers=4, budget=None, cache: SearchCache = None):
+        self.client_factory = client_factory
+        self.cache = cache
+        self.local = threading.local()
+        self.budget = budget if budget is not None else ThrottleBudget()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
 
-def get_missing_date_ranges(directory, ipc_class, date_range):
-    year_class_files = list(directory.glob(f'{ipc_class}_*.txt'))
-    query_start, query_end = date_range 
-     # The algorithm below looks for gaps between tuples of start_date, end_date. 
-     # By adding two dummy dates (query_start, query_start) and 
-     # (query_end, query_end) these will show up in the missing date ranges
-    existing_date_ranges = [(query_start, query_start), (query_end, query_end)]  
-    for f in year_class_files:
-        m = re.match(r'([\w\d]+)_(\d+)-(\d+)\.txt', f.name)
-        if m is not None:
-            ipc_class_, begin_date_str, end_date_str = m.groups()
-            begin_date = datetime.datetime.strptime(begin_date_str, '%Y%m%d')
-            end_date = datetime.datetime.strptime(end_date_str, '%Y%m%d')
-            # We only add those files which have dates overlapping the query range
-            if begin_date < query_end and end_date > query_start:
-                existing_date_ranges.append((begin_date, end_date))
-    existing_date_ranges.sort()
-    merged_existing_date_ranges = []
-    missing_date_ranges = []
-    if existing_date_ranges:
-        current_date_range = existing_date_ranges[0]
-        for next_date_range in existing_date_ranges[1:]:
-            current_start, current_end = current_date_range
-            next_start, next_end = next_date_range
-            if current_end < next_start:
-                merged_existing_date_ranges.append(current_date_range)
-                missing_date_range = (current_end, next_start)
-                missing_date_ranges.append(missing_date_range)
-                current_date_range = next_date_range
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    @property
+    def client(self):
+        # The client isn't thread safe, so every worker thread gets its own
+        if not hasattr(self.local, 'client'):
+            self.local.client = ThrottledClient(self.client_factory(), self.budget)
+        return self.local.client
+
+    def _plan(self, ipc_class, date_range):
+        stats = Counter()
+        date_ranges = determine_date_ranges(self.client, ipc_class, date_range, cache=self.cache, stats=stats)
+        return date_ranges, stats
+
+    def _fetch_page(self, ipc_class, date_range, page_index):
+        range_begin = page_index*100 + 1
+        range_end = (page_index + 1)*100
+        return search_page(self.client, class_query(ipc_class, date_range), range_begin, range_end, cache=self.cache)
+
+    def search(self, planning_jobs, output_dir: Path, overwrite=False, coverage: CoverageIndex = None):
+        '''Search for the documents of the (ipc_class, date_range) jobs. Each date range is first planned, then the first
+        page of each planned range is fetched which tells us its count, and then the rest of its pages. When all pages
+        of a range have arrived it's written to its file. If any request for a range fails no file is written, so the
+        range shows up as missing the next time the search is run. The written files are added to the coverage index.
+        Returns the statistics of the date range planning.'''
+        planning_stats = Counter()
+        # What each future is for, (kind, ipc_class, date_range, page_index) where kind is 'plan' or 'page'
+        futures = dict()
+        # The ranges being fetched, with their pages (None until the page has arrived) and
+        # the number of page requests which haven't finished
+        ranges = dict()
+
+        def submit(kind, ipc_class, date_range, page_index=None):
+            if kind == 'plan':
+                future = self.executor.submit(self._plan, ipc_class, date_range)
             else:
-                current_date_range = (current_start, next_end)
-        merged_existing_date_ranges.append(current_date_range)
-    return missing_date_ranges, merged_existing_date_ranges
+                future = self.executor.submit(self._fetch_page, ipc_class, date_range, page_index)
+            futures[future] = (kind, ipc_class, date_range, page_index)
+
+        def fetch_ranges(ipc_class, date_ranges):
+            for date_range in date_ranges:
+                if overwrite or not range_output_path(output_dir, ipc_class, date_range).exists():
+                    pbar.total += 1
+                    pbar.refresh()
+                    submit('page', ipc_class, date_range, 0)
 
-def search_patents_in_classes(ipc_classes, client, output_dir: Path, overwrite=False):
+        with tqdm(desc='Query date range', total=0, leave=False) as pbar:
+            for ipc_class, date_range in planning_jobs:
+                submit('plan', ipc_class, date_range)
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, ipc_class, date_range, page_index = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except HTTPError as e:
+                        start_date, end_date = date_range
+                        print(f'Error retrieving data for class {ipc_class} and dates {start_date:%Y%m%d}-{end_date:%Y%m%d}, {e}')
+                        result = None
+
+                    if kind == 'plan':
+                        if result is not None:
+                            date_ranges, stats = result
+                            planning_stats.update(stats)
+                            fetch_ranges(ipc_class, date_ranges)
+                        continue
+
+                    if page_index == 0:
+                        if result is None:
+                            pbar.update(1)
+                            continue
+                        documents, total_count = result
+                        if not total_count < MAX_RANGE_COUNT:
+                            # The estimate was wrong, split the range again now that we know its count
+                            planning_stats['missed_estimates'] += 1
+                            pbar.update(1)
+                            fetch_ranges(ipc_class, determine_date_ranges(None, ipc_class, date_range, total_count=total_count))
+                            continue
+                        n_pages = max(1, int(math.ceil(total_count / 100)))
+                        pages = [documents] + [None]*(n_pages - 1)
+                        ranges[(ipc_class, date_range)] = {'pages': pages, 'remaining': n_pages - 1, 'failed': False}
+                        for i in range(1, n_pages):
+                            submit('page', ipc_class, date_range, i)
+                    else:
+                        range_state = ranges[(ipc_class, date_range)]
+                        range_state['remaining'] -= 1
+                        if result is None:
+                            range_state['failed'] = True
+                        else:
+                            documents, _ = result
+                            range_state['pages'][page_index] = documents
+
+                    range_state = ranges[(ipc_class, date_range)]
+                    if range_state['remaining'] == 0:
+                        del ranges[(ipc_class, date_range)]
+                        if not range_state['failed']:
+                            documents = [doc for page in range_state['pages'] for doc in page]
+                            output_path = range_output_path(output_dir, ipc_class, date_range)
+                            write_range_file(output_path, documents)
+                            if coverage is not None:
+                                coverage.add(output_path, len(documents))
+                        pbar.update(1)
+        return planning_stats
+
+
+def search_patents_in_classes(ipc_classes, searcher: ClassSearcher, output_dir: Path, overwrite=False):
+    coverage = CoverageIndex.load(output_dir)
+    planning_jobs = []
     for year, class_counts in ipc_classes.items():
         year = int(year)
         start_date = datetime.datetime(year=year, month=1, day=1)
         end_date = datetime.datetime(year=year+1, month=1, day=1)
 
-        for ipc_class in tqdm(class_counts.keys(), desc='Processing classes', leave=False):
-            # Just make a quick check for the  whole date range. If there's a file we skip it
-            start_date_str = start_date.strftime('%Y%m%d')
-            end_date_str = end_date.strftime('%Y%m%d')
+        for ipc_class in class_counts.keys():
             cleaned_class = cleanup_class(ipc_class)
-
-            query_date_ranges = []
-
             if not overwrite:
                 # Determine whether there is something to do by looking at the existing date files
-                missing_date_ranges, merged_existing_date_ranges = get_missing_date_ranges(output_dir, cleaned_class, (start_date, end_date))
-                for missing_date_range in missing_date_ranges:
-                    divided_date_ranges = determine_date_ranges(client, ipc_class, missing_date_range)
-                    query_date_ranges.extend(divided_date_ranges)
+                missing_date_ranges, merged_existing_date_ranges = get_missing_date_ranges(output_dir, cleaned_class, (start_date, end_date), coverage=coverage)
+                planning_jobs.extend((ipc_class, missing_date_range) for missing_date_range in missing_date_ranges)
             else:
-                divided_date_ranges = determine_date_ranges(client, ipc_class, (start_date, end_date))
-                query_date_ranges.extend(divided_date_ranges)
-
-            for query_date_range in tqdm(query_date_ranges, desc='Query date range', leave=False):
-                start_date, end_date = query_date_range
-                start_date_str = start_date.strftime('%Y%m%d')
-                end_date_str = end_date.strftime('%Y%m%d')
-                output_path = output_dir / f'{cleaned_class}_{start_date_str}-{end_date_str}.txt'
-                if not output_path.exists() or overwrite:
-                    try:
-                        documents = get_class_patents(client, ipc_class, query_date_range)
-                        with open(output_path, 'w') as fp:
-                            fp.write('\n'.join(documents))
-                    except HTTPError as e:
-                        print(f'Error retrieving data for dates {start_date_str}-{end_date_str}, {e}')
+                planning_jobs.append((ipc_class, (start_date, end_date)))
 
+    try:
+        planning_stats = searcher.search(planning_jobs, output_dir, overwrite=overwrite, coverage=coverage)
+    finally:
+        # Merge the journal of the files written by the search into the index
+        coverage.save()
+    if planning_stats['count_probes']:
+        print(f"Planned the date ranges with {planning_stats['count_probes']} count probes and {planning_stats['missed_estimates']} missed estimates, "
+              f"halving the ranges would have taken about {planning_stats['bisection_probes']} probes "
+              f"({planning_stats['bisection_probes'] - planning_stats['count_probes']} saved)")
 
 
 def main():
@@ -198,23 +300,35 @@ def main():
     parser.add_argument('--overwrite', help='If flag is set, overwrite data in output dir. '
                         'If not set, data which is already present will not be downloaded again', 
                         action='store_true')
+    parser.add_argument('--workers', help="Maximum number of search requests in flight at the same time. "
+                        "The request rate is still limited by the OPS throttling", type=int, default=4)
+    parser.add_argument('--ops-url', help="Base URL of the OPS service, mainly useful for testing against a local mock server",
+                        default=None)
+    parser.add_argument('--cache', help="SQLite file where search counts and result pages are cached between runs. "
+                        "By default 'ops_search_cache.sqlite' in the output directory", type=Path, default=None)
+    parser.add_argument('--cache-ttl', help="Number of days before cached search results are fetched again", type=float, default=30)
+    parser.add_argument('--no-cache', help="Don't use the search cache", action='store_true')
     args = parser.parse_args()
     
     
     middlewares = [
         # epo_ops.middlewares.Dogpile(), #No dogpile support on windows
-        epo_ops.middlewares.Throttler(),
+        # The throttling is done by the ClassSearcher instead of the Throttler middleware
     ]
 
     with open(args.api_keys, 'r') as fp:
         api_keys = json.load(fp)
 
-    client = epo_ops.Client(
-        key=api_keys['key'],
-        secret=api_keys['secret'],
-        middlewares=middlewares,
-        accept_type='json'
-        )
+    def client_factory():
+        client = epo_ops.Client(
+            key=api_keys['key'],
+            secret=api_keys['secret'],
+            middlewares=middlewares,
+            accept_type='json'
+            )
+        if args.ops_url is not None:
+            set_ops_url(client, args.ops_url)
+        return client
     
     # date_ranges = []
     # first_year, last_year = args.year_range
@@ -227,7 +341,19 @@ def main():
         yearly_classes = json.load(fp)
     
     args.output_dir.mkdir(parents=True, exist_ok=True)
-    search_patents_in_classes(yearly_classes, client, args.output_dir, overwrite=args.overwrite)
+    cache = None
+    if not args.no_cache:
+        cache_path = args.cache if args.cache is not None else args.output_dir / 'ops_search_cache.sqlite'
+        cache = SearchCache(cache_path, ttl=datetime.timedelta(days=args.cache_ttl))
+    searcher = ClassSearcher(client_factory, workers=args.workers, cache=cache)
+    try:
+        search_patents_in_classes(yearly_classes, searcher, args.output_dir, overwrite=args.overwrite)
+    finally:
+        searcher.close()
+        print(searcher.budget.summary())
+        if cache is not None:
+            print(f"Search cache: {cache.summary()}")
+            cache.close()
 
 
 if __name__ == '__main__':
@@ -13,78 +13,75 @@ from requests.models import HTTPError
 from tqdm import tqdm, trange
 import epo_ops
 
-def extract_patents(query_response):
-    docs = query_response['ops:world-patent-data']['ops:biblio-search']['ops:search-result']['ops:publication-reference']
-    if not isinstance(docs, list):
-        # In the rare case that we get a single result, it's not returned as a JSON array, but as a singleton object
-        docs = [docs]
-    document_ids = []
-    for doc in docs:
-        document_id = doc['document-id']
-        country = document_id['country']['$']
-        doc_number = document_id['doc-number']['$']
-        kind_code = document_id['kind']['$']
-        doc_str = f'{country}{doc_number}.{kind_code}'
-        document_ids.append(doc_str)
-    return document_ids
+from ops_client import ThrottledClient, set_ops_url
+from ops_search import SearchCache, search_page
+
+# OPS returns at most 100 results per search request, and only the first 2000 results of a search
+PAGE_SIZE = 100
+MAX_POSITIONS = 2000
 
 
 def cleanup_class(class_str):
     return class_str.replace('/', '-')
 
 
-def sample_random_patents(week, count, client):
+def plan_windows(positions, covered=0, page_size=PAGE_SIZE):
+    '''Plan the search requests for fetching the results at the sorted (1-based) positions, where the positions up to
+    `covered` have already been fetched. Starting each request window at the first position which isn't covered yet
+    and letting it span page_size results gives the fewest possible requests. The windows are trimmed to end at their
+    last position. Returns a list of (range_begin, range_end, positions) tuples.'''
+    windows = []
+    for position in positions:
+        if position <= covered:
+            continue
+        if windows and position - windows[-1][0] < page_size:
+            windows[-1].append(position)
+        else:
+            windows.append([position])
+    return [(window[0], window[-1], window) for window in windows]
+
+
+def sample_random_patents(week, count, client, rng=random, cache: SearchCache = None, stats: Counter = None):
     week_start, week_end = week
     
-    patents = []
     begin_date_str = week_start.strftime('%Y%m%d')
     end_date_str = week_end.strftime('%Y%m%d')
     cql = f'pn=EP and pd="{begin_date_str} {end_date_str}"'
-    req = client.published_data_search(cql, range_begin=1, range_end=2)  # We limit the range to limit how much date we request
-    query_response = json.loads(req.content)
-    total_count = int(query_response['ops:world-patent-data']['ops:biblio-search']['@total-result-count'])
-    end_range = min(2000, total_count)
-
-    search_result_numbers = sorted(random.sample(range(end_range), count))
-    collected_ranges = []
-    current_range_start = search_result_numbers[0]
-    current_range = [current_range_start]
-    for search_result_number in search_result_numbers[1:]:
-        if search_result_number - current_range_start > 99:
-            collected_ranges.append(current_range)
-            current_range_start = search_result_number
-            current_range = [current_range_start]
-        else:
-            current_range.append(search_result_number)
-    collected_ranges.append(current_range)
-
-    sampled_patents = []
-    for search_range in tqdm(collected_ranges, desc="Retriving documents", leave=False):
+    # Pages found in the cache aren't requests to OPS, so only the misses are counted
+    page_misses_before = cache.stats['page_misses'] if cache is not None else 0
+    # We need the count before we can sample, but instead of a small probe we get the whole first
+    # page for the same single request, and any positions we sample on it come for free
+    first_page, total_count = search_page(client, cql, 1, PAGE_SIZE, cache=cache)
+    n_positions = min(MAX_POSITIONS, total_count)
+    if count > n_positions:
+        print(f'Only {n_positions} documents to sample {count} from for dates {begin_date_str}-{end_date_str}, taking all of them')
+        count = n_positions
+
+    # The search result positions are 1-based
+    positions = sorted(rng.sample(range(1, n_positions + 1), count))
+    windows = plan_windows(positions, covered=len(first_page))
+
+    sampled_patents = [first_page[position - 1] for position in positions if position <= len(first_page)]
+    for range_begin, range_end, window_positions in tqdm(windows, desc="Retriving documents", leave=False):
         try:
-            start_range = min(search_range)
-            end_range = max(search_range)
-            req = client.published_data_search(cql, range_begin=start_range, range_end=end_range)  # We limit the range to limit how much date we request
-            # Since this is the tightest loop, let's ad ad-hoc throttling here
-            # h = req.headers
-            # throttling_control = h['x-throttling-control']
-            # m = re.search(r'search=(\w+):(\d+)', throttling_control)
-            # if m is not None:
-            #     status, n_requests = m.groups()
-            #     if status != 'green':
-            #         print("Self-throttling")
-            #         time.sleep(120)
-            query_response = json.loads(req.content)
-            patents = extract_patents(query_response)
-            selected_patents = [patents[x - start_range] for x in search_range]
-            sampled_patents.extend(selected_patents)
+            patents, _ = search_page(client, cql, range_begin, range_end, cache=cache)
+            sampled_patents.extend(patents[position - range_begin] for position in window_positions)
         except HTTPError as e:
-            print(f'Error retrieving data for dates {start_range}-{end_range}, {e}')
+            print(f'Error retrieving data for dates {range_begin}-{range_end}, {e}')
             raise e
-        
+    if stats is not None:
+        if cache is not None:
+            n_requests = cache.stats['page_misses'] - page_misses_before
+        else:
+            n_requests = 1 + len(windows)
+        stats['search_requests'] += n_requests
+        stats['cached_pages'] += 1 + len(windows) - n_requests
+        stats['sampled_patents'] += len(sampled_patents)
     return sampled_patents
 
 
-def search_patents_in_classes(ipc_classes, client, output_dir: Path, overwrite=False, random_seed=None):
+def search_patents_in_classes(ipc_classes, client, output_dir: Path, overwrite=False, random_seed=None, cache: SearchCache = None):
+    sampling_stats = Counter()
     for year, class_counts in tqdm(ipc_classes.items(), desc='Year'):
         year = int(year)
         if random_seed is not None:
@@ -112,19 +109,27 @@ def search_patents_in_classes(ipc_classes, client, output_dir: Path, overwrite=F
             end_date_str = week_end.strftime('%Y%m%d')
             output_path = output_dir / f'random_sample_{begin_date_str}_{end_date_str}.txt'
             if not output_path.exists() or overwrite:
+                # In the same way, each week gets its own random generator so the documents sampled in a week
+                # don't depend on which of the other weeks already had been sampled when the script was started
+                rng = random.Random(f'{random_seed}_{begin_date_str}') if random_seed is not None else random
                 try:
-                    sampled_patents = sample_random_patents(week, count, client)
+                    sampled_patents = sample_random_patents(week, count, client, rng=rng, cache=cache, stats=sampling_stats)
                     with open(output_path, 'w') as fp:
                         fp.write('\n'.join(sampled_patents))
                 except HTTPError as e:
                     print(f'Error retrieving data for dates {begin_date_str}-{end_date_str}, {e}')
                     h = e.response.headers
-                    if 'x-rejection-reason' in h and h['x-rejection-reason'] == 'ThrottlingControlQuota':
-                        wait_time = int(h['retry-after'])
+                    if 'x-rejection-reason' in h:
+                        # The client has already waited out and retried the rejections it could,
+                        # so if we're still rejected there's no point in continuing
                         raise e
 
                 except IndexError as e:
                     print(f'Index error when retrieving data for dates {begin_date_str}-{end_date_str}, {e}')
+    if sampling_stats['sampled_patents']:
+        print(f"Sampled {sampling_stats['sampled_patents']} documents with {sampling_stats['search_requests']} search requests "
+              f"({sampling_stats['search_requests'] / sampling_stats['sampled_patents']:.3f} requests per sampled document), "
+              f"{sampling_stats['cached_pages']} result pages from the cache")
 
 
 
@@ -141,11 +146,17 @@ def main():
                         'If not set, data which is already present will not be downloaded again', 
                         action='store_true')
     parser.add_argument('--random-seed', type=int, default=1729)
+    parser.add_argument('--ops-url', help="Base URL of the OPS service, mainly useful for testing against a local mock server",
+                        default=None)
+    parser.add_argument('--cache', help="SQLite file where search counts and result pages are cached between runs. "
+                        "By default 'ops_search_cache.sqlite' in the output directory", type=Path, default=None)
+    parser.add_argument('--cache-ttl', help="Number of days before cached search results are fetched again", type=float, default=30)
+    parser.add_argument('--no-cache', help="Don't use the search cache", action='store_true')
     args = parser.parse_args()
 
     middlewares = [
         # epo_ops.middlewares.Dogpile(), #No dogpile support on windows
-        epo_ops.middlewares.Throttler(),
+        # The throttling is done by the ThrottledClient below instead of the Throttler middleware
     ]
 
     with open(args.api_keys, 'r') as fp:
@@ -157,6 +168,9 @@ def main():
         middlewares=middlewares,
         accept_type='json'
         )
+    if args.ops_url is not None:
+        set_ops_url(client, args.ops_url)
+    client = ThrottledClient(client)
     
     # date_ranges = []
     # first_year, last_year = args.year_range
@@ -169,7 +183,15 @@ def main():
         yearly_classes = json.load(fp)
     
     args.output_dir.mkdir(parents=True, exist_ok=True)
-    search_patents_in_classes(yearly_classes, client, args.output_dir, overwrite=args.overwrite, random_seed=args.random_seed)
+    cache = None
+    if not args.no_cache:
+        cache_path = args.cache if args.cache is not None else args.output_dir / 'ops_search_cache.sqlite'
+        cache = SearchCache(cache_path, ttl=datetime.timedelta(days=args.cache_ttl))
+    search_patents_in_classes(yearly_classes, client, args.output_dir, overwrite=args.overwrite, random_seed=args.random_seed, cache=cache)
+    print(client.budget.summary())
+    if cache is not None:
+        print(f"Search cache: {cache.summary()}")
+        cache.close()
 
 
 if __name__ == '__main__':
@@ -6,9 +6,7 @@ import datetime
 from requests.models import HTTPError
 
 from tqdm import tqdm, trange
-from zipfile import ZipFile
 from pathlib import Path
-import xml.etree.ElementTree as ET
 from collections import Counter, defaultdict
 
 import datetime
@@ -20,55 +18,11 @@ import json
 from collections import defaultdict,  Counter
 import datetime
 import random
-from zipfile import ZipFile
 from pathlib import Path
-import xml.etree.ElementTree as ET
 from collections import Counter
 
-
-def load_patent_xml(patent_path):
-    with ZipFile(patent_path) as patent_zip:
-        filenames = [zipinfo.filename for zipinfo in patent_zip.infolist()]
-        # We're just assuming the only XML apart from TOC.xml is the one we're looking for
-        # Since the name of this document is based on the application number, not the 
-        # publication number, we have to scan for it manually
-        doc_xml = None
-        for filename in filenames:
-            *base, ext = filename.split('.')
-            if ext == 'xml' and filename.lower() != 'toc.xml':
-                doc_xml = filename
-        if doc_xml is None:
-            raise ValueError(f"Unable to find document xml for zipfile {patent_path}")
-        
-        with patent_zip.open(doc_xml) as patent_xml_fp:
-            xml_str = str(patent_xml_fp.read(), encoding='utf8')
-            root = ET.fromstring(xml_str)
-            return root
-
-
-def extract_patent_info(patent_path):
-    patent_info = dict()
-    root = load_patent_xml(patent_path)
-    # The root element is the 'ep-patent-document', which has an attribute called date-publ, the publication date
-    publication_date_str = root.attrib['date-publ']
-    publication_date = datetime.datetime.strptime(publication_date_str, '%Y%m%d')
-    patent_info['publication_date'] = publication_date
-
-    doc_country = root.attrib['country']
-    doc_number = root.attrib['doc-number']
-    doc_kind = root.attrib['kind']
-    patent_info['document_number'] = f'{doc_country}{doc_number}.{doc_kind}'
-
-    ipcr_classes = root.findall('.//SDOBI//classification-ipcr/text')
-    text_classes = [e.text for e in ipcr_classes]
-    # The class string has the form 'A61K  38/44        20060101AFI20130522BHEP        '
-    # We first split by white space and only select the first two parts
-    split_classes = [text.split() for text in text_classes]
-    selected_parts = [(main_class, sub_class) for main_class, sub_class, *_ in split_classes]
-    patent_info['ipc_classes'] = selected_parts
-
-    return patent_info
-
+from patent_reader import extract_patent_info
+from patent_index import load_index
 
 
 def main():
@@ -79,6 +33,11 @@ def main():
     parser.add_argument('--sample-ratio', help="How many complement patents to sample relative to the netto list", type=float, default=1)
     parser.add_argument('--random-seed', help="Constant to seed the random number generator with for repreducability", type=int, default=None)
     parser.add_argument('--most-common-k', type=int, default=20)
+    parser.add_argument('--use-index', help="Read the patent information from a persistent index of the patent directory, "
+                        "only parsing files which are new or have changed since the last run", action='store_true')
+    parser.add_argument('--index-path', help="Where to store the index, by default 'patent_index.sqlite' in the patent directory", 
+                        type=Path, default=None)
+    parser.add_argument('--workers', help="Number of processes used to parse new files when updating the index", type=int, default=1)
     args = parser.parse_args()
 
     random.seed(args.random_seed)
@@ -89,19 +48,33 @@ def main():
     yearly_patent_classes = defaultdict(Counter)
     yearly_patents_to_classes = defaultdict(dict)
     error_patents = []
-    for patent_path in tqdm(netto_list_patents, desc='Processing patent files', leave=False):
+    if args.use_index:
+        # The index only parses new or changed files, the rest are read from the index
+        index_entries = load_index(args.netto_list_patents, args.index_path, workers=args.workers)
+        patent_sources = [(entry['path'], entry) for entry in index_entries]
+    else:
+        patent_sources = [(patent_path, None) for patent_path in netto_list_patents]
+
+    for patent_path, index_entry in tqdm(patent_sources, desc='Processing patent files', leave=False):
         try:
-            patent_info = extract_patent_info(patent_path)
+            if index_entry is None:
+                # We only need the bibliographic data, so skip parsing the full text
+                patent_info = extract_patent_info(patent_path, fields_only=True)
+            elif index_entry['error'] is not None:
+                raise ValueError(index_entry['error'])
+            else:
+                patent_info = index_entry
             patent_number = patent_info['document_number']
             downloaded_patents.add(patent_number)
-            year = patent_info['publication_date'].year
+            publication_date = datetime.datetime.strptime(patent_info['publication_date'], '%Y%m%d')
+            year = publication_date.year
             patent_classes = patent_info['ipc_classes']
             yearly_patents[year].add(patent_number)
             yearly_patent_classes[year].update(patent_classes)
             yearly_patents_to_classes[year][patent_number] = patent_classes
         except BaseException as e:
             #print(f"Error with patent {patent_path}, {e}")
-            error_patents.append(patent_path)
+            error_patents.append(str(patent_path))
     
     output_dir = args.output_directory
     output_dir.mkdir(parents=True, exist_ok=True)
@@ -0,0 +1,190 @@
+"""Decoded patent drawings, so the image encoding doesn't have to decode the TIFFs of the packaged zips every time.
+
+The images of a packaged zip are decoded once, converted to grayscale (the drawings are black and white), scaled to a
+fixed size and written as one uint8 array which is opened with np.load in mmap mode. The search report pages
+('srep' in the name) are not drawings and are left out. By default the images are scaled like the CLIP preprocessing
+(the shorter side is scaled to the size and the middle is cropped), so normalizing the stored images gives the same
+input as running the preprocessing on the TIFF. With fit 'pad' the whole drawing is kept instead, padded with white.
+
+    store/
+        store.json          number of images, size, fit and the number of images which couldn't be decoded
+        images.npy          uint8, (n_images, size, size)
+        patent_numbers.npy  the patent of each image, sorted, so the images of a patent are next to each other
+        image_names.npy     the file name of each image in the zip
+        decoded.npy         False for the images which couldn't be decoded, those are left white
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from packaged_patents import PackagedPatents
+
+
+STORE_META = 'store.json'
+FIT_METHODS = ('crop', 'pad')
+# The sizes of the CLIP models, e.g. ViT-B/32 takes 224x224 images
+DEFAULT_SIZE = 224
+
+
+def is_drawing(image_name):
+    return 'srep' not in image_name
+
+
+def decode_image(image_bytes, size=DEFAULT_SIZE, fit='crop'):
+    '''Decode an image and scale it to a size x size grayscale uint8 array'''
+    # The image is scaled in its own mode and converted afterwards, like the CLIP preprocessing does. For the bilevel
+    # TIFFs this means PIL scales with nearest neighbour, whatever resampling is asked for.
+    image = Image.open(io.BytesIO(image_bytes))
+    width, height = image.size
+    if fit == 'crop':
+        # Like torchvision Resize(size, BICUBIC) followed by CenterCrop(size), which CLIP uses
+        if width <= height:
+            scaled_width, scaled_height = size, int(size * height / width)
+        else:
+            scaled_width, scaled_height = int(size * width / height), size
+        image = image.resize((scaled_width, scaled_height), Image.BICUBIC)
+        left = int(round((scaled_width - size) / 2))
+        top = int(round((scaled_height - size) / 2))
+        image = image.crop((left, top, left + size, top + size)).convert('L')
+    elif fit == 'pad':
+        scale = size / max(width, height)
+        scaled_width, scaled_height = max(1, round(width*scale)), max(1, round(height*scale))
+        padded = Image.new('L', (size, size), 255)
+        # Nothing to be the same as here, so the drawing is converted first to scale it with proper resampling
+        scaled = image.convert('L').resize((scaled_width, scaled_height), Image.BICUBIC)
+        padded.paste(scaled, ((size - scaled_width) // 2, (size - scaled_height) // 2))
+        image = padded
+    else:
+        raise ValueError(f"Unknown fit {fit}, should be one of {FIT_METHODS}")
+    return np.asarray(image, dtype=np.uint8)
+
+
+# The packaged zip of a decoding worker process
+decode_worker_state = dict()
+
+
+def init_decode_worker(packaged):
+    decode_worker_state['packaged'] = PackagedPatents(packaged)
+
+
+def decode_patent_images(job):
+    '''Decode the drawings of a patent. Runs in the worker processes. Returns the index of the first image of the
+    patent in the store and the decoded images, None for the ones which couldn't be decoded.'''
+    patent_number, first_index, size, fit = job
+    decoded = []
+    for image_name, image_bytes in decode_worker_state['packaged'].images(patent_number):
+        if not is_drawing(image_name):
+            continue
+        try:
+            decoded.append(decode_image(image_bytes, size=size, fit=fit))
+        except (OSError, ValueError):
+            decoded.append(None)
+    return first_index, decoded
+
+
+def write_image_store(store_dir: Path, packaged: Path, size=DEFAULT_SIZE, fit='crop', workers=1):
+    '''Decode the drawings of a packaged zip into a store. Like the embedding stores, the store is written to a
+    temporary directory which replaces any earlier store when it's complete.'''
+    with PackagedPatents(packaged) as packaged_patents:
+        patent_numbers = []
+        image_names = []
+        jobs = []
+        for patent_number in packaged_patents.patent_numbers:
+            drawing_names = [image_name for image_name in packaged_patents.image_names(patent_number) if is_drawing(image_name)]
+            if drawing_names:
+                jobs.append((patent_number, len(patent_numbers), size, fit))
+                patent_numbers.extend([patent_number]*len(drawing_names))
+                image_names.extend(drawing_names)
+    n_images = len(patent_numbers)
+
+    part_dir = store_dir.with_name(store_dir.name + '.part')
+    if part_dir.exists():
+        shutil.rmtree(part_dir)
+    part_dir.mkdir(parents=True)
+    np.save(part_dir / 'patent_numbers.npy', np.array(patent_numbers, dtype=str))
+    np.save(part_dir / 'image_names.npy', np.array(image_names, dtype=str))
+    images = np.lib.format.open_memmap(part_dir / 'images.npy', mode='w+', dtype=np.uint8, shape=(n_images, size, size))
+    decoded = np.zeros(n_images, dtype=bool)
+
+    with Pool(workers, initializer=init_decode_worker, initargs=(packaged,)) as pool:
+        for first_index, patent_images in tqdm(pool.imap_unordered(decode_patent_images, jobs, chunksize=8),
+                                               desc='Decoding images', total=len(jobs)):
+            for i, image in enumerate(patent_images, start=first_index):
+                if image is None:
+                    images[i] = 255
+                else:
+                    images[i] = image
+                    decoded[i] = True
+    images.flush()
+    del images
+    np.save(part_dir / 'decoded.npy', decoded)
+    n_failed = int(n_images - decoded.sum())
+    with open(part_dir / STORE_META, 'w') as fp:
+        json.dump({'n_images': n_images, 'size': size, 'fit': fit, 'n_failed': n_failed}, fp)
+
+    if store_dir.exists():
+        shutil.rmtree(store_dir)
+    os.replace(part_dir, store_dir)
+    return n_images, n_failed
+
+
+class ImageStore:
+    def __init__(self, store_dir: Path):
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir / STORE_META) as fp:
+            meta = json.load(fp)
+        self.n_images = meta['n_images']
+        self.size = meta['size']
+        self.fit = meta['fit']
+        self.images = np.load(self.store_dir / 'images.npy', mmap_mode='r')
+        self.patent_numbers = np.load(self.store_dir / 'patent_numbers.npy')
+        self.image_names = np.load(self.store_dir / 'image_names.npy')
+        self.decoded = np.load(self.store_dir / 'decoded.npy')
+
+    def __len__(self):
+        return self.n_images
+
+    def image_range(self, patent_number):
+        '''The begin and end index of the images of a patent'''
+        begin = int(np.searchsorted(self.patent_numbers, patent_number, side='left'))
+        end = int(np.searchsorted(self.patent_numbers, patent_number, side='right'))
+        return begin, end
+
+    def patent_images(self, patent_number):
+        '''The decoded images of a patent, as a (n_images, size, size) array'''
+        begin, end = self.image_range(patent_number)
+        return self.images[begin:end][self.decoded[begin:end]]
+
+    def patents(self):
+        '''The patents which have images, in the order of the store'''
+        patent_numbers, first_indices = np.unique(self.patent_numbers, return_index=True)
+        return patent_numbers[np.argsort(first_indices)].tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode the drawings of packaged patent zips into image stores")
+    parser.add_argument('packaged', help="Packaged patent zips", nargs='+', type=Path)
+    parser.add_argument('--output-dir', help="Directory to write the stores to, named like '{zip name}_images'",
+                        type=Path, default=Path())
+    parser.add_argument('--size', help="Width and height of the stored images", type=int, default=DEFAULT_SIZE)
+    parser.add_argument('--fit', help="How to make the images square. 'crop' keeps the middle like the CLIP "
+                        "preprocessing, 'pad' keeps the whole drawing", choices=FIT_METHODS, default='crop')
+    parser.add_argument('--workers', help="Number of processes decoding images", type=int, default=1)
+    args = parser.parse_args()
+
+    for packaged in args.packaged:
+        store_dir = args.output_dir / f'{packaged.with_suffix("").name}_images'
+        n_images, n_failed = write_image_store(store_dir, packaged, size=args.size, fit=args.fit, workers=args.workers)
+        print(f"Wrote {n_images} images of {packaged} to {store_dir}, {n_failed} could not be decoded")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""Cross-validated KNN classification for a whole range of k, computing the neighbours of each fold once.
+
+knn_classify in notebooks/patent_classification.ipynb fits a KNeighborsClassifier and runs cross_validate for each k,
+which computes all the distances between the test and training patents for every k and fold. Here the k_max nearest
+training patents of each test patent are found once per fold, and since the k nearest neighbours are the first k of
+them, the votes for every k are the cumulative sums of the neighbour labels. The folds, distances, votes and scores
+are the same as with sklearn, so the results are the same as knn_classify:
+
+    k_range, precision, recall, f1 = knn_classify(X, y)
+
+X can be a dense array or a scipy sparse matrix, like the TF-IDF features in the notebook.
+
+The one exception is when training patents are at exactly the same distance from a test patent and only some of them
+are among its k nearest (e.g. with duplicated vectors). Here the first of them in the training data are taken, while
+which of them sklearn takes depends on how it splits up the distance computation, and can differ between values of k.
+
+The script evaluates embedding stores, with the patents of the positive stores as label 1:
+
+    python scripts/knn_evaluation.py --positive patent_sbert/patent_sbert_english_netto_list --negative patent_sbert/patent_sbert_complement_english --kinds abstract claims
+"""
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse
+from sklearn.model_selection import StratifiedKFold, cross_validate
+from sklearn.neighbors import KNeighborsClassifier
+
+from embedding_store import EmbeddingStore
+
+
+# Number of test vectors whose distances to the training vectors are computed at a time
+BLOCK_SIZE = 1024
+
+
+def as_float64(X):
+    if scipy.sparse.issparse(X):
+        return scipy.sparse.csr_matrix(X, dtype=np.float64)
+    return np.asarray(X, dtype=np.float64)
+
+
+def squared_row_norms(X):
+    if scipy.sparse.issparse(X):
+        return np.asarray(X.multiply(X).sum(axis=1)).ravel()
+    return np.einsum('ij,ij->i', X, X)
+
+
+def nearest_neighbours(X_train, X_test, k, block_size=BLOCK_SIZE):
+    '''The indices of the k nearest training vectors of each test vector by euclidean distance, nearest first.
+    Like KNeighborsClassifier, the squared distances are computed in float64 from the norms and a matrix product.
+    Of exactly equally distant vectors the one first in X_train is nearer. The vectors can be dense or sparse
+    matrices, the distances of a block are always dense.'''
+    X_train = as_float64(X_train)
+    X_test = as_float64(X_test)
+    k = min(k, X_train.shape[0])
+    train_norms = squared_row_norms(X_train)
+    neighbours = np.empty((X_test.shape[0], k), dtype=np.int64)
+    for start in range(0, X_test.shape[0], block_size):
+        block = X_test[start:start+block_size]
+        products = block @ X_train.T
+        if scipy.sparse.issparse(products):
+            products = products.toarray()
+        distances = (-2 * products + squared_row_norms(block)[:, None]) + train_norms[None, :]
+        # The k-th smallest distance of each row, everything up to it are the candidates, ties included
+        thresholds = np.partition(distances, k-1, axis=1)[:, k-1]
+        for i, (row, threshold) in enumerate(zip(distances, thresholds)):
+            candidates = np.flatnonzero(row <= threshold)
+            neighbours[start+i] = candidates[np.argsort(row[candidates], kind='stable')[:k]]
+    return neighbours
+
+
+def sweep_predictions(neighbour_labels, n_classes):
+    '''The predicted class index of each test vector for every k from 1 to the number of neighbours, as a
+    (n_test, k_max) array. neighbour_labels are the class indices of the neighbours, nearest first. A tied vote goes
+    to the lowest class, like KNeighborsClassifier.'''
+    votes = np.cumsum(neighbour_labels[:, :, None] == np.arange(n_classes)[None, None, :], axis=1)
+    return np.argmax(votes, axis=2)
+
+
+def binary_scores(y_true, y_pred):
+    '''Precision, recall and F1 of the positive class 1 for each column of y_pred, 0 where they're undefined like
+    the sklearn scores'''
+    true_positives = np.sum((y_pred == 1) & (y_true[:, None] == 1), axis=0)
+    predicted_positives = np.sum(y_pred == 1, axis=0)
+    actual_positives = np.sum(y_true == 1)
+    precision = np.where(predicted_positives > 0, true_positives / np.maximum(predicted_positives, 1), 0.)
+    recall = true_positives / actual_positives if actual_positives > 0 else np.zeros(len(true_positives))
+    f1 = np.where(predicted_positives + actual_positives > 0,
+                  2 * true_positives / np.maximum(predicted_positives + actual_positives, 1), 0.)
+    return precision, recall, f1
+
+
+def knn_sweep(X, y, k_values, num_splits=5, block_size=BLOCK_SIZE):
+    '''The precision, recall and F1 of each fold for each k, as (num_splits, len(k_values)) arrays. The folds are
+    those of cross_validate(cv=num_splits) for a classifier, StratifiedKFold without shuffling.'''
+    X = as_float64(X)
+    y = np.asarray(y)
+    classes, y_classes = np.unique(y, return_inverse=True)
+    k_values = np.asarray(k_values)
+    scores = {'precision': [], 'recall': [], 'f1': []}
+    for train_index, test_index in StratifiedKFold(n_splits=num_splits).split(X, y):
+        neighbours = nearest_neighbours(X[train_index], X[test_index], int(k_values.max()), block_size=block_size)
+        predictions = sweep_predictions(y_classes[train_index][neighbours], len(classes))
+        y_pred = classes[predictions[:, k_values - 1]]
+        for name, fold_scores in zip(('precision', 'recall', 'f1'), binary_scores(y[test_index], y_pred)):
+            scores[name].append(fold_scores)
+    return {name: np.array(fold_scores) for name, fold_scores in scores.items()}
+
+
+def knn_classify(X, y, k_min=1, k_max=49, k_step=2, num_splits=5):
+    '''Drop-in replacement of knn_classify in the classification notebook'''
+    k_range = range(k_min, k_max+k_step, k_step)
+    scores = knn_sweep(X, y, list(k_range), num_splits=num_splits)
+    return k_range, scores['precision'].mean(axis=0).tolist(), scores['recall'].mean(axis=0).tolist(), scores['f1'].mean(axis=0).tolist()
+
+
+def sklearn_knn_classify(X, y, k_range, num_splits=5):
+    '''The scores as computed by the notebook, one cross_validate per k, to check the results against'''
+    precision, recall, f1 = [], [], []
+    for k in k_range:
+        scores = cross_validate(KNeighborsClassifier(n_neighbors=k), X, y, cv=num_splits, scoring=["precision", "recall", "f1"])
+        precision.append(np.mean(scores["test_precision"]))
+        recall.append(np.mean(scores["test_recall"]))
+        f1.append(np.mean(scores["test_f1"]))
+    return precision, recall, f1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cross-validate KNN classification of embedding stores for a range of k")
+    parser.add_argument('--positive', help="Embedding stores of the positive class", nargs='+', type=Path, required=True)
+    parser.add_argument('--negative', help="Embedding stores of the negative class", nargs='+', type=Path, required=True)
+    parser.add_argument('--kinds', help="Kinds of vectors to concatenate, e.g. abstract claims", nargs='+', required=True)
+    parser.add_argument('--k-min', type=int, default=1)
+    parser.add_argument('--k-max', type=int, default=49)
+    parser.add_argument('--k-step', type=int, default=2)
+    parser.add_argument('--num-splits', type=int, default=5)
+    parser.add_argument('--check', help="Also run the sklearn cross-validation for each k and compare the scores", action='store_true')
+    args = parser.parse_args()
+
+    positive = [EmbeddingStore(store_dir) for store_dir in args.positive]
+    negative = [EmbeddingStore(store_dir) for store_dir in args.negative]
+    X = np.concatenate([store.matrix(args.kinds) for store in positive + negative])
+    y = np.concatenate([np.full(len(store), 1) for store in positive] + [np.full(len(store), 0) for store in negative])
+    print(f"{len(y)} examples in total, {int(y.sum())} positive")
+
+    start = time.perf_counter()
+    k_range, precision, recall, f1 = knn_classify(X, y, k_min=args.k_min, k_max=args.k_max, k_step=args.k_step, num_splits=args.num_splits)
+    print(f"Evaluated {len(k_range)} values of k in {time.perf_counter() - start:.1f}s")
+    print(f"{'k':>4} {'precision':>10} {'recall':>10} {'f1':>10}")
+    for k, k_precision, k_recall, k_f1 in zip(k_range, precision, recall, f1):
+        print(f"{k:>4} {k_precision:>10.4f} {k_recall:>10.4f} {k_f1:>10.4f}")
+
+    if args.check:
+        start = time.perf_counter()
+        sklearn_scores = sklearn_knn_classify(X, y, k_range, num_splits=args.num_splits)
+        print(f"sklearn took {time.perf_counter() - start:.1f}s")
+        differences = [np.max(np.abs(np.array(scores) - np.array(sklearn_k_scores)))
+                       for scores, sklearn_k_scores in zip((precision, recall, f1), sklearn_scores)]
+        print(f"Largest difference from sklearn: {max(differences):.2e}")
+
+
+if __name__ == '__main__':
+    main()
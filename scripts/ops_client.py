@@ -0,0 +1,171 @@
+"""Client side throttling for the EPO Open Patent Services, driven by the X-Throttling-Control header.
+
+Each OPS response has a header like
+    X-Throttling-Control: busy (images=green:100, inpadoc=green:45, other=green:1000, retrieval=green:100, search=green:15)
+where the color is the throttling state of each service and the number is how many requests per minute we are
+allowed to make to it right now. A black service is blocked, and requests to it are rejected with a
+Retry-After header (in milliseconds) until it opens up again."""
+import functools
+import re
+import threading
+import time
+from collections import Counter
+
+import requests
+
+
+THROTTLING_SERVICE_PATTERN = re.compile(r'(\w+)=(\w+):(\d+)')
+# Used until we've seen a throttling header for the service
+DEFAULT_REQUESTS_PER_MINUTE = 10
+# How long to wait on a black service if the response doesn't say
+DEFAULT_BLACK_WAIT = 60
+# Which OPS service each of the epo_ops.Client methods count towards
+CLIENT_METHOD_SERVICES = {
+    'published_data_search': 'search',
+    'published_data': 'retrieval',
+    'image': 'images',
+    'family': 'inpadoc',
+    'legal': 'inpadoc',
+}
+
+
+def parse_throttling_control(header):
+    '''Parse an X-Throttling-Control header. Returns the system state (e.g. 'idle', 'busy' or 'overloaded')
+    and a dict mapping services to (color, requests_per_minute) tuples.'''
+    system_state = header.split('(')[0].strip()
+    services = {service: (color.lower(), int(n_requests)) for service, color, n_requests in THROTTLING_SERVICE_PATTERN.findall(header)}
+    return system_state, services
+
+
+def retry_after_seconds(headers):
+    '''OPS gives Retry-After in milliseconds'''
+    retry_after = headers.get('retry-after')
+    if retry_after is None:
+        return None
+    return int(retry_after) / 1000
+
+
+def is_rejection(response):
+    '''Whether a response is OPS refusing the request because of throttling, rather than an error for the request
+    itself (like a missing document)'''
+    return response is not None and 'x-rejection-reason' in response.headers
+
+
+def set_ops_url(client, ops_url):
+    '''Point a client at another OPS server, e.g. a local mock server'''
+    client.__auth_url__ = f'{ops_url}/auth/accesstoken'
+    client.__service_url_prefix__ = f'{ops_url}/rest-services'
+
+
+class ThrottleBudget:
+    '''A token bucket per OPS service, shared by all threads making requests. The rate of each bucket is set
+    from the throttling headers of the responses, so the budget follows what OPS currently allows. Services which
+    are black, or for which a request was rejected, are blocked for exactly the Retry-After time.'''
+    def __init__(self, default_rate=DEFAULT_REQUESTS_PER_MINUTE, burst=1, max_retries=10):
+        self.default_rate = default_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        # Waiting threads are woken up when new rates arrive, so they don't oversleep on an old rate
+        self.condition = threading.Condition()
+        self.rates = dict()
+        self.colors = dict()
+        self.tokens = dict()
+        self.last_refill = dict()
+        self.blocked_until = dict()
+        self.system_state = None
+        self.stats = Counter()
+
+    def _refill(self, service, now):
+        rate = self.rates.get(service, self.default_rate) / 60
+        last = self.last_refill.get(service, now)
+        tokens = self.tokens.get(service, self.burst) + (now - last) * rate
+        self.tokens[service] = min(tokens, self.burst)
+        self.last_refill[service] = now
+        return rate
+
+    def acquire(self, service):
+        '''Block until we're allowed to make a request to the service'''
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                blocked_until = self.blocked_until.get(service, 0)
+                if now < blocked_until:
+                    self.condition.wait(blocked_until - now)
+                    continue
+                rate = self._refill(service, now)
+                if self.tokens[service] >= 1:
+                    self.tokens[service] -= 1
+                    self.stats[f'{service}_requests'] += 1
+                    return
+                if rate > 0:
+                    wait_time = (1 - self.tokens[service]) / rate
+                else:
+                    wait_time = 1
+                self.condition.wait(wait_time)
+
+    def block(self, service, seconds):
+        with self.condition:
+            blocked_until = time.monotonic() + seconds
+            self.blocked_until[service] = max(self.blocked_until.get(service, 0), blocked_until)
+            self.condition.notify_all()
+
+    def update(self, headers):
+        '''Update the rates and colors from the headers of a response'''
+        header = headers.get('x-throttling-control')
+        if header is None:
+            return
+        system_state, services = parse_throttling_control(header)
+        retry_after = retry_after_seconds(headers)
+        with self.condition:
+            now = time.monotonic()
+            self.system_state = system_state
+            for service, (color, requests_per_minute) in services.items():
+                self._refill(service, now)
+                self.rates[service] = requests_per_minute
+                self.colors[service] = color
+                if color == 'black':
+                    wait_time = retry_after if retry_after is not None else DEFAULT_BLACK_WAIT
+                    self.blocked_until[service] = max(self.blocked_until.get(service, 0), now + wait_time)
+            self.condition.notify_all()
+
+    def call(self, service, fn, *args, **kwargs):
+        '''Make a request counted towards service when the budget allows it. If the request is rejected with a
+        Retry-After header, we wait exactly that long and try again, up to max_retries times. Without a Retry-After
+        header we wait DEFAULT_BLACK_WAIT seconds.'''
+        for attempt in range(self.max_retries + 1):
+            self.acquire(service)
+            try:
+                response = fn(*args, **kwargs)
+            except requests.HTTPError as e:
+                response = e.response
+                if response is None:
+                    raise
+                self.update(response.headers)
+                if not is_rejection(response) or attempt == self.max_retries:
+                    raise
+                retry_after = retry_after_seconds(response.headers)
+                self.stats[f'{service}_rejections'] += 1
+                self.block(service, retry_after if retry_after is not None else DEFAULT_BLACK_WAIT)
+                continue
+            self.update(response.headers)
+            return response
+
+    def summary(self):
+        colors = ', '.join(f'{service}={color}:{self.rates[service]}' for service, color in sorted(self.colors.items()))
+        counts = ', '.join(f'{name}={count}' for name, count in sorted(self.stats.items()))
+        return f'OPS state {self.system_state} ({colors}), {counts}'
+
+
+class ThrottledClient:
+    '''Wraps an epo_ops.Client so that each request is paced by a ThrottleBudget, which can be shared between
+    several clients. Use it with a client without the Throttler middleware.'''
+    def __init__(self, client, budget=None):
+        self.client = client
+        self.budget = budget if budget is not None else ThrottleBudget()
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        service = CLIENT_METHOD_SERVICES.get(name, 'other')
+        return functools.partial(self.budget.call, service, attr)
@@ -0,0 +1,131 @@
+"""Helpers for the OPS published data search, with a persistent cache of result counts and result pages.
+
+The cache is keyed by the normalized CQL query, so restarted runs and overlapping searches reuse the
+counts and pages fetched earlier instead of asking OPS again. Entries older than the TTL are fetched again."""
+import datetime
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+
+CACHE_SCHEMA = ['''CREATE TABLE IF NOT EXISTS counts (
+    query TEXT PRIMARY KEY,
+    total_count INTEGER NOT NULL,
+    fetched_at REAL NOT NULL
+)''', '''CREATE TABLE IF NOT EXISTS pages (
+    query TEXT NOT NULL,
+    range_begin INTEGER NOT NULL,
+    range_end INTEGER NOT NULL,
+    documents TEXT NOT NULL,
+    total_count INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (query, range_begin, range_end)
+)''']
+
+
+def extract_patents(query_response):
+    docs = query_response['ops:world-patent-data']['ops:biblio-search']['ops:search-result']['ops:publication-reference']
+    if not isinstance(docs, list):
+        # In the rare case that we get a single result, it's not returned as a JSON array, but as a singleton object
+        docs = [docs]
+    document_ids = []
+    for doc in docs:
+        document_id = doc['document-id']
+        country = document_id['country']['$']
+        doc_number = document_id['doc-number']['$']
+        kind_code = document_id['kind']['$']
+        doc_str = f'{country}{doc_number}.{kind_code}'
+        document_ids.append(doc_str)
+    return document_ids
+
+
+def total_result_count(query_response):
+    return int(query_response['ops:world-patent-data']['ops:biblio-search']['@total-result-count'])
+
+
+def normalize_cql(cql):
+    '''Normalize the query so that trivially different ways of writing it share cache entries'''
+    cql = ' '.join(cql.split())
+    cql = re.sub(r'\s*=\s*', '=', cql)
+    cql = re.sub(r'\b(and|or|not|prox)\b', lambda m: m.group(1).lower(), cql, flags=re.IGNORECASE)
+    return cql
+
+
+class SearchCache:
+    def __init__(self, cache_path, ttl=datetime.timedelta(days=30)):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        # The cache is shared between threads, all access goes through the lock
+        self.connection = sqlite3.connect(str(cache_path), check_same_thread=False)
+        with self.connection:
+            for statement in CACHE_SCHEMA:
+                self.connection.execute(statement)
+
+    def _oldest_valid(self):
+        return time.time() - self.ttl.total_seconds()
+
+    def get_count(self, cql):
+        with self.lock:
+            row = self.connection.execute('SELECT total_count FROM counts WHERE query = ? AND fetched_at >= ?',
+                                          (normalize_cql(cql), self._oldest_valid())).fetchone()
+            self.stats['count_hits' if row is not None else 'count_misses'] += 1
+        return row[0] if row is not None else None
+
+    def set_count(self, cql, total_count):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO counts (query, total_count, fetched_at) VALUES (?, ?, ?)',
+                                    (normalize_cql(cql), total_count, time.time()))
+
+    def get_page(self, cql, range_begin, range_end):
+        with self.lock:
+            row = self.connection.execute('SELECT documents, total_count FROM pages WHERE query = ? AND range_begin = ? AND range_end = ? AND fetched_at >= ?',
+                                          (normalize_cql(cql), range_begin, range_end, self._oldest_valid())).fetchone()
+            self.stats['page_hits' if row is not None else 'page_misses'] += 1
+        return (json.loads(row[0]), row[1]) if row is not None else None
+
+    def set_page(self, cql, range_begin, range_end, documents, total_count):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO pages (query, range_begin, range_end, documents, total_count, fetched_at) VALUES (?, ?, ?, ?, ?, ?)',
+                                    (normalize_cql(cql), range_begin, range_end, json.dumps(documents), total_count, time.time()))
+
+    def summary(self):
+        return ', '.join(f'{name}={count}' for name, count in sorted(self.stats.items()))
+
+    def close(self):
+        self.connection.close()
+
+
+def search_count(client, cql, cache: SearchCache = None):
+    '''Return the total number of results of a query'''
+    if cache is not None:
+        total_count = cache.get_count(cql)
+        if total_count is not None:
+            return total_count
+    req = client.published_data_search(cql, range_begin=1, range_end=2)  # We limit the range to limit how much date we request
+    query_response = json.loads(req.content)
+    total_count = total_result_count(query_response)
+    if cache is not None:
+        cache.set_count(cql, total_count)
+    return total_count
+
+
+def search_page(client, cql, range_begin, range_end, cache: SearchCache = None):
+    '''Return the documents in the given (1-based, inclusive) range of results of a query,
+    together with the total number of results of the query'''
+    if cache is not None:
+        page = cache.get_page(cql, range_begin, range_end)
+        if page is not None:
+            return page
+    req = client.published_data_search(cql, range_begin=range_begin, range_end=range_end)
+    query_response = json.loads(req.content)
+    documents = extract_patents(query_response)
+    total_count = total_result_count(query_response)
+    if cache is not None:
+        cache.set_page(cql, range_begin, range_end, documents, total_count)
+        # Every page tells us the total count as well, so we get it for free
+        cache.set_count(cql, total_count)
+    return documents, total_count
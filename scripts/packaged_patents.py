@@ -0,0 +1,276 @@
+"""A reader (and the writer of the columnar format) of the packaged patent zips made by extract_and_package_patents.py.
+
+Opening a zip with ZipFile parses the whole central directory, and finding the members of a patent means splitting
+all the file names. The reader does this once and keeps an index of where the members of each patent are in the
+zip, in '{zip name}.index.json' beside it. The index is only rebuilt if the size or modification time of the zip
+changes. With the index, the patent info of a patent is read with a seek and a single read, so patents can be read in
+any order, and the records are yielded one at a time instead of loading the whole zip into memory.
+
+    with PackagedPatents('packaged_patents/english_netto_list.zip') as packaged:
+        for record in packaged.records(fields=('publication_date', 'ipc_classes')):
+            ...
+        patent_info = packaged['EP1234567.A1']
+
+There are two formats of packaged zips. In the original one, each patent has a pretty printed 'patent_info.json' with
+all its fields and texts. In the columnar format, the short fields of all patents (dates, classes, applicants, ...)
+are columns in a single 'columns/metadata.json', and the texts of each section are in one member per section,
+'columns/{section}.zlib', where the section of each patent is compressed on its own. The section members are stored
+without zip compression, so the text of a patent is read directly at its offset. Reading the classes or dates of all
+patents then doesn't touch the texts at all. In both formats the images are stored as '{patent}/{image name}.tif'.
+"""
+import json
+import os
+import shutil
+import struct
+import zipfile
+import zlib
+from collections import defaultdict
+from pathlib import Path
+
+
+INDEX_VERSION = 2
+# The local file header in front of each member, see the zip specification. The name and extra field lengths
+# are the last two fields, and the member data follows the header, name and extra field.
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+LOCAL_HEADER_SIGNATURE = b'PK\003\004'
+PATENT_INFO_NAME = 'patent_info.json'
+COLUMNS_DIR = 'columns'
+METADATA_NAME = 'metadata.json'
+COLUMNAR_VERSION = 1
+TEXT_SECTIONS = ('abstract', 'claims', 'description')
+
+
+def index_path_of(packaged: Path):
+    return packaged.with_name(packaged.name + '.index.json')
+
+
+def member_entry(info: zipfile.ZipInfo):
+    return [info.filename, info.header_offset, info.compress_type, info.compress_size, info.file_size]
+
+
+def build_index(packaged: Path):
+    '''Return the index of a zip: its format, the entries of the column members (for the columnar format) and a
+    dict from patent numbers to the entries of their patent info (for the json format) and images'''
+    patents = defaultdict(lambda: {'info': None, 'images': []})
+    columns = dict()
+    with zipfile.ZipFile(packaged) as z:
+        for info in z.infolist():
+            directory, filename = info.filename.split('/')
+            if directory == COLUMNS_DIR:
+                columns[filename] = member_entry(info)
+            elif filename == PATENT_INFO_NAME:
+                patents[directory]['info'] = member_entry(info)
+            elif filename.endswith('.tif'):
+                patents[directory]['images'].append(member_entry(info))
+        if columns:
+            # The patents of the columnar format are the rows of the metadata, whether they have images or not
+            metadata = json.loads(z.read(f'{COLUMNS_DIR}/{METADATA_NAME}'))
+            for patent_number in metadata['columns']['patent_number']:
+                patents[patent_number]
+    return {'format': 'columnar' if columns else 'json', 'columns': columns, 'patents': dict(sorted(patents.items()))}
+
+
+def load_index(packaged: Path, index_path: Path = None):
+    '''Load the index of a packaged zip, building it if it's missing or out of date. The index is written beside
+    the zip if possible, if not it's just rebuilt the next time.'''
+    if index_path is None:
+        index_path = index_path_of(packaged)
+    stat = packaged.stat()
+    if index_path.exists():
+        with open(index_path) as fp:
+            index = json.load(fp)
+        if index['version'] == INDEX_VERSION and index['size'] == stat.st_size and index['mtime_ns'] == stat.st_mtime_ns:
+            return index
+    index = dict(build_index(packaged), version=INDEX_VERSION, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    part_path = index_path.with_name(index_path.name + '.part')
+    try:
+        with open(part_path, 'w') as fp:
+            json.dump(index, fp)
+        os.replace(part_path, index_path)
+    except OSError as e:
+        print(f"Could not write the index of {packaged}: {e}")
+    return index
+
+
+def compress_section(section):
+    '''Compress a section of the patent info (a dict from languages to texts) for the columnar format'''
+    return zlib.compress(json.dumps(section, sort_keys=True).encode('utf8'))
+
+
+class ColumnarWriter:
+    '''Collects the fields and compressed sections of the patents of a columnar zip. The sections are written to
+    temporary files until close(), which adds them and the metadata to the zip.'''
+    def __init__(self, patents_fp: zipfile.ZipFile, write_member, temp_dir: Path):
+        self.patents_fp = patents_fp
+        self.write_member = write_member
+        self.columns = defaultdict(list)
+        self.section_paths = {section: temp_dir / f'{section}.zlib' for section in TEXT_SECTIONS}
+        self.section_fps = {section: open(path, 'wb') for section, path in self.section_paths.items()}
+        self.section_offsets = {section: [0] for section in TEXT_SECTIONS}
+
+    def add(self, fields, compressed_sections):
+        '''Add a patent, given as its patent info without the text sections and the compressed sections'''
+        self.columns['patent_number'].append(fields['document_number'])
+        for field, value in fields.items():
+            self.columns[field].append(value)
+        for section in TEXT_SECTIONS:
+            self.section_fps[section].write(compressed_sections[section])
+            offsets = self.section_offsets[section]
+            offsets.append(offsets[-1] + len(compressed_sections[section]))
+
+    def close(self):
+        for section, path in self.section_paths.items():
+            self.section_fps[section].close()
+            # The sections are already compressed, and stored members can be read at an offset
+            zinfo = zipfile.ZipInfo(f'{COLUMNS_DIR}/{section}.zlib', date_time=(1980, 1, 1, 0, 0, 0))
+            zinfo.external_attr = 0o644 << 16
+            zinfo.compress_type = zipfile.ZIP_STORED
+            with open(path, 'rb') as src, self.patents_fp.open(zinfo, 'w', force_zip64=True) as dst:
+                shutil.copyfileobj(src, dst)
+            path.unlink()
+        metadata = {'version': COLUMNAR_VERSION, 'columns': self.columns, 'section_offsets': self.section_offsets}
+        self.write_member(self.patents_fp, f'{COLUMNS_DIR}/{METADATA_NAME}', json.dumps(metadata, separators=(',', ':')))
+
+
+class PackagedPatents:
+    def __init__(self, packaged, index_path=None):
+        self.packaged = Path(packaged)
+        index = load_index(self.packaged, index_path)
+        self.format = index['format']
+        self.index = index['patents']
+        self.column_entries = index['columns']
+        if self.format == 'columnar':
+            self.patent_numbers = list(self.index)
+        else:
+            self.patent_numbers = [patent_number for patent_number, entries in self.index.items() if entries['info'] is not None]
+        self._fp = open(self.packaged, 'rb')
+        # Only used for members which are neither stored nor deflated
+        self._zip = None
+        self._metadata = None
+        self._rows = None
+        self._data_offsets = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._fp.close()
+        if self._zip is not None:
+            self._zip.close()
+
+    def __len__(self):
+        return len(self.patent_numbers)
+
+    def __contains__(self, patent_number):
+        return patent_number in self.index
+
+    def __iter__(self):
+        return iter(self.patent_numbers)
+
+    def __getitem__(self, patent_number):
+        '''The full patent info of a patent'''
+        return self.patent_info(patent_number)
+
+    def _data_offset(self, entry):
+        '''The offset of the data of a member in the zip, after its local header'''
+        name, header_offset = entry[:2]
+        if name not in self._data_offsets:
+            self._fp.seek(header_offset)
+            header = LOCAL_HEADER.unpack(self._fp.read(LOCAL_HEADER.size))
+            if header[0] != LOCAL_HEADER_SIGNATURE:
+                raise zipfile.BadZipFile(f"Bad local header of {name} in {self.packaged}, the index may be out of date")
+            name_length, extra_length = header[-2:]
+            self._data_offsets[name] = header_offset + LOCAL_HEADER.size + name_length + extra_length
+        return self._data_offsets[name]
+
+    def _read_member(self, entry):
+        name, header_offset, compress_type, compress_size, file_size = entry
+        if compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            if self._zip is None:
+                self._zip = zipfile.ZipFile(self.packaged)
+            return self._zip.read(name)
+        self._fp.seek(self._data_offset(entry))
+        data = self._fp.read(compress_size)
+        if compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        if len(data) != file_size:
+            raise zipfile.BadZipFile(f"Member {name} of {self.packaged} has the wrong size")
+        return data
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = json.loads(self._read_member(self.column_entries[METADATA_NAME]))
+            self._rows = {patent_number: i for i, patent_number in enumerate(self._metadata['columns']['patent_number'])}
+        return self._metadata
+
+    def column(self, field):
+        '''Return the values of a field for all patents, in the order of patent_numbers. For the columnar format
+        this only reads the metadata, for the json format all the patent infos are read.'''
+        if self.format == 'columnar':
+            column = self.metadata['columns'][field]
+            return [column[self._rows[patent_number]] for patent_number in self.patent_numbers]
+        return [record[field] for record in self.records(fields=(field,))]
+
+    def _read_section(self, section, row):
+        offsets = self.metadata['section_offsets'][section]
+        entry = self.column_entries[f'{section}.zlib']
+        self._fp.seek(self._data_offset(entry) + offsets[row])
+        return json.loads(zlib.decompress(self._fp.read(offsets[row+1] - offsets[row])))
+
+    def _columnar_fields(self, patent_number, fields):
+        if patent_number not in self.index:
+            raise KeyError(patent_number)
+        columns = self.metadata['columns']
+        row = self._rows[patent_number]
+        if fields is None:
+            fields = [field for field in columns if field != 'patent_number'] + list(TEXT_SECTIONS)
+        return {field: self._read_section(field, row) if field in TEXT_SECTIONS else columns[field][row] for field in fields}
+
+    def patent_info(self, patent_number):
+        if self.format == 'columnar':
+            return self._columnar_fields(patent_number, None)
+        entry = self.index[patent_number]['info']
+        if entry is None:
+            raise KeyError(f"Patent {patent_number} has no {PATENT_INFO_NAME} in {self.packaged}")
+        return json.loads(self._read_member(entry))
+
+    def image_names(self, patent_number):
+        return [entry[0].split('/')[-1] for entry in self.index[patent_number]['images']]
+
+    def image(self, patent_number, image_name):
+        for entry in self.index[patent_number]['images']:
+            if entry[0].split('/')[-1] == image_name:
+                return self._read_member(entry)
+        raise KeyError(f"Patent {patent_number} has no image {image_name} in {self.packaged}")
+
+    def images(self, patent_number):
+        '''Return the (file name, bytes) pairs of the images of a patent, like patent_reader.read_images'''
+        return [(entry[0].split('/')[-1], self._read_member(entry)) for entry in self.index[patent_number]['images']]
+
+    def record(self, patent_number, fields=None, images=False):
+        '''Return a dict with the patent number and the given fields of the patent info (all of them if fields is
+        None). With images, the (file name, bytes) pairs of the images are included as 'images'. For the columnar
+        format, only the text sections among the fields are read.'''
+        record = {'patent_number': patent_number}
+        if self.format == 'columnar':
+            record.update(self._columnar_fields(patent_number, fields))
+        elif fields is None or fields:
+            patent_info = self.patent_info(patent_number)
+            if fields is None:
+                record.update(patent_info)
+            else:
+                record.update((field, patent_info[field]) for field in fields)
+        if images:
+            record['images'] = self.images(patent_number)
+        return record
+
+    def records(self, fields=None, images=False, patent_numbers=None):
+        '''Yield the records (see record()) of the given patents, or of all the patents in patent number order'''
+        if patent_numbers is None:
+            patent_numbers = self.patent_numbers
+        for patent_number in patent_numbers:
+            yield self.record(patent_number, fields=fields, images=images)
@@ -0,0 +1,148 @@
+"""A persistent SQLite index of the bibliographic data of downloaded patent zip-files.
+Each archive is only parsed again if its size or modification time has changed."""
+import json
+import sqlite3
+from multiprocessing import Pool
+from pathlib import Path
+
+from tqdm import tqdm
+
+from patent_reader import extract_patent_info, validate_patent_zip
+
+
+# Bumped when the entries are computed differently, so that indices of earlier versions are rebuilt. Version 2 checks
+# the CRC of all members for the broken flag, not just that the bibliographic data can be parsed, and keeps the reason
+# in validation_error.
+INDEX_VERSION = 2
+SCHEMA = '''CREATE TABLE IF NOT EXISTS patents (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    publication_date TEXT,
+    document_number TEXT,
+    ipc_classes TEXT,
+    applicants TEXT,
+    language TEXT,
+    broken INTEGER NOT NULL,
+    validation_error TEXT,
+    error TEXT
+)'''
+
+COLUMNS = ('path', 'directory', 'size', 'mtime_ns', 'publication_date', 'document_number',
+           'ipc_classes', 'applicants', 'language', 'broken', 'validation_error', 'error')
+
+
+def default_index_path(patent_directory):
+    return Path(patent_directory) / 'patent_index.sqlite'
+
+
+def open_index(index_path):
+    connection = sqlite3.connect(str(index_path))
+    version, = connection.execute('PRAGMA user_version').fetchone()
+    if version < INDEX_VERSION:
+        with connection:
+            connection.execute('DROP TABLE IF EXISTS patents')
+            connection.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+    connection.execute(SCHEMA)
+    connection.execute('CREATE INDEX IF NOT EXISTS patents_directory ON patents (directory)')
+    return connection
+
+
+def index_entry(patent_path):
+    '''Parse the bibliographic data of a single patent zip into a row of the index. Runs in worker processes.
+    Parsing only reads the XML up to the bibliographic data, so whether the archive is broken (e.g. a bad CRC in the
+    description or an image) is decided by validate_patent_zip, whose message is the validation_error.'''
+    stat = patent_path.stat()
+    row = dict(path=str(patent_path), directory=str(patent_path.parent), size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+               publication_date=None, document_number=None, ipc_classes=None, applicants=None, language=None,
+               broken=0, validation_error=None, error=None)
+    validation_error = validate_patent_zip(patent_path)
+    if validation_error is not None:
+        row['broken'] = 1
+        row['validation_error'] = validation_error
+    try:
+        patent_info = extract_patent_info(patent_path, fields_only=True)
+        row['publication_date'] = patent_info['publication_date']
+        row['document_number'] = patent_info['document_number']
+        row['ipc_classes'] = json.dumps(patent_info['ipc_classes'])
+        row['applicants'] = json.dumps(patent_info['applicants'])
+        row['language'] = patent_info['language']
+    except Exception as e:
+        row['error'] = repr(e)
+    return tuple(row[column] for column in COLUMNS)
+
+
+def refresh_index(connection, patent_directory, workers=1):
+    '''Bring the index up to date with the EP*.zip files in patent_directory. Only new or changed files
+    (by size and modification time) are parsed, and files which are no longer in the directory are
+    removed from the index. Returns the number of updated and removed entries.'''
+    patent_directory = Path(patent_directory).resolve()
+    indexed = {path: (size, mtime_ns) for path, size, mtime_ns in
+               connection.execute('SELECT path, size, mtime_ns FROM patents WHERE directory = ?', (str(patent_directory),))}
+
+    changed_paths = []
+    current_paths = set()
+    for patent_path in sorted(patent_directory.glob('EP*.zip')):
+        path = str(patent_path)
+        current_paths.add(path)
+        stat = patent_path.stat()
+        if indexed.get(path) != (stat.st_size, stat.st_mtime_ns):
+            changed_paths.append(patent_path)
+
+    removed_paths = [(path,) for path in indexed.keys() - current_paths]
+    with connection:
+        connection.executemany('DELETE FROM patents WHERE path = ?', removed_paths)
+
+    insert_sql = f'INSERT OR REPLACE INTO patents ({", ".join(COLUMNS)}) VALUES ({", ".join("?" for _ in COLUMNS)})'
+    if workers > 1 and len(changed_paths) > 1:
+        with Pool(workers) as pool:
+            rows = pool.imap_unordered(index_entry, changed_paths, chunksize=16)
+            _insert_rows(connection, insert_sql, rows, len(changed_paths))
+    else:
+        _insert_rows(connection, insert_sql, map(index_entry, changed_paths), len(changed_paths))
+    return len(changed_paths), len(removed_paths)
+
+
+def _insert_rows(connection, insert_sql, rows, total, commit_every=1000):
+    # We commit regularly so that an interrupted refresh still keeps most of its work
+    batch = []
+    for row in tqdm(rows, desc='Indexing patent files', total=total, leave=False):
+        batch.append(row)
+        if len(batch) >= commit_every:
+            with connection:
+                connection.executemany(insert_sql, batch)
+            batch = []
+    with connection:
+        connection.executemany(insert_sql, batch)
+
+
+def indexed_patents(connection, patent_directory):
+    '''Return the indexed entries of patent_directory as dicts. The IPC classes are given as
+    (main_class, sub_class) tuples, like extract_patent_info does.'''
+    patent_directory = Path(patent_directory).resolve()
+    cursor = connection.execute(f'SELECT {", ".join(COLUMNS)} FROM patents WHERE directory = ? ORDER BY path',
+                                (str(patent_directory),))
+    entries = []
+    for row in cursor:
+        entry = dict(zip(COLUMNS, row))
+        entry['path'] = Path(entry['path'])
+        if entry['ipc_classes'] is not None:
+            entry['ipc_classes'] = [tuple(ipc_class) for ipc_class in json.loads(entry['ipc_classes'])]
+        if entry['applicants'] is not None:
+            entry['applicants'] = json.loads(entry['applicants'])
+        entry['broken'] = bool(entry['broken'])
+        entries.append(entry)
+    return entries
+
+
+def load_index(patent_directory, index_path=None, workers=1):
+    '''Refresh the index of patent_directory and return its entries'''
+    if index_path is None:
+        index_path = default_index_path(patent_directory)
+    connection = open_index(index_path)
+    try:
+        refresh_index(connection, patent_directory, workers=workers)
+        return indexed_patents(connection, patent_directory)
+    finally:
+        connection.close()
@@ -0,0 +1,151 @@
+"""Functions for reading the patent zip-files downloaded from the European Publication Server.
+Shared by the scripts which parse the downloaded archives."""
+import zlib
+import zipfile
+from zipfile import ZipFile
+import xml.etree.ElementTree as ET
+
+
+def find_document_xml(patent_zip, patent_path):
+    filenames = [zipinfo.filename for zipinfo in patent_zip.infolist()]
+    # We're just assuming the only XML apart from TOC.xml is the one we're looking for
+    # Since the name of this document is based on the application number, not the
+    # publication number, we have to scan for it manually
+    doc_xml = None
+    for filename in filenames:
+        *base, ext = filename.split('.')
+        if ext == 'xml' and filename.lower() != 'toc.xml':
+            doc_xml = filename
+    if doc_xml is None:
+        raise ValueError(f"Unable to find document xml for zipfile {patent_path}")
+    return doc_xml
+
+
+def parse_patent_xml(patent_zip, patent_path):
+    doc_xml = find_document_xml(patent_zip, patent_path)
+    with patent_zip.open(doc_xml) as patent_xml_fp:
+        # ElementTree handles the encoding declaration itself, so there's no need to decode to a str first
+        return ET.fromstring(patent_xml_fp.read())
+
+
+def parse_bibliographic_xml(patent_zip, patent_path):
+    '''Incrementally parse the document XML up to the end of the SDOBI element.
+    Returns the attributes of the root element and the SDOBI element.'''
+    doc_xml = find_document_xml(patent_zip, patent_path)
+    with patent_zip.open(doc_xml) as patent_xml_fp:
+        root_attrib = None
+        for event, element in ET.iterparse(patent_xml_fp, events=('start', 'end')):
+            if root_attrib is None:
+                root_attrib = dict(element.attrib)
+            elif event == 'end' and element.tag == 'SDOBI':
+                # The bibliographic data comes before the abstract, description and claims,
+                # so we don't need to parse any further
+                return root_attrib, element
+    raise ValueError(f"Unable to find bibliographic data in zipfile {patent_path}")
+
+
+def validate_patent_zip(patent_path):
+    '''Check that a downloaded patent zip is complete without parsing the XML. The central directory has to be
+    readable, all members have to pass the CRC check and there has to be a document XML.
+    Returns None if the archive is fine, otherwise a description of what is wrong with it.'''
+    try:
+        with ZipFile(patent_path) as patent_zip:
+            bad_member = patent_zip.testzip()
+            if bad_member is not None:
+                return f"Bad CRC for member {bad_member}"
+            find_document_xml(patent_zip, patent_path)
+    except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+        return f"Bad zip file: {e}"
+    except ValueError as e:
+        return str(e)
+    return None
+
+
+def read_images(patent_zip):
+    images = []
+    for fileinfo in patent_zip.infolist():
+        *parents, filename = fileinfo.filename.split('/')
+        *baseparts, ext = filename.split('.')
+        if ext == 'tif':
+            with patent_zip.open(fileinfo) as fp:
+                image = fp.read()
+                images.append((filename, image))
+    return images
+
+
+def load_patent_xml(patent_path):
+    with ZipFile(patent_path) as patent_zip:
+        return parse_patent_xml(patent_zip, patent_path)
+
+
+def load_images(patent_path):
+    with ZipFile(patent_path) as patent_zip:
+        return read_images(patent_zip)
+
+
+def numbered_text(paragraph):
+    text = ''
+    if 'num' in paragraph.attrib:
+        num = paragraph.attrib['num']
+        text = f'[{num}] '
+    text += ''.join(paragraph.itertext())
+    return text
+
+
+def get_texts(elements):
+    text_dict = {}
+
+    for element in elements:
+        lang = element.attrib['lang']
+        texts = '\n'.join(numbered_text(c) for c in element)
+        text_dict[lang] = texts
+    return text_dict
+
+
+def bibliographic_info(root_attrib, sdobi):
+    patent_info = dict()
+    # The root element is the 'ep-patent-document', which has an attribute called date-publ, the publication date
+    patent_info['publication_date'] = root_attrib['date-publ']
+
+    doc_country = root_attrib['country']
+    doc_number = root_attrib['doc-number']
+    doc_kind = root_attrib['kind']
+    patent_info['document_number'] = f'{doc_country}{doc_number}.{doc_kind}'
+
+    ipcr_classes = sdobi.findall('.//classification-ipcr/text')
+    text_classes = [e.text for e in ipcr_classes]
+    # The class string has the form 'A61K  38/44        20060101AFI20130522BHEP        '
+    # We first split by white space and only select the first two parts
+    split_classes = [text.split() for text in text_classes]
+    selected_parts = [(main_class, sub_class) for main_class, sub_class, *_ in split_classes]
+    patent_info['ipc_classes'] = selected_parts
+
+    applicants = sdobi.findall('.//B711/snm')
+    text_applicants = [e.text for e in applicants]
+    patent_info['applicants'] = text_applicants
+
+    language, = sdobi.findall('B200/B260')
+    patent_info['language'] = language.text
+    return patent_info
+
+
+def patent_info_from_xml(root):
+    patent_info = bibliographic_info(root.attrib, root.find('.//SDOBI'))
+    patent_info['abstract'] = get_texts(root.findall('abstract'))
+    patent_info['claims'] = get_texts(root.findall('claims'))
+    patent_info['description'] = get_texts(root.findall('description'))
+    return patent_info
+
+
+def read_patent_info(patent_zip, patent_path, fields_only=False):
+    if fields_only:
+        return bibliographic_info(*parse_bibliographic_xml(patent_zip, patent_path))
+    return patent_info_from_xml(parse_patent_xml(patent_zip, patent_path))
+
+
+def extract_patent_info(patent_path, fields_only=False):
+    '''Extract the information used in this project from a downloaded patent zip. The publication date is
+    returned as the string from the document (YYYYMMDD). If fields_only is set, only the bibliographic
+    fields (publication date, document number, IPC classes, applicants and language) are extracted.'''
+    with ZipFile(patent_path) as patent_zip:
+        return read_patent_info(patent_zip, patent_path, fields_only=fields_only)
@@ -1,44 +1,211 @@
 import argparse
 from pathlib import Path
 import json
+import os
+import time
+import datetime
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from tqdm import tqdm
 import requests
+from requests.adapters import HTTPAdapter
+
+from patent_reader import validate_patent_zip
+from download_manifest import DownloadManifest
 
 EPS_URL = 'https://data.epo.org/publication-server/rest/v1.2/patents/{}/document.zip'
+# The publication server allows 5GB of downloads per week
+EPS_WEEKLY_QUOTA = 5*10**9
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class BrokenDownload(Exception):
+    pass
+
+
+class QuotaLedger:
+    '''Keeps track of how many bytes has been downloaded from the publication server during the last week.
+    The transfers are appended to a file, so the quota is tracked over multiple runs of the script.'''
+    def __init__(self, ledger_path: Path, quota=EPS_WEEKLY_QUOTA, window=datetime.timedelta(days=7)):
+        self.ledger_path = ledger_path
+        self.quota = quota
+        self.window = window
+        self.lock = threading.Lock()
+        self.transfers = []
+        if ledger_path.exists():
+            with open(ledger_path) as fp:
+                for line in fp:
+                    timestamp, n_bytes = line.split()
+                    self.transfers.append((float(timestamp), int(n_bytes)))
+        self._prune()
+
+    def _prune(self):
+        cutoff = time.time() - self.window.total_seconds()
+        self.transfers = [(timestamp, n_bytes) for timestamp, n_bytes in self.transfers if timestamp >= cutoff]
+
+    def used(self):
+        with self.lock:
+            self._prune()
+            return sum(n_bytes for timestamp, n_bytes in self.transfers)
+
+    def remaining(self):
+        return self.quota - self.used()
 
-def fetch_data(doc_id: str, output_dir: Path, overwrite=False):
+    def add(self, n_bytes):
+        if n_bytes == 0:
+            return
+        with self.lock:
+            timestamp = time.time()
+            self.transfers.append((timestamp, n_bytes))
+            with open(self.ledger_path, 'a') as fp:
+                fp.write(f'{timestamp} {n_bytes}\n')
+
+
+def make_session(workers):
+    '''Create a session which keeps one pooled connection per worker, so we don't have to do a new TLS handshake for each document'''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def fetch_data(session: requests.Session, doc_id: str, output_dir: Path, overwrite=False, eps_url=EPS_URL,
+               ledger: QuotaLedger = None, manifest: DownloadManifest = None, max_retries=5, backoff=2, chunk_size=2**16, timeout=60):
+    '''Download a single document. The document is streamed to a .part file which is renamed when the download is
+    complete, so a file with the final name is never partially written. If a .part file is left from an earlier
+    attempt, we ask the server to resume from where it ended. Server errors (5xx) are retried with exponential backoff.
+    Before the rename, the zip is validated (central directory, CRC of all members and presence of the document XML)
+    and the result is recorded in the manifest. Broken downloads are removed and fetched again straight away.
+    Returns the number of bytes transferred.'''
+    document = doc_id
     doc_id = 'NW'.join(doc_id.split('.'))
     output_path = output_dir / f'{doc_id}.zip'
-    if overwrite or not output_path.exists():
-        doc_url = EPS_URL.format(doc_id)
-        req = requests.get(doc_url)
-        req.raise_for_status()
-        with open(output_path, 'wb') as fp:
-            fp.write(req.content)
+    if not overwrite and output_path.exists():
+        return 0
+    part_path = output_dir / f'{doc_id}.zip.part'
+    doc_url = eps_url.format(doc_id)
+    transferred = 0
+    for attempt in range(max_retries + 1):
+        if ledger is not None and ledger.remaining() <= 0:
+            raise QuotaExceeded(f"The weekly EPS quota of {ledger.quota} bytes has been used up")
+        headers = {}
+        resume_from = part_path.stat().st_size if part_path.exists() else 0
+        if resume_from > 0:
+            headers['Range'] = f'bytes={resume_from}-'
+        attempt_transferred = 0
+        try:
+            with session.get(doc_url, headers=headers, stream=True, timeout=timeout) as req:
+                if req.status_code == 416:
+                    # The server didn't accept the range of the partial file, start over
+                    part_path.unlink()
+                    continue
+                if req.status_code >= 500 and attempt < max_retries:
+                    time.sleep(backoff * 2**attempt)
+                    continue
+                req.raise_for_status()
+                # If the server ignored the range header we get the whole file back
+                mode = 'ab' if req.status_code == 206 else 'wb'
+                hasher = hashlib.sha256()
+                if mode == 'ab':
+                    with open(part_path, 'rb') as fp:
+                        for chunk in iter(lambda: fp.read(chunk_size), b''):
+                            hasher.update(chunk)
+                with open(part_path, mode) as fp:
+                    for chunk in req.iter_content(chunk_size=chunk_size):
+                        fp.write(chunk)
+                        hasher.update(chunk)
+                        attempt_transferred += len(chunk)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+            continue
+        finally:
+            transferred += attempt_transferred
+            if ledger is not None:
+                ledger.add(attempt_transferred)
+        error = validate_patent_zip(part_path)
+        if manifest is not None:
+            manifest.record(output_path.name, document, part_path.stat().st_size, hasher.hexdigest(), error=error)
+        if error is not None:
+            part_path.unlink()
+            if attempt < max_retries:
+                continue
+            raise BrokenDownload(f"Downloaded file for {document} is broken: {error}")
+        os.replace(part_path, output_path)
+        return transferred
+    raise requests.HTTPError(f"Giving up on {doc_url} after {max_retries} retries")
+
+
+def download_documents(documents, output_dir: Path, workers=4, overwrite=False, eps_url=EPS_URL, ledger=None, manifest=None, **fetch_kwargs):
+    '''Download the documents with at most `workers` requests in flight at the same time.
+    Stops starting new downloads when the quota is exhausted. Returns a dict of the documents which failed.'''
+    failed = dict()
+    session = make_session(workers)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {executor.submit(fetch_data, session, doc_id, output_dir, overwrite=overwrite, eps_url=eps_url,
+                                   ledger=ledger, manifest=manifest, **fetch_kwargs): doc_id
+                   for doc_id in documents}
+        for future in tqdm(as_completed(futures), desc="Fetching documents", total=len(futures)):
+            doc_id = futures[future]
+            try:
+                future.result()
+            except QuotaExceeded as e:
+                print(e)
+                executor.shutdown(wait=True, cancel_futures=True)
+                break
+            except (requests.RequestException, BrokenDownload) as e:
+                print(f"Error downloading document {doc_id}: {e}")
+                failed[doc_id] = str(e)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        session.close()
+    return failed
+
 
 def main():
     parser = argparse.ArgumentParser(description="Script for downloading documents from the EPO Publication Server")
-    parser.add_argument('document_numbers', nargs='*', 
-                        help='A text file where each line is EP document number to fetch, in the format like "EP0000022.A1"', 
+    parser.add_argument('document_numbers', nargs='*',
+                        help='A text file where each line is EP document number to fetch, in the format like "EP0000022.A1"',
                         type=Path)
     parser.add_argument('--output-dir', type=Path, default=Path())
-    parser.add_argument('--overwrite', 
+    parser.add_argument('--overwrite',
                         help='If flag is set, overwrite data in output dir. '
-                        'If not set, data which is already present will not be downloaded again', 
+                        'If not set, data which is already present will not be downloaded again',
                         action='store_true')
+    parser.add_argument('--workers', help="Number of documents to download concurrently", type=int, default=4)
+    parser.add_argument('--max-retries', help="How many times to retry a document on server errors", type=int, default=5)
+    parser.add_argument('--quota-file', help="File used to keep track of how much has been downloaded the last week. "
+                        "By default 'eps_quota.txt' in the output directory", type=Path, default=None)
+    parser.add_argument('--weekly-quota', help="Number of bytes we're allowed to download per week", type=int, default=EPS_WEEKLY_QUOTA)
+    parser.add_argument('--eps-url', help="URL template for the documents, mainly useful for testing against a local server",
+                        default=EPS_URL)
     args = parser.parse_args()
     documents = []
 
     for docnumber_file in args.document_numbers:
         with open(docnumber_file, 'r') as fp:
-            
+
             documents.extend(line.strip() for line in fp)
 
-    
+
     args.output_dir.mkdir(exist_ok=True, parents=True)
-    for doc_id in tqdm(documents, desc="Fetching documents"):
-        fetch_data(doc_id, args.output_dir)
+    quota_file = args.quota_file if args.quota_file is not None else args.output_dir / 'eps_quota.txt'
+    ledger = QuotaLedger(quota_file, quota=args.weekly_quota)
+    print(f"Used {ledger.used()/10**9:.2f}GB of the weekly quota of {ledger.quota/10**9:.2f}GB")
+    manifest = DownloadManifest.in_directory(args.output_dir)
+    failed = download_documents(documents, args.output_dir, workers=args.workers, overwrite=args.overwrite,
+                                eps_url=args.eps_url, ledger=ledger, manifest=manifest, max_retries=args.max_retries)
+    if failed:
+        with open(args.output_dir / 'failed_downloads.txt', 'w') as fp:
+            fp.write('\n'.join(sorted(failed)))
 
 
 if __name__ == '__main__':
@@ -1,76 +1,129 @@
 import argparse
 from pathlib import Path
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
 from tqdm import tqdm
 import epo_ops
 from epo_ops.models import Epodoc
 import requests
 
-def fetch_data(client: epo_ops.Client, doc_id: str, output_dir: Path, overwrite=False):
-    
-    doc = Epodoc(doc_id)
-    output_dir = output_dir / f'{doc.as_api_input()}'
-    output_dir.mkdir(exist_ok=True, parents=True)
-
-    status_file_path = output_dir / 'status.txt'
-    if status_file_path.exists():
-        with open(status_file_path, 'r') as fp:
-            status = fp.read()
-            if status == 'Missing EPO document':
-                return
-            elif  status == 'Done processing' and not overwrite:
+from ops_client import ThrottleBudget, ThrottledClient, is_rejection, set_ops_url
+
+ENDPOINTS = ["fulltext", "biblio", "description", "claims", "images"]
+
+
+class OPSFetcher:
+    '''Fetches documents from OPS with requests overlapping across documents, endpoints and image pages.
+    All requests go through a shared throttle budget which follows the throttling headers of the responses.
+    The client_factory is called once per request thread, it should return an object with the `published_data`
+    and `image` methods of epo_ops.Client (e.g. a client for a local mock server when testing).'''
+    def __init__(self, client_factory, request_workers=8, budget=None):
+        self.client_factory = client_factory
+        self.local = threading.local()
+        self.budget = budget if budget is not None else ThrottleBudget()
+        self.executor = ThreadPoolExecutor(max_workers=request_workers)
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    @property
+    def client(self):
+        # The client isn't thread safe, so every request thread gets its own
+        if not hasattr(self.local, 'client'):
+            self.local.client = ThrottledClient(self.client_factory(), self.budget)
+        return self.local.client
+
+    def _fetch_endpoint(self, doc, endpoint, output_path):
+        req = self.client.published_data('publication', doc, endpoint=endpoint)
+        with open(output_path, 'wb') as fp:
+            fp.write(req.content)
+
+    def _fetch_image(self, request_url, page, output_path):
+        req = self.client.image(request_url, range=page, document_format='application/tiff')
+        with open(output_path, 'wb') as fp:
+            fp.write(req.content)
+
+    def fetch_data(self, doc_id: str, output_dir: Path, overwrite=False):
+        doc = Epodoc(doc_id)
+        output_dir = output_dir / f'{doc.as_api_input()}'
+        output_dir.mkdir(exist_ok=True, parents=True)
+
+        status_file_path = output_dir / 'status.txt'
+        if status_file_path.exists():
+            with open(status_file_path, 'r') as fp:
+                status = fp.read()
+                if status == 'Missing EPO document':
+                    return
+                elif  status == 'Done processing' and not overwrite:
+                    return
+
+        endpoint_futures = {self.executor.submit(self._fetch_endpoint, doc, endpoint, output_dir / f'{endpoint}.json'): endpoint
+                            for endpoint in ENDPOINTS}
+        wait(endpoint_futures)
+        for future, endpoint in endpoint_futures.items():
+            try:
+                future.result()
+            except requests.HTTPError as e:
+                if is_rejection(e.response):
+                    # Still throttled after all the retries. The document isn't missing, so it's left without a
+                    # status and fetched again on the next run.
+                    raise
+                print(f"Received HTTP error {e} for document {doc_id} endpoint {endpoint}")
+                with open(status_file_path, 'w') as fp:
+                    fp.write('Missing EPO document')
                 return
 
-    for endpoint in ["fulltext", "biblio", "description", "claims", "images"]:
-        #print("Get", endpoint)
-        output_path = output_dir / f'{endpoint}.json'
-        try:
-            req = client.published_data('publication', doc, endpoint=endpoint)
-            with open(output_path, 'wb') as fp:
-                fp.write(req.content)
-        except requests.HTTPError as e:
-            print(f"Received HTTP error {e} for document {doc_id} endpoint {endpoint}")
-            with open(status_file_path, 'w') as fp:
-                fp.write('Missing EPO document')
-            return
-            
-    with open(output_dir / 'images.json', 'r') as fp:
-        image_query_json = json.load(fp)
-    
-    image_inquery_result = image_query_json['ops:world-patent-data']['ops:document-inquiry']['ops:inquiry-result']['ops:document-instance']
-    if isinstance(image_inquery_result, dict):
-        image_inquery_result = [image_inquery_result]
-    
-    for res in image_inquery_result:
-        if res.get('@desc', None) == 'Drawing':
-            n_pages = int(res['@number-of-pages'])
-            request_url = res['@link']
-            for i in range(1, n_pages+1):
-                name = f'{i:02}'
+        with open(output_dir / 'images.json', 'r') as fp:
+            image_query_json = json.load(fp)
+
+        image_inquery_result = image_query_json['ops:world-patent-data']['ops:document-inquiry']['ops:inquiry-result']['ops:document-instance']
+        if isinstance(image_inquery_result, dict):
+            image_inquery_result = [image_inquery_result]
+
+        image_futures = []
+        for res in image_inquery_result:
+            if res.get('@desc', None) == 'Drawing':
+                n_pages = int(res['@number-of-pages'])
+                request_url = res['@link']
                 image_output_dir = output_dir / 'Drawing'
                 image_output_dir.mkdir(exist_ok=True)
-                output_path = image_output_dir / f'{name}.tiff'
-                req = client.image(request_url, range=i,
-                                document_format='application/tiff')
-                with open(output_path, 'wb') as fp:
-                    fp.write(req.content)
-
-    with open(status_file_path, 'w') as fp:
-        fp.write('Done processing')
-
-    # # Fetch images
-    # endpoint = "images"
-    # tree = ET.parse(f'../{doc.as_api_input()}/{endpoint}.xml')
-    # # Extract image paths
-    # paths = [e.attrib['link'] for e in tree.getroot().iter() if 'link' in e.attrib]
-    # # Get and write to disk
-    # for p in paths:
-    #     print("Get", p)
-    #     req = client.image(p, range=1)
-    #     name = p.split('/')[-1]
-    #     with open(f'../{doc.as_api_input()}/{name}.tiff', 'wb') as fp:
-    #         fp.write(req.content)
+                for i in range(1, n_pages+1):
+                    name = f'{i:02}'
+                    output_path = image_output_dir / f'{name}.tiff'
+                    image_futures.append(self.executor.submit(self._fetch_image, request_url, i, output_path))
+        for future in image_futures:
+            # Any error fetching an image is raised here, and the document is not marked as done
+            future.result()
+
+        with open(status_file_path, 'w') as fp:
+            fp.write('Done processing')
+
+        # # Fetch images
+        # endpoint = "images"
+        # tree = ET.parse(f'../{doc.as_api_input()}/{endpoint}.xml')
+        # # Extract image paths
+        # paths = [e.attrib['link'] for e in tree.getroot().iter() if 'link' in e.attrib]
+        # # Get and write to disk
+        # for p in paths:
+        #     print("Get", p)
+        #     req = client.image(p, range=1)
+        #     name = p.split('/')[-1]
+        #     with open(f'../{doc.as_api_input()}/{name}.tiff', 'wb') as fp:
+        #         fp.write(req.content)
+
+
+def fetch_documents(fetcher: OPSFetcher, documents, output_dir: Path, document_workers=4, overwrite=False):
+    '''Fetch the documents with up to document_workers documents in progress at the same time. The documents
+    only wait for their requests, which are made by the request threads of the fetcher.'''
+    with ThreadPoolExecutor(max_workers=document_workers) as executor:
+        futures = {executor.submit(fetcher.fetch_data, doc_id, output_dir, overwrite=overwrite): doc_id for doc_id in documents}
+        for future in tqdm(as_completed(futures), desc="Fetching documents", total=len(futures)):
+            try:
+                future.result()
+            except requests.HTTPError as e:
+                print(f"Error fetching document {futures[future]}: {e}")
 
 
 def main():
@@ -82,30 +135,40 @@ def main():
     parser.add_argument('--api-keys', help='JSON file with the API key',
                         type=Path, default=Path('../api_key.json'))
     parser.add_argument('--overwrite', help='If flag is set, overwrite data in output dir. '
-                        'If not set, data which is already present will not be downloaded again', 
+                        'If not set, data which is already present will not be downloaded again',
                         action='store_true')
+    parser.add_argument('--document-workers', help="Number of documents to process concurrently", type=int, default=4)
+    parser.add_argument('--request-workers', help="Maximum number of requests in flight at the same time. "
+                        "The request rate is still limited by the OPS throttling", type=int, default=8)
+    parser.add_argument('--ops-url', help="Base URL of the OPS service, mainly useful for testing against a local mock server",
+                        default=None)
     args = parser.parse_args()
 
-    middlewares = [
-        # epo_ops.middlewares.Dogpile(), #No dogpile support on windows
-        epo_ops.middlewares.Throttler(),
-    ]
-
     with open(args.api_keys, 'r') as fp:
         api_keys = json.load(fp)
 
-    client = epo_ops.Client(
-        key=api_keys['key'],
-        secret=api_keys['secret'],
-        middlewares=middlewares,
-        accept_type='json'
-    )
+    def client_factory():
+        # The throttling is done by the fetcher, which is shared between all threads,
+        # so the clients don't use the Throttler middleware
+        client = epo_ops.Client(
+            key=api_keys['key'],
+            secret=api_keys['secret'],
+            middlewares=[],
+            accept_type='json'
+        )
+        if args.ops_url is not None:
+            set_ops_url(client, args.ops_url)
+        return client
 
     with open(args.document_numbers, 'r') as fp:
         documents = [line.strip() for line in fp]
 
-    for doc_id in tqdm(documents, desc="Fetching documents"):
-        fetch_data(client, doc_id, args.output_dir)
+    fetcher = OPSFetcher(client_factory, request_workers=args.request_workers)
+    try:
+        fetch_documents(fetcher, documents, args.output_dir, document_workers=args.document_workers, overwrite=args.overwrite)
+    finally:
+        fetcher.close()
+        print(fetcher.budget.summary())
 
 
 if __name__ == '__main__':
@@ -1,132 +1,435 @@
+import argparse
 import torch
 #import clip
 #from PIL import Image
-import zipfile
 from pathlib import Path
-import json
 import math
-from collections import defaultdict
-from torch.nn.functional import pad
+import random
+import bisect
+import functools
+import multiprocessing
+from collections import Counter, deque
+from contextlib import ExitStack
 from transformers import AutoTokenizer, AutoModelForMaskedLM
 from tqdm import tqdm
-import pickle
+import numpy as np
 from sentence_transformers import SentenceTransformer
 
+from embedding_store import write_embedding_store
+from embedding_cache import EmbeddingCache, cache_key, cache_summary
+from packaged_patents import PackagedPatents
+from encoding_shards import list_packaged_patents, plan_shard_jobs, write_shard, load_shards
+
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
-model = SentenceTransformer('AI-Growth-Lab/PatentSBERTa').to(device=device)
-
-def tokenize_string(string, model):
-    tokenized = model.tokenize([string])
-    input_ids = tokenized['input_ids']
-    if len(input_ids[0]) >= 512:
-        words = string.split()
-        n_words = len(words)
-        if n_words < 2:
-            # It's not too rare that we get really long words (e.g. mathematical formulas). In this case we just split
-            # them exactly in two along the strings instead of white-spaced words
-            n_chars = len(string)
-            first_half_string = string[:n_chars//2]
-            second_half_string = string[n_chars//2:]
-            first_tokenized = tokenize_string(first_half_string, model)
-            second_tokenized = tokenize_string(second_half_string, model)
+MODEL_NAME = 'AI-Growth-Lab/PatentSBERTa'
+
+TEXT_SECTIONS = ('abstract', 'description', 'claims')
+POOLING_METHODS = ('sum', 'mean', 'max')
+# A window is preferably cut after a token ending with one of these
+SENTENCE_ENDS = ('.', '!', '?', ';')
+
+def min_stride(window_length):
+    '''The shortest stride text_windows accepts. The windows can overlap by at most half their content, since a
+    window cut at a sentence boundary can be only about half as long as the others.'''
+    return window_length - (window_length - 2) // 2
+
+
+def text_windows(texts, tokenizer, window_length=512, stride=None):
+    '''Tokenize the texts in one call to the fast tokenizer, without truncation, and cut the token ids of each text
+    into windows of at most window_length tokens, each starting with the CLS token and ending with the SEP token.
+    A window ends at a sentence boundary if there is one in its second half, otherwise it's cut at the length.
+    With a stride shorter than window_length, the windows overlap by window_length - stride tokens, so the stride
+    can't be shorter than min_stride(window_length), which is half the window.
+    Returns a list of windows (lists of token ids) per text.'''
+    encodings = tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True, truncation=False, verbose=False)
+    if stride is not None and stride < min_stride(window_length):
+        raise ValueError(f"A stride of {stride} is shorter than the shortest allowed stride {min_stride(window_length)} "
+                         f"for windows of {window_length} tokens")
+    content_length = window_length - 2
+    overlap = window_length - stride if stride is not None else 0
+    windows_per_text = []
+    for text, input_ids, offsets in zip(texts, encodings['input_ids'], encodings['offset_mapping']):
+        # The tokens which start a new sentence, i.e. which come after a token ending with a full stop or similar
+        sentence_starts = [i for i in range(1, len(input_ids)) if text[offsets[i-1][1]-1:offsets[i-1][1]] in SENTENCE_ENDS]
+        windows = []
+        window_start = 0
+        while True:
+            window_end = min(window_start + content_length, len(input_ids))
+            if window_end < len(input_ids):
+                j = bisect.bisect_right(sentence_starts, window_end) - 1
+                if j >= 0 and sentence_starts[j] > window_start + content_length // 2:
+                    window_end = sentence_starts[j]
+            windows.append([tokenizer.cls_token_id] + input_ids[window_start:window_end] + [tokenizer.sep_token_id])
+            if window_end >= len(input_ids):
+                break
+            window_start = max(window_end - overlap, window_start + 1)
+        windows_per_text.append(windows)
+    return windows_per_text
+
+
+def length_buckets(lengths, batch_size):
+    '''Group the indices of windows into batches (buckets) of windows of about the same length, by sorting them by
+    length. Each bucket only has to be padded to its own longest window.'''
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[start:start+batch_size] for start in range(0, len(order), batch_size)]
+
+
+def padding_stats(lengths, batches, batch_size, window_length=None):
+    '''Count the real tokens and the tokens of the padded batches: with each window padded to the window length
+    (or the longest window), with batches of batch_size windows in order and with the given batches'''
+    if window_length is None:
+        window_length = max(lengths, default=0)
+    in_order_batches = [range(start, min(start + batch_size, len(lengths))) for start in range(0, len(lengths), batch_size)]
+    return Counter(tokens=sum(lengths),
+                   full_length_tokens=len(lengths)*window_length,
+                   in_order_tokens=sum(len(batch)*max(lengths[i] for i in batch) for batch in in_order_batches),
+                   bucketed_tokens=sum(len(batch)*max(lengths[i] for i in batch) for batch in batches))
+
+
+def padding_summary(stats):
+    if stats['tokens'] == 0:
+        return 'no windows encoded'
+    def padding(padded_tokens):
+        return f"{100*(1 - stats['tokens']/padded_tokens):.1f}%"
+    return (f"padding is {padding(stats['bucketed_tokens'])} of the encoded tokens, it would have been "
+            f"{padding(stats['in_order_tokens'])} without length buckets and {padding(stats['full_length_tokens'])} padding every window to the window length")
+
+
+def encode_windows(windows_per_text, model, device=device, batch_size=16, pooling='sum', pad_token_id=None, use_length_buckets=True,
+                   stats=None, window_length=None):
+    '''Encode texts, given as lists of token windows, into one vector each. The windows of all the texts are encoded
+    together, so the batches are full even though most texts (like abstracts) only have a single window. With
+    use_length_buckets the windows are batched by length (see length_buckets), otherwise in order. Each batch is only
+    padded to its longest window, and the padding is masked out, so with the full precision model the embeddings don't
+    depend on the batching. The quantized model of load_model(quantize=True) scales the inputs of each linear layer by
+    the whole batch, padding included, so there the embedding of a window depends on the windows it's batched with
+    (see check_quantization). The window embeddings are added back to their text with index_add_, and pooled with
+    'sum', 'mean' or 'max' over the windows of each text. The numbers of real and padded tokens are added to the stats
+    Counter if given.'''
+    if pooling not in POOLING_METHODS:
+        raise ValueError(f"Unknown pooling {pooling}, should be one of {POOLING_METHODS}")
+    if pad_token_id is None:
+        pad_token_id = model.tokenizer.pad_token_id
+    windows = [window for text_windows_ in windows_per_text for window in text_windows_]
+    window_owners = [i for i, text_windows_ in enumerate(windows_per_text) for window in text_windows_]
+    lengths = [len(window) for window in windows]
+    if use_length_buckets:
+        batches = length_buckets(lengths, batch_size)
+    else:
+        batches = [list(range(start, min(start + batch_size, len(windows)))) for start in range(0, len(windows), batch_size)]
+    if stats is not None:
+        stats.update(padding_stats(lengths, batches, batch_size, window_length))
+    owners = torch.tensor(window_owners, dtype=torch.long)
+
+    embedding_dim = model.get_sentence_embedding_dimension()
+    if pooling == 'max':
+        pooled = torch.full((len(windows_per_text), embedding_dim), -math.inf)
+    else:
+        pooled = torch.zeros((len(windows_per_text), embedding_dim))
+    with torch.inference_mode():
+        for batch in batches:
+            batch_windows = [windows[i] for i in batch]
+            batch_owners = torch.tensor([window_owners[i] for i in batch], dtype=torch.long)
+            batch_length = max(len(window) for window in batch_windows)
+            batch_text = torch.full((len(batch_windows), batch_length), pad_token_id, dtype=torch.long)
+            batch_mask = torch.zeros((len(batch_windows), batch_length), dtype=torch.long)
+            for i, window in enumerate(batch_windows):
+                batch_text[i, :len(window)] = torch.tensor(window, dtype=torch.long)
+                batch_mask[i, :len(window)] = 1
+            features = {'input_ids': batch_text.to(device=device), 'attention_mask': batch_mask.to(device=device)}
+            out_features = model.forward(features) # Weird that the SentenceTransformer explicitly calls forward
+            embeddings = out_features['sentence_embedding'].detach().cpu().to(dtype=pooled.dtype)
+            if pooling == 'max':
+                for owner, embedding in zip(batch_owners.tolist(), embeddings):
+                    pooled[owner] = torch.maximum(pooled[owner], embedding)
+            else:
+                pooled.index_add_(0, batch_owners, embeddings)
+    if pooling == 'mean':
+        n_windows = torch.bincount(owners, minlength=len(windows_per_text))
+        pooled = pooled / n_windows.unsqueeze(1)
+    return pooled.numpy()
+
+
+def encode_texts(texts, model, device=device, batch_size=16, window_length=512, stride=None, pooling='sum'):
+    windows_per_text = text_windows(texts, model.tokenizer, window_length=window_length, stride=stride)
+    return encode_windows(windows_per_text, model, device=device, batch_size=batch_size, pooling=pooling)
+
+
+def encode_text(text, model, device=device, batch_size=16, window_length=512, stride=None, pooling='sum'):
+    return encode_texts([text], model, device=device, batch_size=batch_size, window_length=window_length, stride=stride, pooling=pooling)[0]
+
+
+# The tokenizer, packaged zip and embedding cache of a tokenizer worker process
+tokenizer_worker_state = dict()
+
+
+def init_tokenizer_worker(model_name, packaged, cache_path=None):
+    tokenizer_worker_state['tokenizer'] = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    tokenizer_worker_state['packaged'] = PackagedPatents(packaged)
+    tokenizer_worker_state['cache'] = EmbeddingCache(cache_path, read_only=True) if cache_path is not None else None
+
+
+def tokenize_patent_chunk(chunk, window_length=512, stride=None, cache_settings=None):
+    '''Read the patent info of a chunk of patents of the packaged zip and cut the text sections into token windows. Runs in the tokenizer workers. Returns the metadata, the cache keys of the sections and the
+    windows of the sections. Sections which are in the embedding cache are not tokenized, their windows are None.'''
+    packaged = tokenizer_worker_state['packaged']
+    cache = tokenizer_worker_state['cache']
+    patent_metadata = []
+    texts = []
+    for record in packaged.records(fields=('applicants', 'publication_date', 'ipc_classes') + TEXT_SECTIONS, patent_numbers=chunk):
+        patent_metadata.append(dict(patent_number=record['patent_number'],
+                                    applicants=','.join(record['applicants']),
+                                    publication_date=record['publication_date'],
+                                    ipc_classes=record['ipc_classes']))
+        texts.extend(record[section]['en'] for section in TEXT_SECTIONS)
+    keys = [cache_key(cache_settings, text) for text in texts]
+    cached_keys = cache.contains(keys) if cache is not None else set()
+    missing = []
+    for i, key in enumerate(keys):
+        # A text which is in the chunk more than once (like an empty section) is only encoded once
+        if key not in cached_keys:
+            missing.append(i)
+            if cache is not None:
+                cached_keys.add(key)
+    windows_per_text = [None]*len(texts)
+    if missing:
+        missing_windows = text_windows([texts[i] for i in missing], tokenizer_worker_state['tokenizer'], window_length=window_length, stride=stride)
+        for i, windows in zip(missing, missing_windows):
+            windows_per_text[i] = windows
+    return patent_metadata, keys, windows_per_text
+
+
+def prefetched(pool, fn, items, prefetch):
+    '''Like pool.imap, but with at most prefetch results waiting, so the tokenization doesn't run ahead of the model
+    and fill up the memory'''
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(fn, (item,)))
+        if len(pending) >= prefetch:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def encode_packaged_patents(packaged, model, patents=None, doc_start=None, doc_end=None, batch_size=16, window_length=512, stride=None,
+                            pooling='sum', chunk_size=64, tokenizer_workers=2, prefetch=4, model_name=MODEL_NAME,
+                            cache: EmbeddingCache = None, cpu_fast=False, stats=None):
+    '''Encode the texts of the patents in a packaged zip, or only the given patents of it.
+    The patents are encoded chunk_size at a time, with the windows of all their sections batched together. The chunks
+    are tokenized by tokenizer_workers processes while the model encodes earlier chunks (with 0 workers the
+    tokenization is done in this process). With a cache, only the sections which aren't in it are encoded.
+    cpu_fast means the model is quantized (see load_model). The padding of the batches is counted in stats.'''
+    if patents is None:
+        patents = list_packaged_patents(packaged)
+    text_patents = []
+    sorted_patents = patents[doc_start:doc_end]
+    chunks = [sorted_patents[i:i+chunk_size] for i in range(0, len(sorted_patents), chunk_size)]
+    # Everything which changes the embedding of a text is part of its cache key
+    cache_settings = dict(model_name=model_name, window_length=window_length, stride=stride, pooling=pooling)
+    if cpu_fast:
+        cache_settings['quantized'] = True
+    tokenize = functools.partial(tokenize_patent_chunk, window_length=window_length, stride=stride, cache_settings=cache_settings)
+    initargs = (model_name, packaged, cache.cache_path if cache is not None else None)
+
+    with ExitStack() as stack:
+        if tokenizer_workers > 0:
+            pool = stack.enter_context(multiprocessing.Pool(tokenizer_workers, initializer=init_tokenizer_worker, initargs=initargs))
+            tokenized_chunks = prefetched(pool, tokenize, chunks, prefetch)
         else:
-            first_half = words[:n_words//2]
-            second_half = words[n_words//2:]
-            first_half_string = ' '.join(first_half)
-            second_half_string = ' '.join(second_half)
-            first_tokenized = tokenize_string(first_half_string, model)
-            second_tokenized = tokenize_string(second_half_string, model)
-        concatentated_input_ids = torch.cat([first_tokenized['input_ids'], second_tokenized['input_ids']], dim=-1)
-        concatentated_attention = torch.cat([first_tokenized['attention_mask'], second_tokenized['attention_mask']], dim=-1)
-        tokenized = {'input_ids': concatentated_input_ids, 'attention_mask': concatentated_attention}
-    return tokenized
-
-
-def encode_text(text, model, device=device, batch_size=16, window_length=512):
-    #step_size = int(window_length/2)
-    step_size = window_length
-    with torch.no_grad():
-        tokenization_results = tokenize_string(text, model)
-        tokenized_text = tokenization_results['input_ids'][0]
-        attention_mask = tokenization_results['attention_mask'][0]
-        n_tokens = len(tokenized_text)
-        if n_tokens < window_length:
-            tokenized_text = pad(tokenized_text, (0, window_length-n_tokens))
-            attention_mask = pad(attention_mask, (0, window_length-n_tokens))
-            n_tokens = len(tokenized_text)
-        padded_length = math.ceil((len(tokenized_text) - window_length)/(step_size))*step_size + window_length
-        tokenized_text = pad(tokenized_text, (0, padded_length-n_tokens))
-        attention_mask = pad(attention_mask, (0, padded_length-n_tokens))
-        unfolded_text = tokenized_text.unfold(0, window_length, step_size)
-        unfolded_mask = attention_mask.unfold(0, window_length, step_size)
-
-        num_batches = math.ceil(len(unfolded_text)/batch_size)
-        encoded_texts = []
-        for i in range(num_batches):
-            batch_text = unfolded_text[i*batch_size:(i+1)*batch_size]
-            batch_mask = unfolded_mask[i*batch_size:(i+1)*batch_size]
-            batch = {'input_ids': batch_text.to(device=device), 'attention_mask': batch_mask.to(device=device)}
-            out_features = model.forward(batch) # Weird that the SentenceTransformer explicitly calls forward
-            embeddings = out_features['sentence_embedding']
-            encoded_text = embeddings.detach().cpu()
-            encoded_texts.append(encoded_text)
-        encoded_texts = torch.cat(encoded_texts, dim=0)
-        summary_encoding = torch.sum(encoded_text, dim=0)
-        return summary_encoding.detach().cpu().numpy()
-
-def encode_packaged_patents(packaged, doc_start=None, doc_end=None, batch_size=16, window_length=512):
-    with zipfile.ZipFile(packaged) as z:
-        document_files = defaultdict(lambda: {'patent_info': None, 'images': []})
-        n_infos = 0
-        for info in z.infolist():
-            n_infos += 1
-            patent, filename = info.filename.split('/')
-            base, ext = filename.split('.')
-            if ext == 'json':
-                document_files[patent]['patent_info'] = info
-            elif ext == 'tif':
-                document_files[patent]['images'].append(info)
-        
-        
-        text_patents = []
-        
-        for patent, infos in tqdm(sorted(document_files.items())):
-            with z.open(infos['patent_info']) as fp:
-                patent_info = json.load(fp)
-                
-
-            abstract = patent_info['abstract']['en']
-            description = patent_info['description']['en']
-            claims = patent_info['claims']['en']
-            applicants = patent_info['applicants']
-            publication_date = patent_info['publication_date']
-            ipc_classes = patent_info['ipc_classes']
-            
-            vectors = dict(abstract_vector=encode_text(abstract, model, batch_size=batch_size, window_length=window_length),
-                        description_vector=encode_text(description, model, batch_size=batch_size, window_length=window_length),
-                        claims_vector = encode_text(claims, model, batch_size=batch_size, window_length=window_length))
-        
-            patent_repr = dict(patent_number=patent,
-            vectors=vectors,
-                            applicants=','.join(applicants),
-                            publication_date=publication_date, 
-                            ipc_classes=ipc_classes)
-                    
+            init_tokenizer_worker(*initargs)
+            tokenized_chunks = map(tokenize, chunks)
+
+        for patent_metadata, keys, windows_per_text in tqdm(tokenized_chunks, total=len(chunks), leave=False):
+            missing = [i for i, windows in enumerate(windows_per_text) if windows is not None]
+            encoded_texts = [None]*len(keys)
+            if missing:
+                encoded_missing = encode_windows([windows_per_text[i] for i in missing], model, batch_size=batch_size, pooling=pooling,
+                                                 stats=stats, window_length=window_length)
+                for i, vector in zip(missing, encoded_missing):
+                    encoded_texts[i] = vector
+            if cache is not None:
+                cache.put({keys[i]: encoded_texts[i] for i in missing})
+                cached_keys = [key for key, vector in zip(keys, encoded_texts) if vector is None]
+                cached_vectors = cache.get(cached_keys)
+                for i, key in enumerate(keys):
+                    if encoded_texts[i] is None:
+                        # The tokenizer saw the key in the cache, it can only be gone if the cache was evicted meanwhile
+                        encoded_texts[i] = cached_vectors[key].copy()
+
+            for i, metadata in enumerate(patent_metadata):
+                patent_vectors = encoded_texts[i*len(TEXT_SECTIONS):(i+1)*len(TEXT_SECTIONS)]
+                vectors = {f'{section}_vector': vector for section, vector in zip(TEXT_SECTIONS, patent_vectors)}
             
-            text_patents.append(patent_repr)
+                patent_repr = dict(metadata, vectors=vectors)
+                text_patents.append(patent_repr)
 
             
     return text_patents
 
-packaged = [Path('F:/datasets/PRV_KEMI_DATA/packaged_patents/english_netto_list.zip'),
-            Path('F:/datasets/PRV_KEMI_DATA/packaged_patents/complement_english.zip'),
-            Path('F:/datasets/PRV_KEMI_DATA/packaged_patents/english_random_sample.zip')]
-
-output_dir = Path('F:/datasets/PRV_KEMI_DATA/patent_sbert_no_overlap/')
-output_dir.mkdir(exist_ok=True)
-for p in packaged:
-    text_patents = encode_packaged_patents(p)
-    basename = p.with_suffix('').name
-    with open(output_dir / f'patent_sbert_no_images_{basename}.pkl', 'wb') as fp:
-        pickle.dump(text_patents, fp)
\ No newline at end of file
+
+def load_model(model_name=MODEL_NAME, device=device, quantize=False):
+    '''Load the sentence transformer. With quantize, the weights of its linear layers are quantized to int8, and the
+    activations are quantized on the fly, which makes it a lot faster on the CPU.'''
+    model = SentenceTransformer(model_name).to(device=device)
+    if quantize:
+        if device != 'cpu':
+            raise ValueError(f"Quantized models only run on the CPU, not on {device}")
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.eval()
+    return model
+
+
+def set_threads(n_threads=None, interop_threads=None):
+    '''Set the number of threads torch uses within operations and between operations. The number of inter-op threads
+    can only be set before torch has run anything in parallel.'''
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    if interop_threads is not None and torch.get_num_interop_threads() != interop_threads:
+        torch.set_num_interop_threads(interop_threads)
+
+
+def cosine_similarities(a, b):
+    return np.sum(a*b, axis=1) / (np.linalg.norm(a, axis=1)*np.linalg.norm(b, axis=1))
+
+
+def check_quantization(packaged, model_name=MODEL_NAME, n_patents=16, batch_size=16, window_length=512, stride=None, pooling='sum', seed=0):
+    '''Encode the sections of a random sample of patents with the full precision and the quantized model, and return
+    the cosine similarities between the two embeddings of each section. Since the quantized embeddings depend on the
+    batching, the cosine similarities between the quantized embeddings of the length bucketed batches and of encoding
+    one window at a time (without padding) are returned as well.'''
+    patents = list_packaged_patents(packaged)
+    sample = sorted(random.Random(seed).sample(patents, min(n_patents, len(patents))))
+    init_tokenizer_worker(model_name, packaged)
+    patent_metadata, keys, windows_per_text = tokenize_patent_chunk(sample, window_length=window_length, stride=stride)
+    full_precision = encode_windows(windows_per_text, load_model(model_name, 'cpu'), device='cpu', batch_size=batch_size, pooling=pooling)
+    model = load_model(model_name, 'cpu', quantize=True)
+    quantized = encode_windows(windows_per_text, model, device='cpu', batch_size=batch_size, pooling=pooling)
+    unbatched = encode_windows(windows_per_text, model, device='cpu', batch_size=1, pooling=pooling)
+    return cosine_similarities(full_precision, quantized), cosine_similarities(quantized, unbatched)
+
+
+# The model and embedding cache of a shard worker process, and the settings for encoding
+shard_worker_state = dict()
+
+
+def init_shard_worker(model_name, device, n_threads, encode_kwargs, cache_path=None, interop_threads=None):
+    set_threads(n_threads, interop_threads)
+    shard_worker_state['model'] = load_model(model_name, device, quantize=encode_kwargs.get('cpu_fast', False))
+    shard_worker_state['encode_kwargs'] = encode_kwargs
+    shard_worker_state['cache'] = EmbeddingCache(cache_path) if cache_path is not None else None
+
+
+def encode_shard(shard_job):
+    '''Encode the patents of a shard and write them to the shard file. Returns the path and the stats of the shard,
+    the cache hits and misses and the padding.'''
+    packaged, output_path, shard_patents = shard_job
+    cache = shard_worker_state['cache']
+    stats_before = Counter(cache.stats) if cache is not None else Counter()
+    shard_stats = Counter()
+    text_patents = encode_packaged_patents(packaged, shard_worker_state['model'], patents=shard_patents, cache=cache,
+                                           stats=shard_stats, **shard_worker_state['encode_kwargs'])
+    write_shard(output_path, text_patents)
+    if cache is not None:
+        shard_stats.update(cache.stats - stats_before)
+    return output_path, shard_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode the texts of packaged patents with a sentence transformer")
+    parser.add_argument('packaged', help="Packaged patent zips to encode", nargs='+', type=Path)
+    parser.add_argument('--output-dir', help="Directory to write the encodings to", type=Path, default=Path())
+    parser.add_argument('--model-name', help="Sentence transformer model to use", default=MODEL_NAME)
+    parser.add_argument('--device', help="Device to run the model on", default=device)
+    parser.add_argument('--batch-size', help="Number of token windows per batch", type=int, default=16)
+    parser.add_argument('--window-length', help="Number of tokens per window", type=int, default=512)
+    parser.add_argument('--stride', help="Number of tokens between the starts of the windows of a text. "
+                        "By default the same as the window length, so the windows don't overlap. The windows can overlap by "
+                        "at most half their length, so the stride can't be shorter than that (257 for the default window length)",
+                        type=int, default=None)
+    parser.add_argument('--pooling', help="How to pool the window embeddings of a text", choices=POOLING_METHODS, default='sum')
+    parser.add_argument('--chunk-size', help="Number of patents whose windows are batched together", type=int, default=64)
+    parser.add_argument('--shard-size', help="Number of patents per shard. Each shard is written as soon as it's done, "
+                        "and shards which are already written are skipped when the script is run again", type=int, default=1000)
+    parser.add_argument('--workers', help="Number of processes encoding shards at the same time, each with its own copy of the model",
+                        type=int, default=1)
+    parser.add_argument('--threads-per-worker', help="Number of torch threads per worker process", type=int, default=None)
+    parser.add_argument('--interop-threads', help="Number of torch inter-op threads per worker process", type=int, default=None)
+    parser.add_argument('--cpu-fast', help="Run an int8 quantized model on the CPU. "
+                        "The embeddings are not the same as those of the full precision model, and unlike those they depend on which "
+                        "windows are batched together, see --check-patents", action='store_true')
+    parser.add_argument('--check-patents', help="With --cpu-fast, first compare the quantized and full precision "
+                        "embeddings of the sections of this many patents. 0 skips the check", type=int, default=16)
+    parser.add_argument('--dtype', help="Data type of the vectors in the embedding stores", choices=('float32', 'float16'), default='float32')
+    parser.add_argument('--tokenizer-workers', help="Number of processes tokenizing ahead of the model. "
+                        "Only used with a single worker, with more workers they tokenize themselves", type=int, default=2)
+    parser.add_argument('--cache', help="Embedding cache file, shared between runs and packaged zips. "
+                        "Defaults to embedding_cache.sqlite in the output directory", type=Path)
+    parser.add_argument('--cache-max-gb', help="Maximum size of the embedding cache, the least recently used embeddings "
+                        "are evicted at the end of the run", type=float, default=4)
+    parser.add_argument('--no-cache', help="Encode all texts, without using the embedding cache", action='store_true')
+    args = parser.parse_args()
+
+    if args.stride is not None and args.stride < min_stride(args.window_length):
+        parser.error(f"--stride can't be shorter than {min_stride(args.window_length)} with a window length of {args.window_length}")
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    encode_kwargs = dict(batch_size=args.batch_size, window_length=args.window_length, stride=args.stride, pooling=args.pooling,
+                         chunk_size=args.chunk_size, model_name=args.model_name,
+                         # Pool workers can't have worker processes of their own
+                         tokenizer_workers=args.tokenizer_workers if args.workers == 1 else 0,
+                         cpu_fast=args.cpu_fast)
+    if args.cpu_fast and args.device != 'cpu':
+        parser.error("--cpu-fast runs the model on the CPU, it can't be used with --device " + args.device)
+    if args.workers == 1:
+        # The inter-op threads can't be set after the model has run, so this has to be done before the check
+        set_threads(args.threads_per_worker, args.interop_threads)
+    if args.cpu_fast and args.check_patents > 0:
+        similarities, batch_similarities = check_quantization(args.packaged[0], model_name=args.model_name, n_patents=args.check_patents,
+                                                              batch_size=args.batch_size, window_length=args.window_length,
+                                                              stride=args.stride, pooling=args.pooling)
+        print(f"Cosine similarity of quantized and full precision embeddings of {len(similarities)} sections: "
+              f"mean {similarities.mean():.4f}, min {similarities.min():.4f}")
+        print(f"Cosine similarity of quantized embeddings encoded in batches and one window at a time: "
+              f"mean {batch_similarities.mean():.4f}, min {batch_similarities.min():.4f}")
+
+    # The shards are only reused by runs with the same settings
+    shard_settings = dict(model_name=args.model_name, window_length=args.window_length, stride=args.stride,
+                          pooling=args.pooling, cpu_fast=args.cpu_fast)
+    shard_jobs, zip_shards = plan_shard_jobs(args.packaged, args.output_dir, args.shard_size, 'sbert', shard_settings)
+
+    cache_path = None
+    if not args.no_cache:
+        cache_path = args.cache if args.cache is not None else args.output_dir / 'embedding_cache.sqlite'
+        # Create the cache before the workers, the tokenizer workers open it read only
+        cache = EmbeddingCache(cache_path, max_bytes=int(args.cache_max_gb*10**9))
+
+    stats = Counter()
+    initargs = (args.model_name, args.device, args.threads_per_worker, encode_kwargs, cache_path, args.interop_threads)
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers, initializer=init_shard_worker, initargs=initargs) as pool:
+            for output_path, shard_stats in tqdm(pool.imap_unordered(encode_shard, shard_jobs), desc="Encoding shards", total=len(shard_jobs)):
+                stats.update(shard_stats)
+    else:
+        init_shard_worker(*initargs)
+        for shard_job in tqdm(shard_jobs, desc="Encoding shards"):
+            output_path, shard_stats = encode_shard(shard_job)
+            stats.update(shard_stats)
+
+    print(f"Encoded windows: {padding_summary(stats)}")
+    if cache_path is not None:
+        print(f"Embedding cache: {cache_summary(stats)}")
+        n_evicted = cache.evict()
+        if n_evicted:
+            print(f"Evicted {n_evicted} embeddings from the cache to keep it below {args.cache_max_gb} GB")
+        cache.close()
+
+    # The complete encodings of each zip are collected in an embedding store
+    for packaged, shard_paths in zip_shards.items():
+        basename = packaged.with_suffix('').name
+        write_embedding_store(args.output_dir / f'patent_sbert_{basename}', load_shards(shard_paths), dtype=args.dtype)
+
+
+if __name__ == '__main__':
+    # The guard is needed since the worker processes import this module on platforms which spawn processes
+    main()
@@ -0,0 +1,183 @@
+"""An index of which date ranges of which classes have been searched, kept next to the search result files.
+
+The class search writes one file per class and date range, named like 'A61K_20100101-20100215.txt'. Instead of
+listing and parsing all those files for every class and year, the index keeps the ranges of each class (and the number
+of documents in each file) in 'search_coverage.json' in the directory. When the index is loaded it is checked against
+the file names in the directory, so files added or removed by other means are picked up.
+
+Rewriting the whole index for every new file would take time quadratic in the number of files, so the files written
+during a search are appended to 'search_coverage.journal' instead. The journal is merged into the index and removed
+when the index is saved, which the search does when it's done, or the next time the index is loaded."""
+import bisect
+import datetime
+import json
+import os
+import re
+from collections import Counter, defaultdict
+from pathlib import Path
+
+
+COVERAGE_NAME = 'search_coverage.json'
+JOURNAL_NAME = 'search_coverage.journal'
+RANGE_FILE_PATTERN = re.compile(r'(.+)_(\d{8})-(\d{8})\.txt$')
+
+
+def parse_range_file_name(name):
+    '''Return the class and date range of a search result file, or None if it isn't one'''
+    m = RANGE_FILE_PATTERN.match(name)
+    if m is None:
+        return None
+    ipc_class, begin_date_str, end_date_str = m.groups()
+    begin_date = datetime.datetime.strptime(begin_date_str, '%Y%m%d')
+    end_date = datetime.datetime.strptime(end_date_str, '%Y%m%d')
+    return ipc_class, (begin_date, end_date)
+
+
+def count_documents(path: Path):
+    with open(path) as fp:
+        return sum(1 for line in fp if line.strip())
+
+
+def merge_date_ranges(date_ranges):
+    '''Merge sorted date ranges which overlap or touch. Returns the merged ranges and the gaps between them.'''
+    merged_date_ranges = []
+    gaps = []
+    if date_ranges:
+        current_start, current_end = date_ranges[0]
+        for next_start, next_end in date_ranges[1:]:
+            if current_end < next_start:
+                merged_date_ranges.append((current_start, current_end))
+                gaps.append((current_end, next_start))
+                current_start, current_end = next_start, next_end
+            else:
+                current_end = max(current_end, next_end)
+        merged_date_ranges.append((current_start, current_end))
+    return merged_date_ranges, gaps
+
+
+class CoverageIndex:
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.index_path = directory / COVERAGE_NAME
+        self.journal_path = directory / JOURNAL_NAME
+        self._journal_fp = None
+        # File name -> (class, (begin_date, end_date), number of documents)
+        self.files = dict()
+        # Class -> sorted list of merged, non-touching, date ranges, and their start and end dates for bisection
+        self.merged = dict()
+        self.merged_starts = dict()
+        self.merged_ends = dict()
+
+    @classmethod
+    def load(cls, directory: Path):
+        '''Load the index of the directory, bringing it up to date with the files which are there'''
+        coverage = cls(directory)
+        if coverage.index_path.exists():
+            with open(coverage.index_path) as fp:
+                stored_files = json.load(fp)
+            for name, (ipc_class, begin_date_str, end_date_str, n_documents) in stored_files.items():
+                begin_date = datetime.datetime.strptime(begin_date_str, '%Y%m%d')
+                end_date = datetime.datetime.strptime(end_date_str, '%Y%m%d')
+                coverage.files[name] = (ipc_class, (begin_date, end_date), n_documents)
+        journal_names = set()
+        if coverage.journal_path.exists():
+            with open(coverage.journal_path) as fp:
+                for line in fp:
+                    try:
+                        name, n_documents = json.loads(line)
+                    except ValueError:
+                        # The last line may be cut off if the search was killed while writing it
+                        continue
+                    ipc_class, date_range = parse_range_file_name(name)
+                    coverage.files[name] = (ipc_class, date_range, n_documents)
+                    journal_names.add(name)
+
+        existing_names = set()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and RANGE_FILE_PATTERN.match(entry.name):
+                    existing_names.add(entry.name)
+        removed_names = coverage.files.keys() - existing_names
+        added_names = existing_names - coverage.files.keys()
+        for name in removed_names:
+            del coverage.files[name]
+        for name in added_names:
+            ipc_class, date_range = parse_range_file_name(name)
+            coverage.files[name] = (ipc_class, date_range, count_documents(directory / name))
+
+        for ipc_class in set(ipc_class for ipc_class, date_range, n_documents in coverage.files.values()):
+            coverage._merge_class(ipc_class)
+        if removed_names or added_names or journal_names:
+            coverage.save()
+        return coverage
+
+    def _merge_class(self, ipc_class):
+        date_ranges = sorted(date_range for ipc_class_, date_range, n_documents in self.files.values() if ipc_class_ == ipc_class)
+        merged, gaps = merge_date_ranges(date_ranges)
+        self.merged[ipc_class] = merged
+        self.merged_starts[ipc_class] = [start for start, end in merged]
+        self.merged_ends[ipc_class] = [end for start, end in merged]
+
+    def add(self, path: Path, n_documents):
+        '''Record a range file which has been written. It's appended to the journal until the index is saved.'''
+        ipc_class, date_range = parse_range_file_name(path.name)
+        self.files[path.name] = (ipc_class, date_range, n_documents)
+        if self._journal_fp is None:
+            self._journal_fp = open(self.journal_path, 'a')
+        self._journal_fp.write(json.dumps([path.name, n_documents]) + '\n')
+        self._journal_fp.flush()
+        merged = self.merged.setdefault(ipc_class, [])
+        starts = self.merged_starts.setdefault(ipc_class, [])
+        ends = self.merged_ends.setdefault(ipc_class, [])
+        # Replace the merged ranges the new range overlaps or touches with one range covering all of them
+        begin_date, end_date = date_range
+        first = bisect.bisect_left(ends, begin_date)
+        last = bisect.bisect_right(starts, end_date)
+        if first < last:
+            begin_date = min(begin_date, starts[first])
+            end_date = max(end_date, ends[last - 1])
+        merged[first:last] = [(begin_date, end_date)]
+        starts[first:last] = [begin_date]
+        ends[first:last] = [end_date]
+
+    def save(self):
+        stored_files = {name: (ipc_class, begin_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'), n_documents)
+                        for name, (ipc_class, (begin_date, end_date), n_documents) in sorted(self.files.items())}
+        part_path = self.index_path.with_name(self.index_path.name + '.part')
+        with open(part_path, 'w') as fp:
+            json.dump(stored_files, fp)
+        os.replace(part_path, self.index_path)
+        # Everything in the journal is in the index now
+        if self._journal_fp is not None:
+            self._journal_fp.close()
+            self._journal_fp = None
+        if self.journal_path.exists():
+            self.journal_path.unlink()
+
+    def missing_date_ranges(self, ipc_class, date_range):
+        '''Return the parts of the date range which are not covered by any range file of the class, and the merged
+        covered ranges overlapping it (including the end points of the query)'''
+        query_start, query_end = date_range
+        starts = self.merged_starts.get(ipc_class, [])
+        ends = self.merged_ends.get(ipc_class, [])
+        # Like for the files, the two dummy ranges make the gaps at the ends of the query show up as missing
+        date_ranges = [(query_start, query_start)]
+        # The merged ranges are disjoint and sorted, so their end dates are sorted as well
+        for i in range(bisect.bisect_right(ends, query_start), len(starts)):
+            if not starts[i] < query_end:
+                break
+            date_ranges.append((starts[i], ends[i]))
+        date_ranges.append((query_end, query_end))
+        date_ranges.sort()
+        merged_existing_date_ranges, missing_date_ranges = merge_date_ranges(date_ranges)
+        return missing_date_ranges, merged_existing_date_ranges
+
+    def document_counts(self, ipc_class=None):
+        '''Return the number of documents found per class and year (of the start date of the ranges)'''
+        counts = defaultdict(Counter)
+        for ipc_class_, (begin_date, end_date), n_documents in self.files.values():
+            if ipc_class is None or ipc_class_ == ipc_class:
+                counts[ipc_class_][begin_date.year] += n_documents
+        if ipc_class is not None:
+            return counts[ipc_class]
+        return counts
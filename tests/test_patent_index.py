@@ -0,0 +1,48 @@
+import sys
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+
+from patent_index import load_index
+
+
+PATENT_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<ep-patent-document id="EP1000001A1" lang="en" country="EP" doc-number="1000001" kind="A1" date-publ="20100106">
+<SDOBI lang="en"><B200><B260>en</B260></B200>
+<B500><B510EP><classification-ipcr sequence="1"><text>A61K  38/44        20060101AFI20130522BHEP        </text></classification-ipcr></B510EP></B500>
+<B700><B710><B711><snm>ACME Corp</snm></B711></B710></B700>
+</SDOBI>
+<abstract id="abst" lang="en"><p num="0001">An abstract.</p></abstract>
+<description id="desc" lang="en"><p num="0001">{padding}DESCRIPTION TEXT AFTER THE BIBLIOGRAPHIC DATA</p></description>
+<claims id="claims01" lang="en"><claim num="0001"><claim-text>A claim.</claim-text></claim></claims>
+</ep-patent-document>
+'''
+
+
+def write_patent_zip(path):
+    # Stored, so the bytes of the description can be changed in the file without breaking the compression
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED) as patent_zip:
+        patent_zip.writestr('TOC.xml', '<toc/>')
+        # A long description, so reading the bibliographic data doesn't read (and check the CRC of) the whole member
+        patent_zip.writestr('1000001/EP1000001NWA1.xml', PATENT_XML.format(padding='Some description. ' * 20000))
+
+
+def test_corrupt_description_is_broken(tmp_path):
+    good_path = tmp_path / 'EP1000001NWA1.zip'
+    write_patent_zip(good_path)
+    corrupt_path = tmp_path / 'EP1000002NWA1.zip'
+    write_patent_zip(corrupt_path)
+    data = bytearray(corrupt_path.read_bytes())
+    offset = data.index(b'DESCRIPTION TEXT')
+    data[offset] ^= 0x01
+    corrupt_path.write_bytes(bytes(data))
+
+    entries = {entry['path'].name: entry for entry in load_index(tmp_path, tmp_path / 'index.sqlite')}
+    assert not entries[good_path.name]['broken']
+    assert entries[good_path.name]['validation_error'] is None
+    assert entries[corrupt_path.name]['broken']
+    assert 'CRC' in entries[corrupt_path.name]['validation_error']
+    # The bibliographic data before the corruption is still indexed
+    assert entries[corrupt_path.name]['document_number'] == 'EP1000001.A1'
+    assert entries[corrupt_path.name]['ipc_classes'] == [('A61K', '38/44')]